@@ -1,4 +1,6 @@
-from nestcloud import app, db
+from nestcloud import create_app, db
+
+app = create_app()
 
 # from pages.home import home_bp
 # from pages.about import about_bp
@@ -0,0 +1,9 @@
+"""
+Точка входа для ASGI-сервера (асинхронный режим, см. nestcloud/asgi.py):
+
+    uvicorn asgi:application --workers 4
+"""
+
+from nestcloud.asgi import create_asgi_app
+
+application = create_asgi_app()
@@ -0,0 +1,69 @@
+"""
+Сравнение двух прогонов бенчмарков:
+
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+
+Для каждого замера выводится медиана до и после и изменение в процентах
+(отрицательное — стало быстрее). --threshold задаёт порог в процентах,
+при превышении которого команда завершается с кодом 1 (для CI).
+"""
+
+import argparse
+import json
+import sys
+
+
+def result_key(result):
+    return (
+        result["group"],
+        result["name"],
+        json.dumps(result["params"], sort_keys=True, ensure_ascii=False),
+    )
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data["meta"], {result_key(r): r for r in data["results"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сравнение результатов бенчмарков")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        help="допустимое замедление медианы, %% (больше — код выхода 1)",
+    )
+    args = parser.parse_args(argv)
+
+    old_meta, old = load_results(args.baseline)
+    new_meta, new = load_results(args.current)
+    print(f"до:    {old_meta.get('git_revision')} ({old_meta.get('started_at')})")
+    print(f"после: {new_meta.get('git_revision')} ({new_meta.get('started_at')})")
+
+    regressions = []
+    for key in sorted(set(old) | set(new)):
+        group, name, params = key
+        label = f"{group}/{name} {params}"
+        if key not in old or key not in new:
+            print(f"{label}: есть только в {'новом' if key in new else 'старом'} прогоне")
+            continue
+        before = old[key]["median"]
+        after = new[key]["median"]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{label}: {before * 1000:.2f} мс → {after * 1000:.2f} мс ({change:+.1f}%)")
+        if args.threshold is not None and change > args.threshold:
+            regressions.append(label)
+
+    if regressions:
+        print(f"Замедление больше {args.threshold}%:")
+        for label in regressions:
+            print(f"  {label}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
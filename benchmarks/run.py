@@ -0,0 +1,508 @@
+"""
+Набор бенчмарков NestCloud.
+
+Запускается без сети, на временной базе SQLite и временной папке загрузок:
+
+    python -m benchmarks.run                      # полный набор
+    python -m benchmarks.run --quick              # быстрый прогон (10 и 1000 файлов)
+    python -m benchmarks.run --only listing,preview --output out.json
+
+Запросы выполняются через тестовый клиент Flask (в том же процессе, без
+HTTP-сервера), поэтому измеряется код приложения: разбор формы, запись
+на диск, запросы к БД, шаблоны и отдача файлов — без накладных расходов сети.
+
+Результат — JSON (см. benchmarks/compare.py для сравнения двух прогонов).
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from functools import partial
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GROUPS = ("upload", "listing", "preview", "download")
+BENCH_PASSWORD = "benchmark"
+MIB = 1024 * 1024
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_float_list(value):
+    return [float(v) for v in value.split(",") if v]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки NestCloud")
+    parser.add_argument("--only", default=",".join(GROUPS), help="группы через запятую")
+    parser.add_argument(
+        "--file-counts",
+        type=parse_int_list,
+        default=[10, 1000, 100000],
+        help="число файлов у пользователей для замеров списка",
+    )
+    parser.add_argument(
+        "--megapixels",
+        type=parse_float_list,
+        default=[1, 4, 12, 24],
+        help="размеры тестовых изображений для превью, Мпикс",
+    )
+    parser.add_argument("--download-mb", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=5, help="повторов каждого замера")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--quick", action="store_true", help="меньшие объёмы данных")
+    parser.add_argument("--output", help="файл результата (по умолчанию benchmarks/results/)")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.file_counts = [c for c in args.file_counts if c <= 1000] or [10]
+        args.megapixels = [m for m in args.megapixels if m <= 4] or [1]
+        args.download_mb = min(args.download_mb, 16)
+        args.repeat = min(args.repeat, 3)
+    args.only = [g for g in args.only.split(",") if g]
+    unknown = set(args.only) - set(GROUPS)
+    if unknown:
+        parser.error(f"неизвестные группы: {', '.join(sorted(unknown))}")
+    return args
+
+
+def measure(fn, repeat, warmup=1):
+    """Время выполнения fn() в секундах: warmup прогонов отбрасываются"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def make_result(group, name, params, samples, nbytes=None, items=None):
+    """Запись результата: статистика по замерам и пропускная способность по медиане"""
+    median = statistics.median(samples)
+    result = {
+        "group": group,
+        "name": name,
+        "params": params,
+        "samples": [round(s, 6) for s in samples],
+        "min": round(min(samples), 6),
+        "median": round(median, 6),
+        "mean": round(statistics.fmean(samples), 6),
+        "max": round(max(samples), 6),
+    }
+    if nbytes is not None:
+        result["bytes"] = nbytes
+        result["mib_per_s"] = round(nbytes / MIB / median, 2)
+    if items is not None:
+        result["items"] = items
+        result["items_per_s"] = round(items / median, 2)
+    label = ", ".join(f"{k}={v}" for k, v in params.items())
+    extra = ""
+    if "mib_per_s" in result:
+        extra += f"  {result['mib_per_s']} МиБ/с"
+    if "items_per_s" in result:
+        extra += f"  {result['items_per_s']} шт/с"
+    print(f"  {name} ({label}): медиана {median * 1000:.2f} мс{extra}", flush=True)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_environment(workdir):
+    """Временная БД и настройки: задаются до импорта приложения"""
+    os.environ["DATABASE"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Шаблоны и статика ищутся относительно текущей папки
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    from nestcloud import create_app, db
+
+    app = create_app(
+        {
+            "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+            "WTF_CSRF_ENABLED": False,
+            "USER_QUOTA_BYTES": 0,
+        }
+    )
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def create_user(login):
+    from nestcloud import db
+    from nestcloud.models import User
+    from nestcloud.security import hash_password
+
+    user = User(login=login, password=hash_password(BENCH_PASSWORD))
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def login_client(app, login):
+    client = app.test_client()
+    # Как WSGI-сервер: ответ читается целиком и закрывается,
+    # иначе место передачи (nestcloud.admission) остаётся занятым
+    client.open = partial(client.open, buffered=True)
+    response = client.post("/login", data={"login": login, "password": BENCH_PASSWORD})
+    assert response.status_code == 302, f"вход {login} не удался"
+    return client
+
+
+def seed_files(user_id, count, rng, batch_size=10000):
+    """
+    Добавляет count записей File одним пакетным INSERT на пачку
+    (содержимое на диск не пишется — для замеров списка оно не нужно).
+    """
+    from sqlalchemy import insert, update
+
+    from nestcloud import db
+    from nestcloud.models import File, User
+    from utils import get_file_category, get_human_readable_size
+
+    extensions = [".jpg", ".png", ".pdf", ".docx", ".txt", ".mp3", ".mp4", ".zip", ".bin"]
+    words = ["отчёт", "report", "photo", "фото", "invoice", "backup", "notes", "draft"]
+    started = datetime(2020, 1, 1)
+    total_bytes = 0
+    for offset in range(0, count, batch_size):
+        rows = []
+        for i in range(offset, min(count, offset + batch_size)):
+            ext = rng.choice(extensions)
+            name = f"{rng.choice(words)}_{i}{ext}"
+            size = rng.randint(1024, 50 * MIB)
+            total_bytes += size
+            category = get_file_category(name)
+            rows.append(
+                {
+                    "filename": name,
+                    "stored_filename": f"{i:032x}_{name}",
+                    "preview_path": None if category == "image" else "file_icons/other.png",
+                    "preview_status": "failed" if category == "image" else None,
+                    "user_id": user_id,
+                    "file_size": get_human_readable_size(size),
+                    "size_bytes": size,
+                    "upload_time": started + timedelta(seconds=i * 37),
+                    "category": category,
+                }
+            )
+        # Пакетная вставка ядром SQLAlchemy (без событий ORM на каждую строку)
+        db.session.execute(insert(File), rows)
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(used_bytes=total_bytes, file_count=count)
+    )
+    db.session.commit()
+
+
+def bench_listing(app, args, rng):
+    results = []
+    for count in args.file_counts:
+        login = f"bench_list_{count}"
+        with app.app_context():
+            user_id = create_user(login)
+            started = time.perf_counter()
+            seed_files(user_id, count, rng)
+            print(f"  наполнение: {count} файлов за {time.perf_counter() - started:.1f} с")
+        client = login_client(app, login)
+        params = {"files": count}
+
+        # Следующая страница — по курсору из первой
+        first = client.get("/files/page").get_json()
+        cursor = first["next_cursor"]
+
+        cases = [
+            ("home", "/home"),
+            ("home_sort_name", "/home?sort=name-asc"),
+            ("home_sort_size", "/home?sort=size-desc"),
+            ("home_search", "/home?q=report"),
+            ("home_search_short", "/home?q=12"),
+            ("home_filter_type", "/home?type=document"),
+        ]
+        if cursor:
+            cases.append(("files_next_page", f"/files/page?cursor={cursor}"))
+        for name, url in cases:
+
+            def request_page(url=url):
+                response = client.get(url)
+                assert response.status_code == 200, (url, response.status_code)
+
+            results.append(
+                make_result(
+                    "listing", name, params, measure(request_page, args.repeat)
+                )
+            )
+    return results
+
+
+def bench_upload(app, args, rng):
+    results = []
+    with app.app_context():
+        create_user("bench_upload")
+    client = login_client(app, "bench_upload")
+
+    cases = [
+        # (название, число файлов в запросе, размер файла)
+        ("upload_single_small", 1, 64 * 1024),
+        ("upload_many_small", 50, 64 * 1024),
+        ("upload_single_large", 1, 32 * MIB),
+    ]
+    if args.quick:
+        cases[-1] = ("upload_single_large", 1, 8 * MIB)
+    for name, files_per_request, size in cases:
+        payloads = [rng.randbytes(size) for _ in range(files_per_request)]
+
+        def upload(payloads=payloads):
+            data = {
+                "file": [
+                    (io.BytesIO(payload), f"file_{i}.bin")
+                    for i, payload in enumerate(payloads)
+                ]
+            }
+            response = client.post(
+                "/upload",
+                data=data,
+                content_type="multipart/form-data",
+                headers={"Accept": "application/json"},
+            )
+            assert response.status_code == 200, response.data
+            assert all("id" in r for r in response.get_json()["results"])
+
+        samples = measure(upload, args.repeat)
+        results.append(
+            make_result(
+                "upload",
+                name,
+                {"files_per_request": files_per_request, "file_bytes": size},
+                samples,
+                nbytes=size * files_per_request,
+                items=files_per_request,
+            )
+        )
+    return results
+
+
+def make_test_image(path, megapixels, fmt, rng):
+    """Изображение с шумом и градиентом (сжимается примерно как фотография)"""
+    from PIL import Image
+
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    noise = Image.effect_noise((width, height), 64)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    channels = [
+        Image.blend(noise, gradient, alpha)
+        for alpha in (0.3, 0.5, 0.7)
+    ]
+    rng.shuffle(channels)
+    Image.merge("RGB", channels).save(path, format=fmt, quality=90)
+    return width, height
+
+
+def bench_preview(app, args, rng, workdir):
+    from utils import generate_image_preview
+
+    results = []
+    output_dir = os.path.join(workdir, "previews")
+    for megapixels in args.megapixels:
+        for fmt in ("JPEG", "PNG"):
+            path = os.path.join(workdir, f"image_{megapixels}mp.{fmt.lower()}")
+            width, height = make_test_image(path, megapixels, fmt, rng)
+
+            def build(path=path):
+                assert generate_image_preview(path, output_dir=output_dir)
+
+            results.append(
+                make_result(
+                    "preview",
+                    "generate_image_preview",
+                    {
+                        "megapixels": megapixels,
+                        "format": fmt.lower(),
+                        "width": width,
+                        "height": height,
+                    },
+                    measure(build, args.repeat),
+                    nbytes=os.path.getsize(path),
+                )
+            )
+    return results
+
+
+def bench_download(app, args, rng):
+    results = []
+    with app.app_context():
+        create_user("bench_download")
+    client = login_client(app, "bench_download")
+
+    size = args.download_mb * MIB
+    response = client.post(
+        "/upload",
+        data={"file": [(io.BytesIO(rng.randbytes(size)), "download.bin")]},
+        content_type="multipart/form-data",
+        headers={"Accept": "application/json"},
+    )
+    file_id = response.get_json()["results"][0]["id"]
+    url = f"/download/{file_id}"
+    params = {"file_bytes": size}
+
+    def full_download():
+        response = client.get(url)
+        assert response.status_code == 200 and len(response.data) == size
+
+    results.append(
+        make_result(
+            "download", "download_full", params, measure(full_download, args.repeat),
+            nbytes=size,
+        )
+    )
+
+    # Последовательное чтение файла диапазонами по 1 МиБ (как при перемотке видео)
+    range_size = MIB
+    ranges = [(start, min(size, start + range_size) - 1) for start in range(0, size, range_size)]
+
+    def ranged_download():
+        for start, end in ranges:
+            response = client.get(url, headers={"Range": f"bytes={start}-{end}"})
+            assert response.status_code == 206 and len(response.data) == end - start + 1
+
+    results.append(
+        make_result(
+            "download",
+            "download_ranges",
+            {**params, "range_bytes": range_size},
+            measure(ranged_download, args.repeat),
+            nbytes=size,
+            items=len(ranges),
+        )
+    )
+
+    # Несколько диапазонов в одном запросе (multipart/byteranges)
+    picked = sorted(rng.sample(ranges, min(16, len(ranges))))
+    picked_bytes = sum(end - start + 1 for start, end in picked)
+    header = "bytes=" + ",".join(f"{start}-{end}" for start, end in picked)
+
+    def multi_range_download():
+        response = client.get(url, headers={"Range": header})
+        assert response.status_code == 206 and len(response.data) > picked_bytes
+
+    results.append(
+        make_result(
+            "download",
+            "download_multi_range",
+            {**params, "ranges": len(picked), "range_bytes": range_size},
+            measure(multi_range_download, args.repeat),
+            nbytes=picked_bytes,
+        )
+    )
+
+    # Условный запрос: ответ 304 без тела
+    etag = client.get(url, headers={"Range": "bytes=0-0"}).headers["ETag"]
+
+    def conditional_download():
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+    results.append(
+        make_result(
+            "download", "download_not_modified", params,
+            measure(conditional_download, args.repeat),
+        )
+    )
+    return results
+
+
+def collect_meta(app, args):
+    import PIL
+
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "sqlite": sqlite3.sqlite_version,
+        "pillow": PIL.__version__,
+        "config": {
+            key: app.config[key]
+            for key in ("STORAGE_MODE", "STORAGE_FANOUT", "PREVIEW_MODE", "UPLOAD_WRITE_WORKERS")
+        },
+        "args": {
+            "only": args.only,
+            "file_counts": args.file_counts,
+            "megapixels": args.megapixels,
+            "download_mb": args.download_mb,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "quick": args.quick,
+        },
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="nestcloud-bench-")
+    try:
+        app = prepare_environment(workdir)
+        meta = collect_meta(app, args)
+        results = []
+        for group in GROUPS:
+            if group not in args.only:
+                continue
+            print(f"[{group}]", flush=True)
+            if group == "listing":
+                results += bench_listing(app, args, rng)
+            elif group == "upload":
+                results += bench_upload(app, args, rng)
+            elif group == "preview":
+                results += bench_preview(app, args, rng, workdir)
+            elif group == "download":
+                results += bench_download(app, args, rng)
+    finally:
+        if args.keep:
+            print(f"Временные данные: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output
+    if not output:
+        revision = (meta["git_revision"] or "unknown")[:8]
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(ROOT, "benchmarks", "results", f"{stamp}-{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+
+
+if __name__ == "__main__":
+    main()
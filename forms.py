@@ -1,13 +1,14 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileRequired
+from flask_wtf.file import MultipleFileField, FileRequired
 from wtforms import SubmitField
 
 
 class UploadForm(FlaskForm):
-    file = FileField(
-        "Файл",
+    # Несколько файлов или целая папка за один запрос
+    file = MultipleFileField(
+        "Файлы",
         validators=[
-            FileRequired(message="Пожалуйста, выберите файл"),
+            FileRequired(message="Пожалуйста, выберите файлы"),
         ],
     )
     submit = SubmitField("Загрузить")
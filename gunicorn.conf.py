@@ -0,0 +1,49 @@
+"""
+Настройки gunicorn для рабочего режима (gunicorn -c gunicorn.conf.py wsgi:app).
+
+Значения берутся из переменных окружения:
+GUNICORN_BIND, GUNICORN_WORKERS, GUNICORN_THREADS, GUNICORN_TIMEOUT.
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:8000")
+# Процессы обрабатывают запросы параллельно; с SQLite больше ядер процессора
+# ставить бессмысленно — коммиты всё равно выполняются по одному
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count())))
+# Потоки внутри процесса ждут диск и сеть (загрузка и отдача файлов), не занимая процесс
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Загрузка больших файлов по медленному каналу может идти долго
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+# Приложение импортируется один раз в главном процессе и копируется при fork
+preload_app = True
+# Перезапуск процесса после N запросов ограничивает рост памяти
+max_requests = 5000
+max_requests_jitter = 500
+accesslog = "-"
+
+
+def on_starting(server):
+    # Снимки метрик прошлого запуска не относятся к новым процессам
+    from nestcloud.metrics import shared_metrics
+
+    shared_metrics.clear()
+
+
+def post_fork(server, worker):
+    # Соединения, открытые до fork, нельзя использовать в нескольких процессах
+    from nestcloud import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    # Последние значения процесса попадают в сумму /metrics
+    from nestcloud.metrics import shared_metrics
+
+    shared_metrics.flush()
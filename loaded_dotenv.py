@@ -5,3 +5,30 @@ load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 DATABASE = os.getenv("DATABASE")
+# Режим хранения: "files" — каждый файл отдельно, "cas" — по хешу содержимого с дедупликацией
+STORAGE_MODE = os.getenv("STORAGE_MODE", "files")
+# Сжатие содержимого в режиме files: "" — хранить как есть, "zstd" — сжимать сжимаемые файлы при записи
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "")
+# Число уровней подкаталогов (по 2 символа хеша имени) для файлов и превью; 0 — все файлы в одной папке
+STORAGE_FANOUT = int(os.getenv("STORAGE_FANOUT", "2"))
+# Квота на пользователя в байтах по умолчанию; 0 — без ограничения
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_BYTES", "0"))
+# Метод хеширования паролей werkzeug с параметрами сложности, например "scrypt:32768:8:1"
+# или "pbkdf2:sha256:600000"; пусто — метод по умолчанию. При смене хеши пересчитываются при входе
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "")
+# Отдача файлов веб-сервером: "" — отдаёт Flask, "x-accel" — nginx (X-Accel-Redirect), "x-sendfile" — Apache/lighttpd
+SENDFILE_MODE = os.getenv("SENDFILE_MODE", "")
+# Внутренний location nginx, соответствующий UPLOAD_FOLDER (для x-accel)
+SENDFILE_PREFIX = os.getenv("SENDFILE_PREFIX", "/protected-uploads")
+# Построение превью: "async" — в фоновом обработчике, "inline" — во время загрузки
+PREVIEW_MODE = os.getenv("PREVIEW_MODE", "async")
+# Журналирование: уровень (DEBUG, INFO, WARNING, ...) и формат ("text" или "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Токен для /metrics (заголовок "Authorization: Bearer <токен>"); пусто — без проверки
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Соединений с БД в пуле на процесс и сколько можно открыть сверх него
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Сколько секунд SQLite ждёт освобождения блокировки записи
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "15"))
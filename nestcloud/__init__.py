@@ -1,19 +1,181 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from loaded_dotenv import DATABASE, SECRET_KEY
+from loaded_dotenv import (
+    DATABASE,
+    SECRET_KEY,
+    STORAGE_MODE,
+    STORAGE_COMPRESSION,
+    STORAGE_FANOUT,
+    USER_QUOTA_BYTES,
+    PASSWORD_HASH_METHOD,
+    SENDFILE_MODE,
+    SENDFILE_PREFIX,
+    PREVIEW_MODE,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    METRICS_TOKEN,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    SQLITE_BUSY_TIMEOUT,
+)
+from nestcloud.logs import configure_logging
 import os
 
 app = Flask("NestCloud")
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE
 app.secret_key = SECRET_KEY
-db = SQLAlchemy(app)
-manager = LoginManager(app)
+# БД и вход подключаются к приложению в create_app
+db = SQLAlchemy()
+manager = LoginManager()
 manager.login_view = "login_page"  # ← обязательно!
 manager.login_message = "Пожалуйста, войдите в аккаунт, чтобы получить доступ."
 manager.login_message_category = "info"
 
+app.config["LOG_LEVEL"] = LOG_LEVEL
+app.config["LOG_FORMAT"] = LOG_FORMAT
+# Пул соединений с БД (на процесс) и ожидание блокировки SQLite, секунды
+app.config["DB_POOL_SIZE"] = DB_POOL_SIZE
+app.config["DB_MAX_OVERFLOW"] = DB_MAX_OVERFLOW
+app.config["DB_POOL_RECYCLE"] = 1800
+app.config["SQLITE_BUSY_TIMEOUT"] = SQLITE_BUSY_TIMEOUT
+app.config["SQLITE_JOURNAL_MODE"] = "WAL"
+app.config["SQLITE_SYNCHRONOUS"] = "NORMAL"
 app.config["UPLOAD_FOLDER"] = os.path.join(app.root_path, "uploads")
 app.config["MAX_CONTENT_LENGTH"] = 512 * 1024 * 1024  # 16 МБ максимум
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-from nestcloud import models, routes
+app.config["STORAGE_MODE"] = STORAGE_MODE
+app.config["STORAGE_FANOUT"] = STORAGE_FANOUT
+# Сжатие при записи (режим files): уровень zstd, сколько байт с начала файла
+# пробно сжимается и до какой доли должна сжаться проба, чтобы сжимать весь файл
+app.config["STORAGE_COMPRESSION"] = STORAGE_COMPRESSION
+app.config["COMPRESSION_LEVEL"] = 3
+app.config["COMPRESSION_SAMPLE_BYTES"] = 64 * 1024
+app.config["COMPRESSION_MAX_RATIO"] = 0.8
+app.config["SENDFILE_MODE"] = SENDFILE_MODE
+app.config["SENDFILE_PREFIX"] = SENDFILE_PREFIX
+# Превью по адресу с версией файла (?v=) не меняется: браузер может кешировать его на год
+app.config["PREVIEW_MAX_AGE"] = 365 * 24 * 3600
+# Иконки типов файлов (static/file_icons) могут смениться с обновлением — кешируются на сутки
+app.config["ICON_MAX_AGE"] = 24 * 3600
+# Сколько превью можно запросить одним /preview/batch
+app.config["PREVIEW_BATCH_MAX"] = 200
+# Превью: "async" — строит фоновый обработчик (flask preview-worker), "inline" — сразу при загрузке
+app.config["PREVIEW_MODE"] = PREVIEW_MODE
+app.config["PREVIEW_JOB_TIMEOUT"] = 300
+app.config["PREVIEW_MAX_ATTEMPTS"] = 3
+# Производные превью: допустимые ширины и лимит дискового кеша
+app.config["DERIVATIVE_WIDTHS"] = (64, 128, 256, 512, 1024, 2048)
+app.config["DERIVATIVE_CACHE_MAX_BYTES"] = 1024 * 1024 * 1024
+# Максимум файлов в одной групповой операции (архив, удаление)
+app.config["BULK_MAX_FILES"] = 1000
+# Загрузка по частям: размер чанка, максимальный размер файла и время жизни сессии
+app.config["UPLOAD_CHUNK_SIZE"] = 8 * 1024 * 1024
+app.config["UPLOAD_SESSION_MAX_SIZE"] = 512 * 1024 * 1024
+app.config["UPLOAD_SESSION_TTL_HOURS"] = 24
+# Хранение прежних версий файлов: сколько последних и сколько дней (0 — без ограничения)
+app.config["VERSION_KEEP_COUNT"] = 10
+app.config["VERSION_KEEP_DAYS"] = 30
+# Сколько файлов одного запроса записывается на диск параллельно
+app.config["UPLOAD_WRITE_WORKERS"] = 8
+# Квота по умолчанию (User.quota_bytes переопределяет её для отдельного пользователя)
+app.config["USER_QUOTA_BYTES"] = USER_QUOTA_BYTES
+# Кеш пользователей для загрузчика Flask-Login (секунды; 0 — без кеша)
+app.config["USER_CACHE_TTL"] = 30
+app.config["USER_CACHE_MAX_SIZE"] = 10000
+# Хеширование паролей: метод/сложность, число потоков и допустимая очередь
+app.config["PASSWORD_HASH_METHOD"] = PASSWORD_HASH_METHOD
+app.config["PASSWORD_HASH_WORKERS"] = 2
+app.config["PASSWORD_HASH_MAX_PENDING"] = 32
+# Режим ASGI (nestcloud.asgi): потоки для обработчиков и чтения файлов,
+# сколько тела запроса держать в памяти до записи во временный файл
+# и каким блоком отдавать файлы
+app.config["ASGI_WORKER_THREADS"] = 16
+app.config["ASGI_SPOOL_MEMORY"] = 1024 * 1024
+app.config["ASGI_READ_SIZE"] = 256 * 1024
+# Проверка хранилища (flask scrub): скорость чтения, что делать с файлами без записей
+# в БД (quarantine / delete / report), с какого возраста файл считается брошенным,
+# сколько дней хранить карантин и пауза между проходами (секунды)
+app.config["SCRUB_IO_BYTES_PER_SECOND"] = 32 * 1024 * 1024
+app.config["SCRUB_ORPHAN_ACTION"] = "quarantine"
+app.config["SCRUB_ORPHAN_GRACE_SECONDS"] = 3600
+app.config["SCRUB_QUARANTINE_DAYS"] = 30
+app.config["SCRUB_PASS_INTERVAL"] = 24 * 3600
+# Корзина: сколько дней хранить удалённые файлы, скорость окончательного
+# удаления (файлов в секунду, 0 — без ограничения) и пауза между проходами
+# flask purge-trash (секунды)
+app.config["TRASH_RETENTION_DAYS"] = 30
+app.config["TRASH_PURGE_FILES_PER_SECOND"] = 100
+app.config["TRASH_PURGE_INTERVAL"] = 300
+# Допуск передач (nestcloud.admission): сколько загрузок и скачиваний одновременно
+# на пользователя и всего (0 — без ограничения; загрузок на пользователя не меньше
+# числа параллельных чанков в браузере), скорость в байтах в секунду (0 — без
+# ограничения), на сколько секунд копится запас скорости, Retry-After при отказе,
+# срок аренды места (продлевается по ходу передачи) и файл общего состояния
+# процессов (None — uploads/.transfers.sqlite) с таймаутом блокировки
+app.config["UPLOAD_CONCURRENCY_PER_USER"] = 4
+app.config["UPLOAD_CONCURRENCY_TOTAL"] = 64
+app.config["DOWNLOAD_CONCURRENCY_PER_USER"] = 8
+app.config["DOWNLOAD_CONCURRENCY_TOTAL"] = 256
+app.config["UPLOAD_BYTES_PER_SECOND_PER_USER"] = 0
+app.config["UPLOAD_BYTES_PER_SECOND_TOTAL"] = 0
+app.config["DOWNLOAD_BYTES_PER_SECOND_PER_USER"] = 0
+app.config["DOWNLOAD_BYTES_PER_SECOND_TOTAL"] = 0
+app.config["TRANSFER_BURST_SECONDS"] = 1
+app.config["TRANSFER_RETRY_AFTER"] = 2
+app.config["TRANSFER_LEASE_SECONDS"] = 60
+app.config["TRANSFER_STATE_PATH"] = None
+app.config["TRANSFER_STATE_TIMEOUT"] = 5
+# Метрики всех процессов сервера: каталог снимков (None — uploads/.metrics)
+# и как часто процесс записывает туда свои значения, секунды
+app.config["METRICS_DIR"] = None
+app.config["METRICS_FLUSH_INTERVAL"] = 5
+# Доступ к /metrics (пусто — открыт; закрывайте на уровне сети или токеном)
+app.config["METRICS_TOKEN"] = METRICS_TOKEN
+
+_app_created = False
+
+
+def create_app(config=None):
+    """
+    Настраивает приложение и возвращает его (точка входа для flask, gunicorn и скриптов).
+
+    :param config: настройки поверх значений из .env, например адрес БД для тестов
+    """
+    global _app_created
+    if _app_created:
+        # Обработчики регистрируются на одном объекте app — второй экземпляр не создать
+        if config:
+            raise RuntimeError("Приложение уже создано, настройки не применить")
+        return app
+
+    app.config.update(config or {})
+    configure_logging(app.config["LOG_LEVEL"], app.config["LOG_FORMAT"])
+
+    from nestcloud.database import get_engine_options
+
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(app.config)
+    db.init_app(app)
+    manager.init_app(app)
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+    # Модули регистрируют обработчики и читают настройки при импорте
+    from nestcloud import (
+        metrics,
+        models,
+        search,
+        security,
+        routes,
+        quota,
+        admission,
+        upload_sessions,
+        versions,
+        trash,
+        previews,
+        scrubber,
+        derivatives,
+        api,
+        commands,
+    )
+
+    _app_created = True
+    return app
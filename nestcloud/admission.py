@@ -0,0 +1,412 @@
+"""
+Допуск загрузок и скачиваний: сколько передач одновременно и с какой
+скоростью может вести один пользователь и весь сервер.
+
+- Одновременные передачи — аренды: строка на передачу со сроком
+  TRANSFER_LEASE_SECONDS, который продлевается по ходу передачи, так что
+  место, занятое упавшим процессом, освобождается само. Сверх
+  *_CONCURRENCY_PER_USER / *_CONCURRENCY_TOTAL запрос сразу получает 429
+  с Retry-After — ещё до чтения тела (before_request срабатывает раньше
+  разбора формы, в режиме ASGI место занимается до приёма тела).
+- Скорость — token bucket на пользователя и общий (*_BYTES_PER_SECOND_*):
+  передача списывает переданные байты, и если запас ушёл в минус, ждёт,
+  пока он восстановится. Запас накапливается не больше чем на
+  TRANSFER_BURST_SECONDS секунд.
+
+Состояние общее для всех процессов сервера: оно хранится в отдельном
+файле SQLite (TRANSFER_STATE_PATH, по умолчанию uploads/.transfers.sqlite)
+независимо от основной БД. Если хранилище недоступно, передачи
+пропускаются без ограничений — ограничение не должно останавливать сервис.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from flask import jsonify, request
+from flask_login import current_user
+
+from nestcloud import app
+from nestcloud.metrics import (
+    REGISTRY,
+    TRANSFER_THROTTLED,
+    TRANSFERS_REJECTED,
+    CallbackGauge,
+    call_when_sent,
+)
+
+logger = logging.getLogger(__name__)
+
+# Обработчики, передающие содержимое файлов, и вид передачи
+TRANSFER_ENDPOINTS = {
+    "upload_file": "upload",
+    "api_upload_file": "upload",
+    "upload_chunk": "upload",
+    "download_file": "download",
+    "download_file_version": "download",
+    "download_files_bulk": "download",
+}
+# Ключи окружения WSGI: допущенная передача, отказ (исчерпанный предел)
+# и функция ожидания (в режиме ASGI ожидание переносится в цикл asyncio)
+ENVIRON_TRANSFER = "nestcloud.transfer"
+ENVIRON_REJECTED = "nestcloud.transfer_rejected"
+ENVIRON_SLEEP = "nestcloud.transfer_sleep"
+# Сколько байт накапливается до списания из ведра (одна транзакция SQLite)
+ACCOUNT_QUANTUM = 256 * 1024
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS lease ("
+    " id INTEGER PRIMARY KEY, kind TEXT NOT NULL,"
+    " user_id INTEGER NOT NULL, expires_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_lease_kind_user ON lease (kind, user_id)",
+    "CREATE TABLE IF NOT EXISTS bucket ("
+    " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)",
+)
+
+_local = threading.local()
+
+
+def get_state_path():
+    return app.config["TRANSFER_STATE_PATH"] or os.path.join(
+        app.config["UPLOAD_FOLDER"], ".transfers.sqlite"
+    )
+
+
+def connect():
+    """Соединение с хранилищем состояния — своё у каждого потока и процесса"""
+    path = get_state_path()
+    key = (os.getpid(), path)
+    if getattr(_local, "key", None) == key:
+        return _local.connection
+    connection = sqlite3.connect(
+        path, timeout=app.config["TRANSFER_STATE_TIMEOUT"], isolation_level=None
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    # Состояние временное: после сбоя питания его не жалко потерять
+    connection.execute("PRAGMA synchronous = OFF")
+    for ddl in SCHEMA:
+        connection.execute(ddl)
+    _local.connection = connection
+    _local.key = key
+    return connection
+
+
+@contextmanager
+def transaction():
+    """Транзакция с блокировкой на запись с самого начала (BEGIN IMMEDIATE)"""
+    connection = connect()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def get_limits(kind):
+    """(одновременно на пользователя, всего, байт/с на пользователя, байт/с всего)"""
+    prefix = kind.upper()
+    return (
+        app.config[f"{prefix}_CONCURRENCY_PER_USER"],
+        app.config[f"{prefix}_CONCURRENCY_TOTAL"],
+        app.config[f"{prefix}_BYTES_PER_SECOND_PER_USER"],
+        app.config[f"{prefix}_BYTES_PER_SECOND_TOTAL"],
+    )
+
+
+def try_acquire(kind, user_id):
+    """
+    Занимает место для передачи, если пределы одновременных передач не исчерпаны.
+
+    :return: (id аренды, None) или (None, "user" / "total" — исчерпанный предел)
+    """
+    per_user, total, _, _ = get_limits(kind)
+    now = time.time()
+    with transaction() as connection:
+        connection.execute("DELETE FROM lease WHERE expires_at < ?", (now,))
+        if per_user:
+            (count,) = connection.execute(
+                "SELECT count(*) FROM lease WHERE kind = ? AND user_id = ?",
+                (kind, user_id),
+            ).fetchone()
+            if count >= per_user:
+                return None, "user"
+        if total:
+            (count,) = connection.execute(
+                "SELECT count(*) FROM lease WHERE kind = ?", (kind,)
+            ).fetchone()
+            if count >= total:
+                return None, "total"
+        cursor = connection.execute(
+            "INSERT INTO lease (kind, user_id, expires_at) VALUES (?, ?, ?)",
+            (kind, user_id, now + app.config["TRANSFER_LEASE_SECONDS"]),
+        )
+        return cursor.lastrowid, None
+
+
+def take_tokens(connection, key, rate, amount, now):
+    """
+    Списывает amount байт из ведра key (rate байт/с).
+
+    :return: сколько секунд ждать, пока запас ведра не перестанет быть отрицательным
+    """
+    burst = rate * app.config["TRANSFER_BURST_SECONDS"]
+    row = connection.execute(
+        "SELECT tokens, updated_at FROM bucket WHERE key = ?", (key,)
+    ).fetchone()
+    tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+    tokens -= amount
+    connection.execute(
+        "INSERT INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, "
+        "updated_at = excluded.updated_at",
+        (key, tokens, now),
+    )
+    return max(0.0, -tokens / rate)
+
+
+class Transfer:
+    """Допущенная передача: аренда места и учёт переданных байт в вёдрах скорости"""
+
+    def __init__(self, kind, user_id, lease_id):
+        self.kind = kind
+        self.user_id = user_id
+        self.lease_id = lease_id
+        _, _, user_rate, total_rate = get_limits(kind)
+        self.buckets = [
+            (key, rate)
+            for key, rate in ((f"{kind}:{user_id}", user_rate), (f"{kind}:*", total_rate))
+            if rate
+        ]
+        self.lease_seconds = app.config["TRANSFER_LEASE_SECONDS"]
+        self.pending = 0
+        self.renewed_at = time.monotonic()
+        # Тело запроса уже ограничено по скорости при приёме (режим ASGI)
+        self.input_shaped = False
+        # Освобождение передано ответу (после отдачи тела)
+        self.handed_off = False
+        self.released = False
+
+    def due(self, size):
+        """
+        Добавляет переданные байты к накопленным.
+
+        :return: пора ли вызвать flush (продлить аренду или списать байты из вёдер)
+        """
+        self.pending += size
+        renew_due = time.monotonic() - self.renewed_at > self.lease_seconds / 3
+        return renew_due or bool(self.buckets and self.pending >= ACCOUNT_QUANTUM)
+
+    def account(self, size):
+        """
+        Учитывает переданные байты.
+
+        :return: сколько секунд подождать перед следующей порцией
+        """
+        return self.flush() if self.due(size) else 0.0
+
+    def flush(self):
+        """Списывает накопленные байты и продлевает аренду — одной транзакцией"""
+        amount, self.pending = self.pending, 0
+        now = time.time()
+        try:
+            with transaction() as connection:
+                delay = 0.0
+                if amount:
+                    for key, rate in self.buckets:
+                        delay = max(delay, take_tokens(connection, key, rate, amount, now))
+                if self.lease_id is not None:
+                    connection.execute(
+                        "UPDATE lease SET expires_at = ? WHERE id = ?",
+                        (now + self.lease_seconds, self.lease_id),
+                    )
+        except sqlite3.Error:
+            logger.warning("Не удалось учесть передачу %s", self.kind, exc_info=True)
+            return 0.0
+        self.renewed_at = time.monotonic()
+        return delay
+
+    def release(self):
+        """Освобождает место передачи (повторный вызов ничего не делает)"""
+        if self.released:
+            return
+        self.released = True
+        try:
+            with transaction() as connection:
+                # Остаток байт тоже списывается — ждать уже некому
+                if self.pending:
+                    now = time.time()
+                    for key, rate in self.buckets:
+                        take_tokens(connection, key, rate, self.pending, now)
+                if self.lease_id is not None:
+                    connection.execute("DELETE FROM lease WHERE id = ?", (self.lease_id,))
+        except sqlite3.Error:
+            # Аренда истечёт сама через TRANSFER_LEASE_SECONDS
+            logger.warning("Не удалось освободить передачу %s", self.kind, exc_info=True)
+
+
+def admit(environ, kind, user_id):
+    """
+    Занимает место для передачи и кладёт в окружение запроса передачу или отказ.
+
+    :return: допущена ли передача
+    """
+    try:
+        lease_id, exhausted = try_acquire(kind, user_id)
+    except sqlite3.Error:
+        logger.warning(
+            "Хранилище допуска передач недоступно, передача без ограничений", exc_info=True
+        )
+        return True
+    if lease_id is None:
+        TRANSFERS_REJECTED.inc(kind=kind, limit=exhausted)
+        logger.info(
+            "Передача отклонена (%s, предел %s): пользователь %s", kind, exhausted, user_id
+        )
+        environ[ENVIRON_REJECTED] = exhausted
+        return False
+    environ[ENVIRON_TRANSFER] = Transfer(kind, user_id, lease_id)
+    return True
+
+
+def pace(transfer, size, sleep):
+    """Учитывает переданные байты и ждёт, если передача опережает свою скорость"""
+    delay = transfer.account(size)
+    if delay:
+        TRANSFER_THROTTLED.inc(delay, kind=transfer.kind)
+        sleep(delay)
+
+
+class ShapedInput:
+    """
+    wsgi.input, чтение из которого идёт не быстрее ограничения передачи
+    и продлевает её аренду
+    """
+
+    def __init__(self, stream, transfer, sleep):
+        self.stream = stream
+        self.transfer = transfer
+        self.sleep = sleep
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        pace(self.transfer, len(data), self.sleep)
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        pace(self.transfer, len(data), self.sleep)
+        return data
+
+    def close(self):
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            close()
+
+
+class ShapedBody:
+    """
+    Тело ответа, которое отдаётся не быстрее ограничения передачи
+    и продлевает её аренду
+    """
+
+    def __init__(self, body, transfer, sleep):
+        self.body = body
+        self.transfer = transfer
+        self.sleep = sleep
+
+    def __iter__(self):
+        for chunk in self.body:
+            pace(self.transfer, len(chunk), self.sleep)
+            yield chunk
+
+    def close(self):
+        close = getattr(self.body, "close", None)
+        if close is not None:
+            close()
+
+
+def too_many_transfers_response():
+    message = "Слишком много одновременных передач, повторите позже"
+    if request.path.startswith("/api/") or (
+        request.accept_mimetypes.best == "application/json"
+    ):
+        rv = jsonify(error=message)
+    else:
+        rv = app.response_class(message, mimetype="text/plain")
+    rv.status_code = 429
+    rv.headers["Retry-After"] = str(app.config["TRANSFER_RETRY_AFTER"])
+    return rv
+
+
+@app.before_request
+def admit_transfer():
+    """Занимает место для загрузки или скачивания, при отказе — 429 без чтения тела"""
+    kind = TRANSFER_ENDPOINTS.get(request.endpoint)
+    if kind is None or not current_user.is_authenticated:
+        return None
+    environ = request.environ
+    # В режиме ASGI место занято (или получен отказ) ещё до приёма тела
+    if ENVIRON_TRANSFER not in environ and ENVIRON_REJECTED not in environ:
+        admit(environ, kind, current_user.id)
+    if ENVIRON_REJECTED in environ:
+        return too_many_transfers_response()
+
+    # Чтение тела продлевает аренду, даже если скорость не ограничена:
+    # иначе долгая загрузка теряет место через TRANSFER_LEASE_SECONDS
+    transfer = environ.get(ENVIRON_TRANSFER)
+    if transfer is not None and kind == "upload" and not transfer.input_shaped:
+        environ["wsgi.input"] = ShapedInput(
+            environ["wsgi.input"], transfer, environ.get(ENVIRON_SLEEP, time.sleep)
+        )
+    return None
+
+
+@app.after_request
+def release_transfer_when_sent(response):
+    """Место освобождается, когда сервер закончит отдачу ответа"""
+    transfer = request.environ.get(ENVIRON_TRANSFER)
+    if transfer is None:
+        return response
+    if transfer.kind == "download":
+        # Файл отдаётся блоками (вместо sendfile), чтобы по ходу отдачи
+        # продлевать аренду и выдерживать ограничение скорости
+        response.response = ShapedBody(
+            response.response, transfer, request.environ.get(ENVIRON_SLEEP, time.sleep)
+        )
+    call_when_sent(response, transfer.release)
+    transfer.handed_off = True
+    return response
+
+
+@app.teardown_request
+def release_unsent_transfer(exc):
+    """Ответ не дошёл до after_request (ошибка) — место освобождается сразу"""
+    transfer = request.environ.get(ENVIRON_TRANSFER)
+    if transfer is not None and not transfer.handed_off:
+        transfer.release()
+
+
+def count_active_transfers():
+    """Передачи, которые сейчас занимают место (по всем процессам)"""
+    rows = connect().execute(
+        "SELECT kind, count(*) FROM lease WHERE expires_at >= ? GROUP BY kind",
+        (time.time(),),
+    )
+    values = {(kind,): 0 for kind in ("upload", "download")}
+    values.update({(kind,): count for kind, count in rows})
+    return values
+
+
+REGISTRY.append(
+    CallbackGauge(
+        "nestcloud_transfers_active",
+        "Загрузки и скачивания, идущие сейчас на всех процессах сервера",
+        ("kind",),
+        count_active_transfers,
+    )
+)
@@ -0,0 +1,366 @@
+"""
+JSON API для клиентов синхронизации и веб-интерфейса (версия 1).
+
+Кроме списка и операций над файлами, API отдаёт журнал изменений:
+клиент запоминает курсор (seq последнего изменения) и запрашивает только
+изменения после него, вместо повторной загрузки всего списка.
+"""
+
+from functools import wraps
+import logging
+
+from flask import jsonify, request, url_for
+from flask_login import current_user, login_user, logout_user
+from sqlalchemy import func
+
+from nestcloud import app, db, listing, quota, folders
+from nestcloud.files import (
+    get_own_file,
+    find_duplicates,
+    create_uploaded_files,
+    prepare_new_filename,
+    trash_files,
+)
+from nestcloud.models import File, FileChange
+from nestcloud.security import authenticate
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/api/v1"
+MAX_PAGE_SIZE = 1000
+
+
+def api_login_required(view):
+    """Как login_required, но без редиректа на страницу входа — 401 в JSON"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify(error="Требуется вход"), 401
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def get_limit(default):
+    try:
+        return max(1, min(int(request.args.get("limit", default)), MAX_PAGE_SIZE))
+    except ValueError:
+        return default
+
+
+def file_to_dict(file_record):
+    return {
+        "id": file_record.id,
+        "filename": file_record.filename,
+        "size": file_record.size_bytes,
+        "size_human": file_record.file_size,
+        "version": file_record.version,
+        "folder_id": file_record.folder_id,
+        "content_status": file_record.content_status,
+        "upload_time": file_record.upload_time.isoformat(),
+        "preview_status": file_record.preview_status or "ready",
+        "preview_url": (
+            url_for("preview_file", file_id=file_record.id, v=file_record.version)
+            if file_record.preview_path
+            else None
+        ),
+        "download_url": url_for("download_file", file_id=file_record.id),
+    }
+
+
+def folder_to_dict(folder):
+    return {
+        "id": folder.id,
+        "name": folder.name,
+        "parent_id": folder.parent_id,
+        "created_at": folder.created_at.isoformat(),
+    }
+
+
+def get_change_cursor(user_id):
+    """Номер последнего изменения в журнале пользователя"""
+    return (
+        db.session.query(func.max(FileChange.seq))
+        .filter(FileChange.user_id == user_id)
+        .scalar()
+        or 0
+    )
+
+
+@app.route(f"{API_PREFIX}/login", methods=["POST"])
+def api_login():
+    data = request.get_json(silent=True) or {}
+    user = authenticate(data.get("login"), data.get("password"))
+    if not user:
+        return jsonify(error="Неверный логин или пароль"), 401
+    login_user(user, remember=bool(data.get("remember")))
+    return jsonify(id=user.id, login=user.login)
+
+
+@app.route(f"{API_PREFIX}/logout", methods=["POST"])
+@api_login_required
+def api_logout():
+    logout_user()
+    return "", 204
+
+
+@app.route(f"{API_PREFIX}/usage", methods=["GET"])
+@api_login_required
+def api_usage():
+    """Занятое место, число файлов и квота — из счётчиков пользователя"""
+    return jsonify(quota.get_usage(current_user))
+
+
+@app.route(f"{API_PREFIX}/files", methods=["GET"])
+@api_login_required
+def api_list_files():
+    """
+    Страница списка файлов (всех или одной папки: ?folder=<id> или root).
+    Курсор журнала изменений (change_cursor) берётся до чтения списка,
+    чтобы изменения во время листинга не потерялись.
+    """
+    folder_id = listing.ALL_FOLDERS
+    if "folder" in request.args:
+        folder = folders.get_target_folder(request.args["folder"])
+        folder_id = folder.id if folder else None
+    change_cursor = get_change_cursor(current_user.id)
+    user_files, next_cursor = listing.list_files_page(
+        current_user.id,
+        request.args.get("sort"),
+        request.args.get("cursor"),
+        limit=get_limit(listing.PAGE_SIZE),
+        search_text=request.args.get("q", "").strip(),
+        category=request.args.get("type"),
+        folder_id=folder_id,
+    )
+    return jsonify(
+        files=[file_to_dict(f) for f in user_files],
+        next_cursor=next_cursor,
+        change_cursor=change_cursor,
+    )
+
+
+@app.route(f"{API_PREFIX}/files", methods=["POST"])
+@api_login_required
+def api_upload_file():
+    """
+    Загрузка одного или нескольких файлов (поле "file" можно повторять).
+    Для нескольких файлов возвращается результат по каждому файлу.
+    """
+    files = [f for f in request.files.getlist("file") if f.filename]
+    if not files:
+        return jsonify(error="Пожалуйста, выберите файл"), 400
+    folder = folders.get_target_folder(request.form.get("folder_id"))
+
+    try:
+        results = create_uploaded_files(
+            files, current_user.id, folder.id if folder else None
+        )
+    except Exception:
+        logger.exception("Ошибка при загрузке файла через API")
+        return jsonify(error="Ошибка при загрузке файла"), 500
+
+    if len(files) == 1:
+        if "error" in results[0]:
+            return jsonify(error="Ошибка при загрузке файла"), 500
+        return jsonify(file_to_dict(results[0]["file"])), 201
+
+    return (
+        jsonify(
+            results=[
+                {"filename": r["filename"], "file": file_to_dict(r["file"])}
+                if "file" in r
+                else {"filename": r["filename"], "error": "Ошибка при загрузке файла"}
+                for r in results
+            ]
+        ),
+        207 if any("error" in r for r in results) else 201,
+    )
+
+
+@app.route(f"{API_PREFIX}/files/check-duplicates", methods=["POST"])
+@api_login_required
+def api_check_duplicates():
+    """
+    Проверка перед загрузкой: клиент присылает имя, размер и sample_hash
+    (и, если посчитан, sha256) каждого файла и получает уже загруженные копии.
+    """
+    data = request.get_json(silent=True) or {}
+    candidates = data.get("files")
+    if not isinstance(candidates, list) or not all(
+        isinstance(c, dict) for c in candidates
+    ):
+        return jsonify(error="Ожидается список files"), 400
+    if len(candidates) > app.config["BULK_MAX_FILES"]:
+        return jsonify(error="Слишком много файлов в одном запросе"), 400
+
+    duplicates = find_duplicates(current_user.id, candidates)
+    return jsonify(
+        results=[
+            {
+                "name": c.get("name"),
+                "duplicate_of": file_to_dict(duplicate) if duplicate else None,
+            }
+            for c, duplicate in zip(candidates, duplicates)
+        ]
+    )
+
+
+@app.route(f"{API_PREFIX}/files/<int:file_id>", methods=["GET"])
+@api_login_required
+def api_stat_file(file_id):
+    return jsonify(file_to_dict(get_own_file(file_id)))
+
+
+@app.route(f"{API_PREFIX}/files/<int:file_id>", methods=["PATCH"])
+@api_login_required
+def api_rename_file(file_id):
+    """Переименование ({"filename"}) и/или перенос в папку ({"folder_id"}, null — корень)"""
+    file_record = get_own_file(file_id)
+    data = request.get_json(silent=True) or {}
+    if "filename" in data or "folder_id" not in data:
+        new_filename, error = prepare_new_filename(file_record, data.get("filename"))
+        if error:
+            return jsonify(error=error), 400
+        file_record.filename = new_filename
+    if "folder_id" in data:
+        folders.move_files([file_record], folders.get_target_folder(data["folder_id"]))
+    db.session.commit()
+    return jsonify(file_to_dict(file_record))
+
+
+@app.route(f"{API_PREFIX}/files/<int:file_id>", methods=["DELETE"])
+@api_login_required
+def api_delete_file(file_id):
+    """Переносит файл в корзину (вернуть — POST /api/v1/trash/<id>/restore)"""
+    file_record = get_own_file(file_id)
+    try:
+        trash_files(current_user.id, File.id == file_record.id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception("Ошибка при удалении файла %s через API", file_id)
+        return jsonify(error="Ошибка при удалении файла"), 500
+    return "", 204
+
+
+@app.route(f"{API_PREFIX}/folders", methods=["GET"])
+@api_login_required
+def api_list_folders():
+    """Вложенные папки одного уровня: ?parent=<id> (без параметра — корень)"""
+    parent = folders.get_target_folder(request.args.get("parent"))
+    subfolders = folders.list_subfolders(current_user.id, parent.id if parent else None)
+    return jsonify(folders=[folder_to_dict(f) for f in subfolders])
+
+
+@app.route(f"{API_PREFIX}/folders", methods=["POST"])
+@api_login_required
+def api_create_folder():
+    data = request.get_json(silent=True) or {}
+    parent = folders.get_target_folder(data.get("parent_id"))
+    folder, error = folders.create_folder(current_user.id, data.get("name"), parent)
+    if error:
+        return jsonify(error=error), 400
+    db.session.commit()
+    return jsonify(folder_to_dict(folder)), 201
+
+
+@app.route(f"{API_PREFIX}/folders/<int:folder_id>", methods=["GET"])
+@api_login_required
+def api_stat_folder(folder_id):
+    """Сведения о папке: путь от корня и итоги по всему поддереву"""
+    folder = folders.get_own_folder(folder_id)
+    data = folder_to_dict(folder)
+    data["path"] = [f.name for f in folders.get_breadcrumbs(folder)]
+    data.update(folders.get_folder_stats(folder))
+    return jsonify(data)
+
+
+@app.route(f"{API_PREFIX}/folders/<int:folder_id>", methods=["PATCH"])
+@api_login_required
+def api_update_folder(folder_id):
+    """Переименование ({"name"}) и/или перенос ({"parent_id"}, null — в корень)"""
+    folder = folders.get_own_folder(folder_id)
+    data = request.get_json(silent=True) or {}
+    error = None
+    if "name" in data:
+        error = folders.rename_folder(folder, data["name"])
+    if not error and "parent_id" in data:
+        error = folders.move_folder(folder, folders.get_target_folder(data["parent_id"]))
+    if error:
+        db.session.rollback()
+        return jsonify(error=error), 400
+    db.session.commit()
+    return jsonify(folder_to_dict(folder))
+
+
+@app.route(f"{API_PREFIX}/folders/<int:folder_id>", methods=["DELETE"])
+@api_login_required
+def api_delete_folder(folder_id):
+    """Удаляет папку со всеми вложенными папками, файлы переносит в корзину"""
+    folder = folders.get_own_folder(folder_id)
+    try:
+        folders.delete_folder(folder)
+    except Exception:
+        db.session.rollback()
+        logger.exception("Ошибка при удалении папки %s через API", folder_id)
+        return jsonify(error="Ошибка при удалении папки"), 500
+    return "", 204
+
+
+@app.route(f"{API_PREFIX}/changes", methods=["GET"])
+@api_login_required
+def api_changes():
+    """
+    Изменения после курсора ?since=N (по возрастанию seq).
+    Для созданных и изменённых файлов прикладывается их текущее состояние.
+    """
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify(error="Неверный курсор"), 400
+    limit = get_limit(500)
+
+    changes = (
+        FileChange.query.filter(
+            FileChange.user_id == current_user.id, FileChange.seq > since
+        )
+        .order_by(FileChange.seq)
+        .limit(limit + 1)
+        .all()
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    # Текущее состояние затронутых файлов — одним запросом
+    file_ids = {change.file_id for change in changes if change.op != "deleted"}
+    files = {}
+    if file_ids:
+        files = {
+            f.id: f
+            for f in File.query.filter(
+                File.user_id == current_user.id,
+                File.id.in_(file_ids),
+                File.deleted_at.is_(None),
+            )
+        }
+
+    return jsonify(
+        changes=[
+            {
+                "seq": change.seq,
+                "op": change.op,
+                "file_id": change.file_id,
+                "changed_at": change.changed_at.isoformat(),
+                "file": (
+                    file_to_dict(files[change.file_id])
+                    if change.file_id in files
+                    else None
+                ),
+            }
+            for change in changes
+        ],
+        cursor=changes[-1].seq if changes else since,
+        has_more=has_more,
+    )
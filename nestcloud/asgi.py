@@ -0,0 +1,342 @@
+"""
+Асинхронный режим работы (ASGI) для медленных клиентов.
+
+    uvicorn asgi:application --workers 4
+
+В обычном WSGI-режиме поток сервера занят запросом всё время, пока клиент
+передаёт тело или забирает ответ: несколько телефонов, медленно загружающих
+по 512 МБ, занимают все потоки. Здесь сетевой обмен ведёт цикл asyncio,
+а потоки пула заняты только там, где есть работа:
+
+- тело запроса принимается асинхронно блоками и складывается во временный
+  файл (в памяти — не больше ASGI_SPOOL_MEMORY), до приёма тела проверяются
+  вход, MAX_CONTENT_LENGTH, квота и предел одновременных загрузок, а
+  ограничение скорости загрузки выдерживается ожиданием в цикле asyncio;
+- обработчик Flask (разбор формы, хеширование, превью, запросы к БД)
+  вызывается в пуле из ASGI_WORKER_THREADS потоков, когда тело уже на диске;
+- ответ отдаётся блоками по ASGI_READ_SIZE: каждый блок читается в пуле,
+  а следующий не читается, пока сервер не отправит предыдущий клиенту,
+  и после отключения клиента (http.disconnect) чтение прекращается;
+  паузы ограничения скорости скачивания тоже ждёт цикл, а не поток.
+
+Используются те же обработчики, модели и хранилище, что и в WSGI-режиме.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import io
+import logging
+import sys
+import tempfile
+import time
+
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+
+from nestcloud import admission, create_app, quota
+from nestcloud.metrics import STAGE_DURATION, TRANSFER_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# Загрузки, которые проверяются до приёма тела: без входа, сверх квоты,
+# MAX_CONTENT_LENGTH или предела одновременных загрузок тело не принимается,
+# а сразу возвращается ответ
+UPLOAD_ENDPOINTS = quota.QUOTA_CHECKED_ENDPOINTS | {"upload_chunk"}
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper: send_file отдаёт файл блоками ASGI_READ_SIZE
+    вместо 8 КБ, чтобы на каждый блок приходилось меньше переходов в пул.
+    """
+
+    def __init__(self, filelike, buffer_size=8192, read_size=256 * 1024):
+        self.filelike = filelike
+        self.buffer_size = max(buffer_size, read_size)
+        # close — атрибут экземпляра: metrics.observe_until_close его подменяет
+        self.close = getattr(filelike, "close", lambda: None)
+
+    # Ответ на Range переходит к началу диапазона, не читая файл до него
+    def seekable(self):
+        return hasattr(self.filelike, "seekable") and self.filelike.seekable()
+
+    def seek(self, *args):
+        self.filelike.seek(*args)
+
+    def tell(self):
+        return self.filelike.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.buffer_size)
+        if data:
+            return data
+        raise StopIteration()
+
+
+class StreamingWSGIAdapter:
+    """ASGI-приложение поверх WSGI-приложения Flask с асинхронным вводом-выводом"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.spool_memory = flask_app.config["ASGI_SPOOL_MEMORY"]
+        self.read_size = flask_app.config["ASGI_READ_SIZE"]
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config["ASGI_WORKER_THREADS"],
+            thread_name_prefix="asgi-worker",
+        )
+
+    async def run_sync(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        else:
+            raise RuntimeError(f"Неподдерживаемый тип ASGI: {scope['type']}")
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def build_environ(self, scope):
+        """Окружение WSGI по запросу ASGI (PEP 3333), без тела"""
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": partial(FileWrapper, read_size=self.read_size),
+        }
+        for raw_name, raw_value in scope["headers"]:
+            name = raw_name.decode("latin-1").upper().replace("-", "_")
+            value = raw_value.decode("latin-1")
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = name
+            else:
+                key = f"HTTP_{name}"
+            if key in environ:
+                # Повторные заголовки склеиваются через запятую, а Cookie
+                # (HTTP/2 присылает каждую отдельно) — через "; " (RFC 9113, 8.2.3)
+                separator = "; " if key == "HTTP_COOKIE" else ","
+                value = f"{environ[key]}{separator}{value}"
+            environ[key] = value
+        return environ
+
+    def get_endpoint(self, environ):
+        adapter = self.flask_app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, _ = adapter.match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    def should_reject_upload(self, environ, endpoint, content_length):
+        """
+        Ответит ли Flask на загрузку отказом, не читая тела (вход, размер, квота,
+        одновременные загрузки). Место для допущенной загрузки занимается здесь же:
+        передача кладётся в environ, и before_request Flask её подхватит.
+        """
+        with self.flask_app.request_context(dict(environ)):
+            if not current_user.is_authenticated:
+                return True
+            # Размер чанка ограничен сессией загрузки, квота проверена при её создании
+            if endpoint in quota.QUOTA_CHECKED_ENDPOINTS and content_length is not None:
+                max_length = self.flask_app.config["MAX_CONTENT_LENGTH"]
+                if max_length is not None and content_length > max_length:
+                    return True
+                if not quota.fits_quota(current_user, content_length):
+                    return True
+            return not admission.admit(environ, "upload", current_user.id)
+
+    async def receive_body(self, environ, receive, max_length):
+        """
+        Принимает тело запроса во временный файл.
+
+        :return: "ok", "disconnected" (клиент отключился) или "too_large"
+        """
+        spool = tempfile.SpooledTemporaryFile(self.spool_memory)
+        environ["wsgi.input"] = spool
+        received = 0
+        started = time.perf_counter()
+        transfer = environ.get(admission.ENVIRON_TRANSFER)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                spool.close()
+                return "disconnected"
+            chunk = message.get("body", b"")
+            if chunk:
+                received += len(chunk)
+                if max_length is not None and received > max_length:
+                    spool.close()
+                    return "too_large"
+                if received <= self.spool_memory:
+                    spool.write(chunk)
+                else:
+                    # Тело уже на диске — запись может блокировать
+                    await self.run_sync(spool.write, chunk)
+                # Приём тела продлевает аренду и выдерживает ограничение
+                # скорости: клиент ждёт, поток не занят
+                if transfer is not None and transfer.due(len(chunk)):
+                    delay = await self.run_sync(transfer.flush)
+                    if delay:
+                        TRANSFER_THROTTLED.inc(delay, kind="upload")
+                        await asyncio.sleep(delay)
+            if not message.get("more_body", False):
+                break
+        STAGE_DURATION.observe(time.perf_counter() - started, stage="receive_body_async")
+        if transfer is not None:
+            transfer.input_shaped = True
+        spool.seek(0)
+        environ["CONTENT_LENGTH"] = str(received)
+        environ.pop("HTTP_TRANSFER_ENCODING", None)
+        return "ok"
+
+    def call_wsgi(self, environ):
+        response = {}
+
+        # Заголовки уходят клиенту только после возврата из обработчика,
+        # поэтому повторный вызов с exc_info просто заменяет ответ
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+            return lambda data: response.setdefault("written", []).append(data)
+
+        iterable = self.flask_app.wsgi_app(environ, start_response)
+        return response, iterable
+
+    async def watch_disconnect(self, receive, disconnected):
+        """Ждёт отключения клиента, пока отдаётся ответ (непрочитанное тело пропускается)"""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+
+    async def send_response(self, response, iterable, send, delays, receive):
+        """
+        Отдаёт тело ответа: блок читается в пуле, отправка ждёт клиента,
+        паузы ограничения скорости (delays) выдерживаются в цикле asyncio.
+        Если клиент отключился, файл дальше не читается.
+        """
+        iterator = iter(iterable)
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, disconnected))
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": response["status"],
+                    "headers": response["headers"],
+                }
+            )
+            for data in response.get("written", []):
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+            while not disconnected.is_set():
+                chunk = await self.run_sync(next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                if delays:
+                    delay = sum(delays)
+                    delays.clear()
+                    # Пауза прерывается отключением клиента
+                    try:
+                        await asyncio.wait_for(disconnected.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            if disconnected.is_set():
+                logger.debug("Клиент отключился во время отдачи ответа")
+            else:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            watcher.cancel()
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                await self.run_sync(close)
+
+    async def send_simple(self, send, status, message):
+        body = message.encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode("ascii")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def handle_http(self, scope, receive, send):
+        environ = self.build_environ(scope)
+        content_length = environ.get("CONTENT_LENGTH")
+        content_length = int(content_length) if content_length else None
+        has_body = bool(content_length) or "HTTP_TRANSFER_ENCODING" in environ
+        # Ожидания ограничения скорости из потоков пула ждёт цикл asyncio
+        delays = []
+        environ[admission.ENVIRON_SLEEP] = delays.append
+
+        try:
+            if has_body:
+                endpoint = self.get_endpoint(environ)
+                # При отказе тело не принимается: Flask ответит, не читая его
+                rejected = endpoint in UPLOAD_ENDPOINTS and await self.run_sync(
+                    self.should_reject_upload, environ, endpoint, content_length
+                )
+                if not rejected:
+                    max_length = self.flask_app.config["MAX_CONTENT_LENGTH"]
+                    status = await self.receive_body(environ, receive, max_length)
+                    transfer = environ.get(admission.ENVIRON_TRANSFER)
+                    if status != "ok" and transfer is not None:
+                        await self.run_sync(transfer.release)
+                    if status == "disconnected":
+                        logger.debug("Клиент отключился во время передачи тела: %s", scope["path"])
+                        return
+                    if status == "too_large":
+                        await self.send_simple(send, 413, "Request Entity Too Large")
+                        return
+
+            response, iterable = await self.run_sync(self.call_wsgi, environ)
+            await self.send_response(response, iterable, send, delays, receive)
+        finally:
+            environ["wsgi.input"].close()
+
+
+def create_asgi_app(config=None):
+    return StreamingWSGIAdapter(create_app(config))
+
@@ -0,0 +1,103 @@
+"""
+Разбиение содержимого на блоки по содержимому (content-defined chunking)
+для загрузки новых версий файлов: после правки в середине файла меняются
+только блоки рядом с правкой, остальные границы остаются на тех же байтах.
+
+Алгоритм (клиент должен повторить его в точности, модуль использует только
+стандартную библиотеку и может служить эталоном):
+
+1. Для каждого байта b[i] считается хеш окна из WINDOW последних байт:
+   h0[i] = T0[b[i]], затем для r = 1..ROUNDS (шаг s = 2^(r-1))
+   hr[i] = Tr[h(r-1)[i]] XOR h(r-1)[i - s] (за началом файла — 0).
+   Таблица Tr[x] — первый байт SHA-256 от строки f"{r}:{x}".
+2. Блок заканчивается после пары байт хеша, равной BOUNDARY
+   (hR[i-1], hR[i]), если длина блока от MIN_SIZE; поиск начинается
+   с MIN_SIZE байт от начала блока. Не найдено до MAX_SIZE — блок режется
+   на MAX_SIZE. Последний блок может быть короче MIN_SIZE.
+3. Манифест — список [SHA-256 блока, размер] в порядке блоков.
+"""
+
+import hashlib
+
+MIN_SIZE = 64 * 1024
+MAX_SIZE = 1024 * 1024
+ROUNDS = 4
+WINDOW = 2**ROUNDS
+BOUNDARY = b"NC"
+# Сколько читать из источника за раз
+READ_SIZE = 4 * 1024 * 1024
+
+TABLES = [
+    bytes(hashlib.sha256(f"{r}:{x}".encode("ascii")).digest()[0] for x in range(256))
+    for r in range(ROUNDS + 1)
+]
+
+
+def get_parameters() -> dict:
+    """Параметры разбиения — клиент сверяет их со своей реализацией"""
+    return {
+        "algorithm": "nestcloud-cdc-1",
+        "min_size": MIN_SIZE,
+        "max_size": MAX_SIZE,
+        "window": WINDOW,
+        "boundary": BOUNDARY.hex(),
+    }
+
+
+def window_hashes(data: bytes) -> bytes:
+    """
+    Хеши окон для каждого байта data (шаг 1 выше). Каждый раунд —
+    таблица через bytes.translate и сдвиг с XOR над целым числом:
+    весь блок обрабатывается без цикла по байтам в Python.
+    """
+    n = len(data)
+    mask = (1 << (8 * n)) - 1
+    h = data.translate(TABLES[0])
+    value = int.from_bytes(h, "little")
+    step = 1
+    for r in range(1, ROUNDS + 1):
+        value = (
+            int.from_bytes(h.translate(TABLES[r]), "little") ^ (value << (8 * step))
+        ) & mask
+        h = value.to_bytes(n, "little")
+        step *= 2
+    return h
+
+
+def iter_chunks(source):
+    """Блоки содержимого файлового объекта source (bytes)"""
+    data = bytearray()
+    hashes = bytearray()
+    # Последние WINDOW - 1 байт предыдущего чтения: окна на стыке чтений
+    carry = b""
+    start = 0
+    eof = False
+    while True:
+        while not eof and len(data) - start < MAX_SIZE:
+            block = source.read(READ_SIZE)
+            if not block:
+                eof = True
+                break
+            extended = carry + block
+            hashes += window_hashes(extended)[len(carry) :]
+            carry = extended[-(WINDOW - 1) :]
+            data += block
+        if start == len(data):
+            return
+
+        limit = min(len(data), start + MAX_SIZE)
+        found = hashes.find(BOUNDARY, start + MIN_SIZE - len(BOUNDARY), limit)
+        end = found + len(BOUNDARY) if found != -1 else limit
+        yield bytes(data[start:end])
+        start = end
+        if start >= READ_SIZE:
+            del data[:start]
+            del hashes[:start]
+            start = 0
+
+
+def build_manifest(source) -> list:
+    """Манифест содержимого: [[SHA-256 блока, размер], ...]"""
+    return [
+        [hashlib.sha256(chunk).hexdigest(), len(chunk)] for chunk in iter_chunks(source)
+    ]
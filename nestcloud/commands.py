@@ -0,0 +1,447 @@
+"""
+Команды обслуживания (запуск: flask --app app <команда>).
+"""
+
+import os
+import posixpath
+import shutil
+import time
+
+import click
+from sqlalchemy import func, inspect, text, update
+
+from nestcloud import app, db, search, storage
+from nestcloud.models import File, FileVersion, User
+from utils import get_file_category
+
+
+def add_missing_columns():
+    """Добавляет в существующие таблицы столбцы, появившиеся в моделях"""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            db.session.execute(text(ddl))
+            click.echo(f"Добавлен столбец {table.name}.{column.name}")
+    db.session.commit()
+
+
+# Индексы прежних версий схемы, заменённые другими
+OBSOLETE_INDEXES = [
+    # Заменены частичными индексами ix_file_live_* (без файлов в корзине)
+    "ix_file_user_upload_time",
+    "ix_file_user_filename",
+    "ix_file_user_size_bytes",
+    "ix_file_user_category",
+    "ix_file_user_folder_upload_time",
+    "ix_file_user_folder_filename",
+    "ix_file_user_folder_size_bytes",
+]
+
+
+def drop_obsolete_indexes():
+    for name in OBSOLETE_INDEXES:
+        db.session.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+    db.session.commit()
+
+
+def create_missing_indexes():
+    """Создаёт индексы моделей, которых ещё нет в базе"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """Создаёт недостающие таблицы, столбцы и индексы"""
+    db.create_all()
+    add_missing_columns()
+    drop_obsolete_indexes()
+    create_missing_indexes()
+    with db.engine.begin() as connection:
+        search.create_search_index(connection)
+        search.fill_search_index(connection)
+    click.echo("Схема базы данных обновлена")
+
+
+@app.cli.command("migrate-to-cas")
+@click.option("--batch-size", default=100, show_default=True)
+def migrate_to_cas(batch_size):
+    """
+    Переносит файлы из папок пользователей в хранилище блобов.
+
+    Блоб создаётся жёсткой ссылкой (или копией), запись File коммитится,
+    и только после этого удаляется исходный файл — прерванную миграцию
+    можно просто запустить снова.
+    """
+    migrated = deduplicated = missing = 0
+    last_id = 0
+    while True:
+        batch = (
+            File.query.filter(File.blob_hash.is_(None), File.id > last_id)
+            .order_by(File.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        to_remove = []
+        for file_record in batch:
+            last_id = file_record.id
+            source_path = storage.get_file_path(file_record)
+            if not os.path.exists(source_path):
+                click.echo(f"Файл не найден, пропускаем: {source_path}")
+                missing += 1
+                continue
+
+            # Блобы хранятся несжатыми: сжатый файл распаковывается во временный
+            temp_path = None
+            if file_record.encoding:
+                temp_path = storage.make_temp_path()
+                with storage.open_content(source_path, file_record.encoding) as source:
+                    blob_hash = storage.copy_and_hash(source, temp_path)
+            else:
+                blob_hash = storage.hash_file(source_path)
+            blob_path = storage.get_blob_path(blob_hash)
+            is_new = storage.add_blob_reference(
+                blob_hash, os.path.getsize(temp_path or source_path)
+            )
+            if is_new or not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                if temp_path is None:
+                    temp_path = storage.make_temp_path()
+                    try:
+                        os.link(source_path, temp_path)
+                    except OSError:
+                        shutil.copyfile(source_path, temp_path)
+                os.replace(temp_path, blob_path)
+            else:
+                if temp_path is not None:
+                    os.remove(temp_path)
+                deduplicated += 1
+
+            file_record.blob_hash = blob_hash
+            file_record.content_hash = blob_hash
+            file_record.encoding = None
+            file_record.stored_size = file_record.size_bytes
+            to_remove.append(source_path)
+            migrated += 1
+
+        db.session.commit()
+        for source_path in to_remove:
+            os.remove(source_path)
+        click.echo(f"Перенесено файлов: {migrated} (дубликатов: {deduplicated})")
+
+    click.echo(
+        f"Миграция завершена: перенесено {migrated}, "
+        f"дубликатов {deduplicated}, не найдено {missing}"
+    )
+
+
+@app.cli.command("backfill-sizes")
+@click.option("--batch-size", default=500, show_default=True)
+def backfill_sizes(batch_size):
+    """Заполняет size_bytes по файлам на диске для записей, где он не задан"""
+    updated = missing = 0
+    last_id = 0
+    while True:
+        batch = (
+            File.query.filter(File.size_bytes.is_(None), File.id > last_id)
+            .order_by(File.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        for file_record in batch:
+            last_id = file_record.id
+            try:
+                file_record.size_bytes = os.path.getsize(
+                    storage.get_file_path(file_record)
+                )
+                updated += 1
+            except OSError:
+                click.echo(f"Файл не найден: {storage.get_file_path(file_record)}")
+                missing += 1
+        db.session.commit()
+    click.echo(f"Размер заполнен для {updated} файлов, не найдено {missing}")
+
+
+@app.cli.command("backfill-hashes")
+@click.option("--batch-size", default=200, show_default=True)
+def backfill_hashes(batch_size):
+    """Заполняет индекс дубликатов (sample_hash, content_hash) для старых файлов"""
+    updated = missing = 0
+    last_id = 0
+    while True:
+        batch = (
+            File.query.filter(
+                (File.sample_hash.is_(None)) | (File.content_hash.is_(None)),
+                File.id > last_id,
+            )
+            .order_by(File.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        for file_record in batch:
+            last_id = file_record.id
+            path = storage.get_file_path(file_record)
+            try:
+                file_record.sample_hash = storage.sample_hash_file(path)
+                file_record.content_hash = file_record.blob_hash or storage.hash_file(
+                    path
+                )
+                if file_record.size_bytes is None:
+                    file_record.size_bytes = os.path.getsize(path)
+                updated += 1
+            except OSError:
+                click.echo(f"Файл не найден: {path}")
+                missing += 1
+        db.session.commit()
+    click.echo(f"Хеши заполнены для {updated} файлов, не найдено {missing}")
+
+
+def link_into_place(source_path, target_path):
+    """
+    Делает файл доступным по новому пути, не убирая старый: жёсткая ссылка
+    (или копия через временный файл). Повторный вызов после сбоя безопасен.
+
+    :return: False, если файла нет ни по старому, ни по новому пути
+    """
+    if os.path.exists(target_path):
+        return True
+    if not os.path.exists(source_path):
+        return False
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        temp_path = target_path + ".tmp"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    return True
+
+
+@app.cli.command("migrate-layout")
+@click.option("--batch-size", default=200, show_default=True)
+@click.option(
+    "--rate",
+    default=100.0,
+    show_default=True,
+    help="Не больше стольких файлов в секунду (0 — без ограничения)",
+)
+def migrate_layout(batch_size, rate):
+    """
+    Раскладывает файлы и превью по подкаталогам согласно STORAGE_FANOUT.
+
+    Работает без остановки сервиса: файл сначала становится доступен по новому
+    пути (жёсткая ссылка), затем коммитится новый путь в БД, и только потом
+    удаляется старый. Прерванную миграцию можно запустить снова.
+    """
+    moved = previews_moved = missing = 0
+    last_id = 0
+    while True:
+        started = time.monotonic()
+        batch = (
+            File.query.filter(File.id > last_id)
+            .order_by(File.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        to_remove = []
+        for file_record in batch:
+            last_id = file_record.id
+
+            # Содержимое (в режиме cas оно лежит в хранилище блобов — не переносим)
+            if not file_record.blob_hash:
+                stored = file_record.stored_filename
+                target = storage.make_file_relpath(posixpath.basename(stored))
+                if target != stored:
+                    old_path = storage.resolve_user_path(file_record.user_id, stored)
+                    new_path = storage.resolve_user_path(file_record.user_id, target)
+                    if link_into_place(old_path, new_path):
+                        # Запрос UPDATE без событий модели: для клиентов файл не менялся
+                        db.session.execute(
+                            update(File)
+                            .where(File.id == file_record.id)
+                            .values(stored_filename=target)
+                        )
+                        to_remove.append(old_path)
+                        moved += 1
+                    else:
+                        click.echo(f"Файл не найден, пропускаем: {old_path}")
+                        missing += 1
+
+            # Превью: одно превью может быть общим для нескольких записей
+            preview = file_record.preview_path
+            if preview and preview.startswith("previews/"):
+                target = storage.make_preview_relpath(posixpath.basename(preview))
+                if target != preview:
+                    old_path = storage.resolve_user_path(file_record.user_id, preview)
+                    new_path = storage.resolve_user_path(file_record.user_id, target)
+                    if link_into_place(old_path, new_path):
+                        db.session.execute(
+                            update(File)
+                            .where(
+                                File.user_id == file_record.user_id,
+                                File.preview_path == preview,
+                            )
+                            .values(preview_path=target)
+                        )
+                        to_remove.append(old_path)
+                        previews_moved += 1
+
+        db.session.commit()
+        # Выгружаем пачку из сессии: пути в ней уже изменены запросами UPDATE
+        db.session.expire_all()
+        for old_path in to_remove:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        click.echo(f"Перенесено файлов: {moved}, превью: {previews_moved}")
+
+        # Ограничение скорости, чтобы не мешать работающему сервису
+        if rate > 0:
+            time.sleep(max(0.0, len(batch) / rate - (time.monotonic() - started)))
+
+    click.echo(
+        f"Миграция завершена: перенесено файлов {moved}, превью {previews_moved}, "
+        f"не найдено {missing}"
+    )
+
+
+@app.cli.command("reconcile-usage")
+@click.option(
+    "--check-disk/--no-check-disk",
+    default=True,
+    show_default=True,
+    help="Сверять size_bytes с размерами файлов на диске",
+)
+def reconcile_usage(check_disk):
+    """
+    Пересчитывает User.used_bytes и file_count по записям File и FileVersion
+    (файлы в корзине и прежние версии учитываются только в used_bytes),
+    предварительно исправляя size_bytes файлов, разошедшиеся с файлами на диске.
+    """
+    fixed_sizes = fixed_users = 0
+    for user in User.query.order_by(User.id).all():
+        if check_disk:
+            rows = db.session.execute(
+                db.select(
+                    File.id,
+                    File.user_id,
+                    File.stored_filename,
+                    File.blob_hash,
+                    File.size_bytes,
+                    File.encoding,
+                    File.stored_size,
+                ).where(File.user_id == user.id)
+            ).all()
+            for row in rows:
+                try:
+                    actual = os.path.getsize(storage.get_file_path(row))
+                except OSError:
+                    click.echo(f"Файл не найден: {storage.get_file_path(row)}")
+                    continue
+                if row.encoding:
+                    # У сжатого файла с диском сверяется только stored_size
+                    if actual != row.stored_size:
+                        db.session.execute(
+                            update(File)
+                            .where(File.id == row.id)
+                            .values(stored_size=actual)
+                        )
+                        fixed_sizes += 1
+                    continue
+                if actual != row.size_bytes:
+                    # UPDATE без событий модели: счётчики ниже пересчитываются целиком
+                    db.session.execute(
+                        update(File)
+                        .where(File.id == row.id)
+                        .values(size_bytes=actual, stored_size=actual)
+                    )
+                    fixed_sizes += 1
+
+        # Файлы в корзине и прежние версии занимают место, но в число файлов не входят
+        used_bytes_query = db.select(
+            db.select(func.coalesce(func.sum(File.size_bytes), 0))
+            .where(File.user_id == user.id)
+            .scalar_subquery()
+            + db.select(func.coalesce(func.sum(FileVersion.size_bytes), 0))
+            .where(FileVersion.user_id == user.id)
+            .scalar_subquery()
+        )
+        file_count_query = db.select(func.count(File.id)).where(
+            File.user_id == user.id, File.deleted_at.is_(None)
+        )
+        used_bytes = db.session.execute(used_bytes_query).scalar()
+        file_count = db.session.execute(file_count_query).scalar()
+        if (user.used_bytes, user.file_count) != (used_bytes, file_count):
+            click.echo(
+                f"Пользователь {user.id}: {user.used_bytes} Б / {user.file_count} файлов "
+                f"→ {used_bytes} Б / {file_count} файлов"
+            )
+            # Пересчёт одним UPDATE с подзапросами — не теряет параллельные загрузки
+            db.session.execute(
+                update(User)
+                .where(User.id == user.id)
+                .values(
+                    used_bytes=used_bytes_query.scalar_subquery(),
+                    file_count=file_count_query.scalar_subquery(),
+                )
+            )
+            fixed_users += 1
+        db.session.commit()
+
+    click.echo(
+        f"Сверка завершена: исправлено размеров {fixed_sizes}, "
+        f"счётчиков пользователей {fixed_users}"
+    )
+
+
+@app.cli.command("reindex-search")
+@click.option("--batch-size", default=1000, show_default=True)
+def reindex_search(batch_size):
+    """Заполняет категории файлов и заново строит поисковый индекс имён"""
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(File.id, File.filename)
+            .where(File.category.is_(None), File.id > last_id)
+            .order_by(File.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            last_id = row.id
+            # UPDATE без событий модели: для клиентов файл не менялся
+            db.session.execute(
+                update(File)
+                .where(File.id == row.id)
+                .values(category=get_file_category(row.filename))
+            )
+        updated += len(rows)
+        db.session.commit()
+
+    with db.engine.begin() as connection:
+        search.create_search_index(connection)
+        search.fill_search_index(connection, rebuild=True)
+    click.echo(f"Категории заполнены для {updated} файлов, поисковый индекс перестроен")
@@ -0,0 +1,270 @@
+"""
+Производные превью изображений нескольких размеров и форматов (JPEG / WebP / AVIF).
+
+Производное строится при первом запросе и хранится в дисковом кеше
+(UPLOAD_FOLDER/.derivatives) с ограничением общего размера и вытеснением
+давно не использованных (LRU по времени изменения файла). Ключ кеша — содержимое
+файла, ширина и формат, поэтому одинаковые файлы разных пользователей
+используют одни и те же производные.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+
+from flask import abort, request
+from flask_login import login_required
+
+from nestcloud import app, storage
+from nestcloud.files import get_own_file, get_preview_max_age
+from nestcloud.metrics import PREVIEW_FAILURES
+from nestcloud.transfer import send_stored_file
+from utils import is_image_file
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+# Форматы в порядке предпочтения при выборе по заголовку Accept
+FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+SAVE_OPTIONS = {
+    "AVIF": {"quality": 60},
+    "WEBP": {"quality": 80, "method": 4},
+    "JPEG": {"quality": 85, "progressive": True, "optimize": True},
+}
+# Число полос блокировок: разные ключи редко ждут друг друга, а файлов-блокировок
+# не становится больше, чем полос
+LOCK_STRIPES = 64
+# Время последнего использования обновляется не чаще, чем раз в этот интервал
+TOUCH_INTERVAL = 3600
+
+
+def is_format_supported(fmt: str) -> bool:
+    from PIL import features
+
+    if fmt == "jpeg":
+        return True
+    return bool(features.check(fmt))
+
+
+def negotiate_format(requested):
+    """Формат из ?format= или лучший из поддерживаемых браузером (Accept)"""
+    if requested:
+        if requested not in FORMATS or not is_format_supported(requested):
+            abort(404)
+        return requested
+    accept = request.accept_mimetypes
+    for fmt, (_, mimetype) in FORMATS.items():
+        if fmt != "jpeg" and accept[mimetype] and is_format_supported(fmt):
+            return fmt
+    return "jpeg"
+
+
+def round_width(width: int) -> int:
+    """Ширина округляется вверх до разрешённой, чтобы кеш не разрастался"""
+    for allowed in app.config["DERIVATIVE_WIDTHS"]:
+        if width <= allowed:
+            return allowed
+    return app.config["DERIVATIVE_WIDTHS"][-1]
+
+
+def render_derivative(source_path, dest_path, width, fmt):
+    """Уменьшает изображение до ширины/высоты width и сохраняет в формате fmt"""
+    from PIL import Image, ImageOps
+
+    pil_format = FORMATS[fmt][0]
+    with Image.open(source_path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (width * 2, width * 2))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((width, width), Image.Resampling.LANCZOS)
+        has_alpha = img.mode in ("RGBA", "LA") or "transparency" in img.info
+        img = img.convert("RGBA" if has_alpha and pil_format != "JPEG" else "RGB")
+        img.save(dest_path, format=pil_format, **SAVE_OPTIONS[pil_format])
+
+
+class DerivativeCache:
+    """Дисковый кеш с ограничением размера и вытеснением по LRU"""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._size_guard = threading.Lock()
+        # Размер кеша известен процессу приблизительно (в кеш пишут и другие
+        # процессы), поэтому перед вытеснением он пересчитывается по диску
+        self._estimated_size = None
+
+    def path_for(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    @staticmethod
+    def _stripe(key):
+        return zlib.crc32(key.encode("utf-8")) % LOCK_STRIPES
+
+    def _key_lock(self, key):
+        """Блокировка ключа внутри процесса (одна из полос)"""
+        return self._thread_locks[self._stripe(key)]
+
+    @contextmanager
+    def _process_lock(self, key):
+        """Межпроцессная блокировка ключа через flock на одном из файлов-полос"""
+        if fcntl is None:
+            yield
+            return
+        lock_folder = os.path.join(self.folder, ".locks")
+        os.makedirs(lock_folder, exist_ok=True)
+        lock_path = os.path.join(lock_folder, f"{self._stripe(key)}.lock")
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_or_create(self, key, produce):
+        """
+        Возвращает путь к закешированному файлу, при промахе создаёт его
+        вызовом produce(temp_path). Одно и то же производное не строится
+        дважды даже при одновременных запросах (в том числе из разных процессов).
+        """
+        path = self.path_for(key)
+        if self._touch(path):
+            return path
+
+        with self._key_lock(key), self._process_lock(key):
+            # Пока ждали блокировку, файл мог построить другой запрос
+            if os.path.exists(path):
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                produce(temp_path)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+        self._account(os.path.getsize(path))
+        return path
+
+    def _touch(self, path):
+        """Отмечает использование файла; False, если файла в кеше нет"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time() - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return True
+
+    def _account(self, added_bytes):
+        with self._size_guard:
+            if self._estimated_size is None:
+                self._estimated_size = self.scan_size()
+            else:
+                self._estimated_size += added_bytes
+            if self._estimated_size > self.max_bytes:
+                self._estimated_size = self.evict()
+
+    def _entries(self):
+        for root, dirs, names in os.walk(self.folder):
+            if ".locks" in dirs:
+                dirs.remove(".locks")
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Удаляет давно не использованные файлы, пока кеш не станет меньше 90% лимита"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        logger.info("Кеш производных превью: удалено %d файлов, размер %d байт", removed, total)
+        return total
+
+
+_derivative_cache = None
+
+
+def get_derivative_cache():
+    global _derivative_cache
+    if _derivative_cache is None:
+        _derivative_cache = DerivativeCache(
+            os.path.join(app.config["UPLOAD_FOLDER"], ".derivatives"),
+            app.config["DERIVATIVE_CACHE_MAX_BYTES"],
+        )
+    return _derivative_cache
+
+
+@app.route("/preview/<int:file_id>/<int:width>")
+@login_required
+def preview_derivative(file_id, width):
+    """Превью изображения заданной ширины; формат — ?format= или по Accept"""
+    file_record = get_own_file(file_id)
+    if not is_image_file(file_record.filename):
+        abort(404)
+
+    source_path = storage.get_file_path(file_record)
+    if not os.path.exists(source_path):
+        abort(404)
+
+    width = round_width(width)
+    fmt = negotiate_format(request.args.get("format"))
+    key = f"{storage.get_content_etag(file_record)}_{width}.{fmt}"
+
+    try:
+        path = get_derivative_cache().get_or_create(
+            key, lambda temp_path: render_derivative(source_path, temp_path, width, fmt)
+        )
+    except Exception:
+        PREVIEW_FAILURES.inc()
+        logger.exception("Не удалось построить превью %s", key)
+        abort(404)
+
+    max_age = get_preview_max_age(file_record)
+    rv = send_stored_file(
+        path,
+        download_name=f"preview_{width}.{fmt}",
+        etag=key,
+        as_attachment=False,
+        mimetype=FORMATS[fmt][1],
+        max_age=max_age,
+        immutable=bool(max_age),
+    )
+    if not request.args.get("format"):
+        rv.vary.add("Accept")
+    return rv
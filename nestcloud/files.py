@@ -0,0 +1,411 @@
+"""
+Операции над файлами пользователя, общие для веб-интерфейса и JSON API:
+создание записи после сохранения на диск, переименование и удаление.
+
+Удаление переносит файл в корзину — меняются только метаданные, запрос
+не ждёт диска. Содержимое удаляется позже, пачками (flask purge-trash).
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+
+from flask import abort, request
+from flask_login import current_user
+from sqlalchemy import delete, tuple_, update
+
+from nestcloud import app, db, storage
+from nestcloud.metrics import FILES_UPLOADED, UPLOAD_FAILURES, timed
+from nestcloud.models import (
+    File,
+    FileVersion,
+    PreviewJob,
+    record_file_changes,
+    update_user_usage,
+)
+from nestcloud.previews import enqueue_preview
+from nestcloud.security import user_cache
+from utils import save_files, get_file_category
+
+logger = logging.getLogger(__name__)
+
+# Символы, недопустимые в имени файла
+FORBIDDEN_FILENAME_PARTS = ["/", "\\", "..", "<", ">", ":", '"', "|", "?", "*"]
+
+
+def get_own_file(file_id):
+    """Возвращает файл текущего пользователя или прерывает запрос (404/403)"""
+    file_record = File.query.get_or_404(file_id)
+
+    # Проверяем, что файл принадлежит текущему пользователю
+    if file_record.user_id != current_user.id:
+        abort(403)
+    # Файл в корзине виден только в ней самой
+    if file_record.deleted_at is not None:
+        abort(404)
+    return file_record
+
+
+def get_preview_max_age(file_record):
+    """
+    Срок кеширования превью в браузере. Адрес с ?v=<версия файла> (его отдают
+    file_to_dict и шаблоны) всегда указывает на превью одной версии и кешируется
+    на PREVIEW_MAX_AGE; без версии или со старой — None, проверка по ETag.
+    """
+    if request.args.get("v") == str(file_record.version):
+        return app.config["PREVIEW_MAX_AGE"]
+    return None
+
+
+def get_own_files(file_ids):
+    """Файлы текущего пользователя из списка id — одним запросом (чужие id отбрасываются)"""
+    if not file_ids:
+        return []
+    return (
+        File.query.filter(
+            File.user_id == current_user.id,
+            File.id.in_(file_ids),
+            File.deleted_at.is_(None),
+        )
+        .order_by(File.id)
+        .all()
+    )
+
+
+def parse_file_ids(values):
+    """Список id из полей формы / параметров запроса, не больше BULK_MAX_FILES"""
+    file_ids = []
+    for value in values:
+        for part in str(value).split(","):
+            if part.strip().isdigit():
+                file_ids.append(int(part))
+    return file_ids[: app.config["BULK_MAX_FILES"]]
+
+
+def find_duplicates(user_id, candidates):
+    """
+    Ищет уже загруженные копии файлов по индексу дубликатов — одним запросом.
+
+    :param candidates: список словарей {"size", "sample_hash", "sha256" (необязательно)}
+    :return: список той же длины: запись File или None. Если клиент передал
+             sha256, а у найденного файла известен content_hash, они должны совпасть.
+    """
+    keys = {
+        (c["size"], c["sample_hash"])
+        for c in candidates
+        if isinstance(c.get("size"), int) and c.get("sample_hash")
+    }
+    if not keys:
+        return [None] * len(candidates)
+
+    matches = {}
+    for file_record in (
+        File.query.filter(
+            File.user_id == user_id,
+            tuple_(File.size_bytes, File.sample_hash).in_(list(keys)),
+            File.deleted_at.is_(None),
+        )
+        .order_by(File.id)
+        .all()
+    ):
+        key = (file_record.size_bytes, file_record.sample_hash)
+        matches.setdefault(key, []).append(file_record)
+
+    results = []
+    for c in candidates:
+        found = None
+        for file_record in matches.get((c.get("size"), c.get("sample_hash")), []):
+            sha256 = c.get("sha256")
+            if sha256 and file_record.content_hash and sha256 != file_record.content_hash:
+                continue
+            # Файл с тем же именем — лучшее совпадение
+            if found is None or file_record.filename == c.get("name"):
+                found = file_record
+        results.append(found)
+    return results
+
+
+def create_file_record(saved_data, user_id, folder_id=None):
+    """
+    Создаёт запись File по данным save_file/describe_stored_file
+    и ставит превью в очередь. Коммит остаётся за вызывающим кодом.
+    """
+    new_file = File(
+        filename=saved_data["original_filename"],
+        stored_filename=saved_data["stored_filename"],
+        user_id=user_id,
+        file_size=saved_data["human_size"],
+        size_bytes=saved_data["size_bytes"],
+        stored_size=saved_data.get("stored_size"),
+        encoding=saved_data.get("encoding"),
+        upload_time=saved_data["upload_time"],
+        preview_path=saved_data["preview_relpath"],
+        preview_status=saved_data["preview_status"],
+        blob_hash=saved_data.get("blob_hash"),
+        sample_hash=saved_data.get("sample_hash"),
+        content_hash=saved_data.get("content_hash"),
+        category=get_file_category(saved_data["original_filename"]),
+        folder_id=folder_id,
+    )
+    db.session.add(new_file)
+    enqueue_preview(new_file)
+    return new_file
+
+
+def create_uploaded_files(files, user_id, folder_id=None):
+    """
+    Сохраняет несколько загруженных файлов (запись на диск — параллельно)
+    и добавляет их записи в БД одним коммитом (в папку folder_id, None — корень).
+
+    :return: список словарей {"filename", "file" или "error"} в порядке файлов
+    """
+    results = []
+    for filename, saved_data, error in save_files(files, user_id):
+        if error:
+            results.append({"filename": filename, "error": error})
+        else:
+            new_file = create_file_record(saved_data, user_id, folder_id)
+            results.append({"filename": filename, "file": new_file, "data": saved_data})
+
+    try:
+        with timed("db_commit"):
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        UPLOAD_FAILURES.inc(len(results))
+        # Записи не сохранились — удаляем записанные файлы (блобы подберёт очистка)
+        remove_paths(
+            r["data"]["absolute_path"]
+            for r in results
+            if "data" in r and not r["data"].get("blob_hash")
+        )
+        raise
+
+    for r in results:
+        r.pop("data", None)
+    uploaded = sum(1 for r in results if "file" in r)
+    FILES_UPLOADED.inc(uploaded)
+    UPLOAD_FAILURES.inc(len(results) - uploaded)
+    return results
+
+
+def prepare_new_filename(file_record, new_filename):
+    """
+    Проверяет новое имя файла и сохраняет исходное расширение.
+
+    :return: (новое имя, None) или (None, текст ошибки)
+    """
+    new_filename = (new_filename or "").strip()
+
+    if not new_filename:
+        return None, "Имя файла не может быть пустым"
+
+    # Проверяем, что имя файла не содержит опасных символов
+    if any(char in new_filename for char in FORBIDDEN_FILENAME_PARTS):
+        return None, "Имя файла содержит недопустимые символы"
+
+    # Получаем расширение оригинального файла
+    old_extension = ""
+    if "." in file_record.filename:
+        old_extension = "." + file_record.filename.rsplit(".", 1)[1]
+
+    # Удаляем расширение из введенного имени (если есть)
+    if "." in new_filename:
+        new_filename = new_filename.rsplit(".", 1)[0]
+
+    # Всегда добавляем оригинальное расширение
+    if old_extension:
+        new_filename = new_filename + old_extension
+
+    return new_filename, None
+
+
+def trash_files(user_id, condition):
+    """
+    Переносит в корзину файлы пользователя, подходящие под условие. Меняются
+    только метаданные: содержимое и место в квоте освобождаются при
+    окончательном удалении (purge_file_records). Запросы идут без событий
+    модели — журнал изменений и число файлов обновляются здесь, одним
+    запросом на всю пачку. Коммит остаётся за вызывающим кодом.
+
+    :return: число перенесённых файлов
+    """
+    now = datetime.now()
+    live = db.and_(File.user_id == user_id, File.deleted_at.is_(None), condition)
+    connection = db.session.connection()
+    # Для клиентов синхронизации файл в корзине удалён
+    record_file_changes(connection, live, "deleted")
+    count = db.session.execute(
+        update(File)
+        .where(live)
+        .values(
+            deleted_at=now,
+            purge_at=now + timedelta(days=app.config["TRASH_RETENTION_DAYS"]),
+        )
+        .execution_options(synchronize_session="fetch")
+    ).rowcount
+    update_user_usage(connection, user_id, 0, -count)
+    # События модели не срабатывают — снимок пользователя сбрасывается здесь
+    user_cache.invalidate(user_id)
+    return count
+
+
+def restore_files(user_id, condition):
+    """
+    Возвращает файлы из корзины (кроме уже ожидающих окончательного удаления).
+    Коммит остаётся за вызывающим кодом.
+
+    :return: число восстановленных файлов
+    """
+    trashed = db.and_(
+        File.user_id == user_id,
+        File.deleted_at.isnot(None),
+        File.purge_at > datetime.now(),
+        condition,
+    )
+    connection = db.session.connection()
+    record_file_changes(connection, trashed, "created")
+    count = db.session.execute(
+        update(File)
+        .where(trashed)
+        .values(deleted_at=None, purge_at=None)
+        .execution_options(synchronize_session="fetch")
+    ).rowcount
+    update_user_usage(connection, user_id, 0, count)
+    user_cache.invalidate(user_id)
+    return count
+
+
+def schedule_purge(user_id, condition):
+    """
+    Удаление из корзины навсегда: файлы сразу пропадают из корзины,
+    а содержимое удалит ближайший проход flask purge-trash.
+    Коммит остаётся за вызывающим кодом.
+
+    :return: число файлов
+    """
+    now = datetime.now()
+    return db.session.execute(
+        update(File)
+        .where(
+            File.user_id == user_id,
+            File.deleted_at.isnot(None),
+            File.purge_at > now,
+            condition,
+        )
+        .values(purge_at=now)
+        .execution_options(synchronize_session="fetch")
+    ).rowcount
+
+
+def purge_file_records(file_records):
+    """
+    Окончательно удаляет файлы из корзины одной транзакцией (вместе с их
+    предыдущими версиями). Записи удаляются запросами без событий модели,
+    занятое место (файлы и их версии) уменьшается одним UPDATE
+    на пользователя (число файлов уменьшилось ещё при переносе в корзину).
+    Файлы с диска удаляются после коммита: если коммит не удался, записи
+    продолжают указывать на существующее содержимое.
+    """
+    if not file_records:
+        return
+    purged_ids = [f.id for f in file_records]
+    versions = FileVersion.query.filter(FileVersion.file_id.in_(purged_ids)).all()
+
+    paths_to_remove, orphaned_blobs = release_contents(file_records + versions)
+    freed_bytes = {}
+    preview_paths = {}
+    for file_record in file_records:
+        user_id = file_record.user_id
+        freed_bytes[user_id] = freed_bytes.get(user_id, 0) + (file_record.size_bytes or 0)
+        preview_paths.setdefault(user_id, []).append(file_record.preview_path)
+    for version in versions:
+        user_id = version.user_id
+        freed_bytes[user_id] = freed_bytes.get(user_id, 0) + (version.size_bytes or 0)
+
+    connection = db.session.connection()
+    for user_id, size in freed_bytes.items():
+        paths_to_remove += unused_preview_paths(user_id, preview_paths[user_id], purged_ids)
+        update_user_usage(connection, user_id, -size, 0)
+        user_cache.invalidate(user_id)
+    for model, column in (
+        (FileVersion, FileVersion.file_id),
+        (PreviewJob, PreviewJob.file_id),
+        (File, File.id),
+    ):
+        db.session.execute(
+            delete(model)
+            .where(column.in_(purged_ids))
+            .execution_options(synchronize_session=False)
+        )
+    # Удалённые запросами записи больше не нужны сессии
+    for record in file_records + versions:
+        db.session.expunge(record)
+    db.session.commit()
+
+    remove_released(paths_to_remove, orphaned_blobs)
+    logger.info("Окончательно удалено файлов: %d", len(file_records))
+
+
+def release_contents(records):
+    """
+    Освобождает содержимое записей File / FileVersion (коммит остаётся
+    за вызывающим кодом): у блобов уменьшается счётчик ссылок, обычные
+    файлы подлежат удалению.
+
+    :return: (пути для удаления, блобы без ссылок) — для remove_released после коммита
+    """
+    paths_to_remove = []
+    blob_counts = {}
+    for record in records:
+        if record.blob_hash:
+            blob_counts[record.blob_hash] = blob_counts.get(record.blob_hash, 0) + 1
+        else:
+            paths_to_remove.append(storage.get_file_path(record))
+    orphaned_blobs = [
+        blob_hash
+        for blob_hash, count in blob_counts.items()
+        if storage.release_blob(blob_hash, count)
+    ]
+    return paths_to_remove, orphaned_blobs
+
+
+def unused_preview_paths(user_id, preview_paths, exclude_ids=()):
+    """
+    Полные пути превью (кроме статических иконок), которые не использует
+    ни один файл, кроме exclude_ids — одинаковые блобы пользователя делят одно превью
+    """
+    preview_paths = {
+        path for path in preview_paths if path and not path.startswith("file_icons/")
+    }
+    if not preview_paths:
+        return []
+    still_used = {
+        path
+        for (path,) in db.session.query(File.preview_path).filter(
+            File.user_id == user_id,
+            File.preview_path.in_(preview_paths),
+            File.id.notin_(exclude_ids),
+        )
+    }
+    return [
+        storage.resolve_user_path(user_id, path) for path in preview_paths - still_used
+    ]
+
+
+def remove_released(paths, orphaned_blobs):
+    """Удаляет с диска содержимое, освобождённое release_contents (после коммита)"""
+    remove_paths(paths)
+    for blob_hash in orphaned_blobs:
+        storage.remove_unreferenced_blob(blob_hash)
+
+
+def remove_paths(paths):
+    """Удаляет файлы с диска, пропуская уже отсутствующие"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Не удалось удалить %s: %s", path, e)
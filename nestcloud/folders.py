@@ -0,0 +1,223 @@
+"""
+Папки пользователя: создание, переименование, перенос и удаление —
+общие для веб-интерфейса и JSON API.
+
+Дерево хранится материализованными путями (Folder.path — id предков и самой
+папки, например "/3/17/"). Содержимое одной папки выбирается по parent_id /
+File.folder_id, поддерево — диапазоном path по индексу (user_id, path),
+так что скорость не зависит от размера всего дерева пользователя.
+Перенос папки переписывает path только у папок её поддерева, файлы
+(и их содержимое на диске) не меняются.
+"""
+
+import logging
+
+from flask import abort
+from flask_login import current_user
+from sqlalchemy import func, update
+
+from nestcloud import db
+from nestcloud.files import FORBIDDEN_FILENAME_PARTS, trash_files
+from nestcloud.models import File, Folder
+
+logger = logging.getLogger(__name__)
+
+# Наибольшая вложенность папок (path хранится строкой ограниченной длины)
+MAX_DEPTH = 64
+# Побайтовый collation по СУБД (по умолчанию — BINARY, как в SQLite)
+BINARY_COLLATIONS = {"postgresql": "C"}
+
+
+def get_own_folder(folder_id):
+    """Возвращает папку текущего пользователя или прерывает запрос (404/403)"""
+    folder = db.get_or_404(Folder, folder_id)
+    if folder.user_id != current_user.id:
+        abort(403)
+    return folder
+
+
+def parse_folder_id(value):
+    """id папки из формы / JSON; пустое значение и "root" — корень (None)"""
+    if value in (None, "", "root"):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def get_target_folder(value):
+    """Папка назначения из параметра запроса (None — корень)"""
+    folder_id = parse_folder_id(value)
+    return get_own_folder(folder_id) if folder_id is not None else None
+
+
+def subtree_filter(folder):
+    """
+    Условие "папка folder и все вложенные" по индексу (user_id, path).
+    Путь состоит из цифр и "/", поэтому все пути поддерева лежат
+    в диапазоне [path, path без последнего "/" + "0"). Диапазон верен только
+    при побайтовом сравнении, поэтому collation задан явно (тот же, что
+    у столбца, — иначе индекс не используется).
+    """
+    path = Folder.path.collate(BINARY_COLLATIONS.get(db.engine.dialect.name, "BINARY"))
+    return db.and_(
+        Folder.user_id == folder.user_id,
+        path >= folder.path,
+        path < folder.path[:-1] + "0",
+    )
+
+
+def check_folder_name(user_id, parent_id, name, exclude_id=None):
+    """
+    Проверяет имя папки и его уникальность среди соседних папок.
+
+    :return: (имя, None) или (None, текст ошибки)
+    """
+    name = (name or "").strip()
+    if not name:
+        return None, "Имя папки не может быть пустым"
+    if len(name) > 255 or any(part in name for part in FORBIDDEN_FILENAME_PARTS):
+        return None, "Имя папки содержит недопустимые символы"
+    query = Folder.query.filter(
+        Folder.user_id == user_id, Folder.parent_id == parent_id, Folder.name == name
+    )
+    if exclude_id is not None:
+        query = query.filter(Folder.id != exclude_id)
+    if query.first() is not None:
+        return None, "Папка с таким именем уже существует"
+    return name, None
+
+
+def create_folder(user_id, name, parent=None):
+    """
+    Создаёт папку (коммит остаётся за вызывающим кодом).
+
+    :return: (Folder, None) или (None, текст ошибки)
+    """
+    parent_id = parent.id if parent else None
+    name, error = check_folder_name(user_id, parent_id, name)
+    if error:
+        return None, error
+    if parent and parent.path.count("/") > MAX_DEPTH:
+        return None, "Слишком большая вложенность папок"
+
+    folder = Folder(user_id=user_id, parent_id=parent_id, name=name)
+    db.session.add(folder)
+    # Путь включает собственный id, который известен только после вставки
+    db.session.flush()
+    folder.path = f"{parent.path if parent else '/'}{folder.id}/"
+    return folder, None
+
+
+def rename_folder(folder, name):
+    """Переименовывает папку — меняется одна строка. :return: текст ошибки или None"""
+    name, error = check_folder_name(folder.user_id, folder.parent_id, name, folder.id)
+    if error:
+        return error
+    folder.name = name
+    return None
+
+
+def move_folder(folder, new_parent):
+    """
+    Переносит папку в new_parent (None — в корень): одним UPDATE переписываются
+    пути папок поддерева. Коммит остаётся за вызывающим кодом.
+
+    :return: текст ошибки или None
+    """
+    new_parent_id = new_parent.id if new_parent else None
+    if new_parent_id == folder.parent_id:
+        return None
+    if new_parent and new_parent.path.startswith(folder.path):
+        return "Нельзя перенести папку в саму себя"
+    _, error = check_folder_name(folder.user_id, new_parent_id, folder.name, folder.id)
+    if error:
+        return error
+
+    old_path = folder.path
+    new_path = f"{new_parent.path if new_parent else '/'}{folder.id}/"
+    if new_path.count("/") + max_subtree_depth(folder) > MAX_DEPTH + 1:
+        return "Слишком большая вложенность папок"
+    db.session.execute(
+        update(Folder)
+        .where(subtree_filter(folder))
+        .values(
+            path=db.literal(new_path, db.String).concat(
+                func.substr(Folder.path, len(old_path) + 1)
+            )
+        )
+        .execution_options(synchronize_session=False)
+    )
+    folder.parent_id = new_parent_id
+    # path папки в сессии уже устарел — перечитаем при следующем обращении
+    db.session.expire(folder, ["path"])
+    return None
+
+
+def max_subtree_depth(folder):
+    """На сколько уровней поддерево уходит вглубь от folder"""
+    slashes = func.length(Folder.path) - func.length(func.replace(Folder.path, "/", ""))
+    longest = db.session.query(func.max(slashes)).filter(subtree_filter(folder)).scalar()
+    return (longest or 0) - folder.path.count("/")
+
+
+def move_files(file_records, folder):
+    """Переносит файлы в папку (None — в корень): меняется только folder_id"""
+    folder_id = folder.id if folder else None
+    for file_record in file_records:
+        file_record.folder_id = folder_id
+
+
+def get_breadcrumbs(folder):
+    """Папки от корня до folder включительно — одним запросом по id из пути"""
+    if folder is None:
+        return []
+    ids = [int(part) for part in folder.path.strip("/").split("/")]
+    folders = {f.id: f for f in Folder.query.filter(Folder.id.in_(ids))}
+    return [folders[folder_id] for folder_id in ids if folder_id in folders]
+
+
+def list_subfolders(user_id, parent_id):
+    """Вложенные папки одного уровня, по имени"""
+    return (
+        Folder.query.filter(Folder.user_id == user_id, Folder.parent_id == parent_id)
+        .order_by(Folder.name, Folder.id)
+        .all()
+    )
+
+
+def get_folder_stats(folder):
+    """Число вложенных папок, файлов и их размер во всём поддереве"""
+    subtree = db.select(Folder.id).where(subtree_filter(folder))
+    folders = db.session.query(func.count(Folder.id)).filter(subtree_filter(folder)).scalar()
+    files, size = db.session.execute(
+        db.select(func.count(File.id), func.coalesce(func.sum(File.size_bytes), 0)).where(
+            File.user_id == folder.user_id,
+            File.folder_id.in_(subtree),
+            File.deleted_at.is_(None),
+        )
+    ).one()
+    return {"folders": folders - 1, "files": files, "size": size}
+
+
+def delete_folder(folder):
+    """
+    Удаляет папку со всеми вложенными папками, а их файлы переносит
+    в корзину (с коммитом). Восстановленные файлы попадают в корень.
+    """
+    folder_id = folder.id
+    subtree = db.select(Folder.id).where(subtree_filter(folder))
+    in_subtree = db.and_(File.user_id == folder.user_id, File.folder_id.in_(subtree))
+    trashed = trash_files(folder.user_id, in_subtree)
+    # Файлы корзины больше не ссылаются на удаляемые папки
+    db.session.execute(
+        update(File)
+        .where(in_subtree)
+        .values(folder_id=None)
+        .execution_options(synchronize_session="fetch")
+    )
+    db.session.execute(Folder.__table__.delete().where(subtree_filter(folder)))
+    db.session.commit()
+    logger.info("Удалена папка %s, файлов перенесено в корзину: %d", folder_id, trashed)
+    return trashed
@@ -0,0 +1,162 @@
+"""
+Постраничный список файлов пользователя с сортировкой на сервере.
+
+Используется keyset-пагинация: курсор хранит значение поля сортировки и id
+последней показанной строки, и следующая страница выбирается по индексу
+(user_id, <поле>, id) без OFFSET — скорость не зависит от номера страницы.
+Поиск по имени и фильтр по категории сужают тот же запрос, курсор остаётся
+прежним (клиент передаёт те же q и type вместе с курсором). Список одной
+папки идёт по индексам (user_id, folder_id, <поле>, id). Файлы в корзине
+в эти индексы не входят (частичные индексы), у корзины свой индекс.
+"""
+
+import base64
+from datetime import datetime
+import json
+
+from sqlalchemy import tuple_
+
+from nestcloud import search
+from nestcloud.models import File
+from utils import FILE_CATEGORIES
+
+# Вид сортировки → (поле, по убыванию)
+SORTS = {
+    "name-asc": (File.filename, False),
+    "name-desc": (File.filename, True),
+    "size-asc": (File.size_bytes, False),
+    "size-desc": (File.size_bytes, True),
+    "time-asc": (File.upload_time, False),
+    "time-desc": (File.upload_time, True),
+}
+SORT_LABELS = {
+    "name-asc": "По имени (А-Я)",
+    "name-desc": "По имени (Я-А)",
+    "size-asc": "По размеру (возрастание)",
+    "size-desc": "По размеру (убывание)",
+    "time-asc": "По времени (старые сначала)",
+    "time-desc": "По времени (новые сначала)",
+}
+DEFAULT_SORT = "time-desc"
+PAGE_SIZE = 50
+# folder_id для списка файлов из всех папок (None — корень)
+ALL_FOLDERS = "all"
+
+
+def normalize_sort(sort):
+    return sort if sort in SORTS else DEFAULT_SORT
+
+
+def normalize_category(category):
+    return category if category in FILE_CATEGORIES else None
+
+
+def encode_cursor(sort, file_record):
+    column, _ = SORTS[sort]
+    return pack_cursor(getattr(file_record, column.key), file_record.id)
+
+
+def pack_cursor(value, last_id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, last_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(sort, cursor):
+    """Возвращает (значение, id) из курсора или None, если курсор испорчен"""
+    return unpack_cursor(cursor, sort.startswith("time-"))
+
+
+def unpack_cursor(cursor, is_time=False):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, last_id = json.loads(raw)
+        if is_time:
+            value = datetime.fromisoformat(value)
+        return value, int(last_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def user_files_query(user_id):
+    """Базовый запрос файлов пользователя вне корзины — все списки строятся от него"""
+    return File.query.filter(File.user_id == user_id, File.deleted_at.is_(None))
+
+
+def count_user_files(user_id):
+    return user_files_query(user_id).count()
+
+
+def trash_query(user_id):
+    """Файлы в корзине, кроме уже ожидающих окончательного удаления"""
+    return File.query.filter(
+        File.user_id == user_id,
+        File.deleted_at.isnot(None),
+        File.purge_at > datetime.now(),
+    )
+
+
+def list_trash_page(user_id, cursor=None, limit=PAGE_SIZE):
+    """
+    Страница корзины, недавно удалённые сначала (индекс ix_file_trash).
+
+    :return: (список File, курсор следующей страницы или None)
+    """
+    query = trash_query(user_id)
+    if cursor:
+        position = unpack_cursor(cursor, is_time=True)
+        if position is not None:
+            query = query.filter(tuple_(File.deleted_at, File.id) < position)
+    files = (
+        query.order_by(File.deleted_at.desc(), File.id.desc()).limit(limit + 1).all()
+    )
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = pack_cursor(files[-1].deleted_at, files[-1].id)
+    return files, next_cursor
+
+
+def list_files_page(
+    user_id,
+    sort=DEFAULT_SORT,
+    cursor=None,
+    limit=PAGE_SIZE,
+    search_text=None,
+    category=None,
+    folder_id=ALL_FOLDERS,
+):
+    """
+    Одна страница файлов пользователя (с учётом поиска по имени, категории и папки).
+
+    :return: (список File, курсор следующей страницы или None)
+    """
+    sort = normalize_sort(sort)
+    column, descending = SORTS[sort]
+    query = user_files_query(user_id)
+    if folder_id != ALL_FOLDERS:
+        query = query.filter(File.folder_id == folder_id)
+    if search_text:
+        query = search.filter_by_search(query, user_id, search_text)
+    category = normalize_category(category)
+    if category:
+        query = query.filter(File.category == category)
+
+    if cursor:
+        position = decode_cursor(sort, cursor)
+        if position is not None:
+            key = tuple_(column, File.id)
+            query = query.filter(key < position if descending else key > position)
+
+    if descending:
+        query = query.order_by(column.desc(), File.id.desc())
+    else:
+        query = query.order_by(column.asc(), File.id.asc())
+
+    files = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = encode_cursor(sort, files[-1])
+    return files, next_cursor
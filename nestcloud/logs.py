@@ -0,0 +1,45 @@
+"""
+Настройка журналирования приложения.
+
+Уровень задаётся LOG_LEVEL (DEBUG, INFO, WARNING, ...), формат — LOG_FORMAT:
+"text" — строка для человека, "json" — одна JSON-запись на строку для сборщиков
+логов. Дополнительные поля передаются через extra={...} и попадают в JSON.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+
+# Стандартные атрибуты LogRecord — всё остальное пришло через extra
+STANDARD_RECORD_FIELDS = set(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level="INFO", log_format="text"):
+    handler = logging.StreamHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
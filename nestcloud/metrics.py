@@ -0,0 +1,502 @@
+"""
+Метрики в формате Prometheus (/metrics).
+
+Счётчики и гистограммы считаются в памяти процесса, а для /metrics
+складываются по всем процессам сервера (несколько рабочих процессов gunicorn
+за одним адресом Prometheus видит как один экземпляр). Каждый процесс раз
+в METRICS_FLUSH_INTERVAL секунд записывает снимок своих значений в общий
+каталог METRICS_DIR, а /metrics суммирует снимки. Снимки завершившихся
+процессов сливаются в один файл, чтобы счётчики не уменьшались после
+перезапуска рабочего процесса. Этапы загрузки и отдачи замеряются
+через timed("этап").
+
+Если задан METRICS_TOKEN, /metrics требует заголовок
+"Authorization: Bearer <токен>".
+"""
+
+import atexit
+from contextlib import contextmanager
+import hmac
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import Response, abort, g, request
+
+from nestcloud import app
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+# Границы корзин гистограмм длительности, секунды
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Счётчик без меток виден в /metrics сразу, со значением 0
+        self._values = {} if self.labelnames else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dump(self, values=None):
+        """Значения в виде для JSON-снимка (по умолчанию — этого процесса)"""
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        return [[list(key), value] for key, value in values.items()]
+
+    def merge(self, values, dumped):
+        """Добавляет к values значения из снимка dump()"""
+        for key, value in dumped:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def collect(self, values=None):
+        """Строки для /metrics: значения values (сумма процессов) или этого процесса"""
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        if not self.labelnames:
+            values.setdefault((), 0)
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # метки → (счётчики по корзинам, сумма, количество)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def dump(self, values=None):
+        if values is None:
+            with self._lock:
+                values = {key: (list(c), t, n) for key, (c, t, n) in self._values.items()}
+        return [
+            [list(key), counts, total, count]
+            for key, (counts, total, count) in values.items()
+        ]
+
+    def merge(self, values, dumped):
+        for key, counts, total, count in dumped:
+            if len(counts) != len(self.buckets):
+                # Снимок процесса со старыми границами корзин
+                continue
+            key = tuple(key)
+            old_counts, old_total, old_count = values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            values[key] = (
+                [a + b for a, b in zip(old_counts, counts)],
+                old_total + total,
+                old_count + count,
+            )
+
+    def collect(self, values=None):
+        if values is None:
+            with self._lock:
+                values = {key: (list(c), t, n) for key, (c, t, n) in self._values.items()}
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = format_labels(names, key + (repr(float(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = format_labels(names, key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REQUESTS = Counter(
+    "nestcloud_http_requests_total",
+    "HTTP-запросы по обработчику, методу и коду ответа",
+    ("endpoint", "method", "status"),
+)
+REQUEST_DURATION = Histogram(
+    "nestcloud_http_request_duration_seconds",
+    "Время обработки запроса до начала отдачи ответа",
+    ("endpoint",),
+)
+STAGE_DURATION = Histogram(
+    "nestcloud_stage_duration_seconds",
+    "Длительность этапов загрузки, превью и отдачи файлов",
+    ("stage",),
+)
+BYTES_RECEIVED = Counter(
+    "nestcloud_bytes_received_total", "Принято байт в телах запросов", ("endpoint",)
+)
+BYTES_SENT = Counter(
+    "nestcloud_bytes_sent_total", "Отдано байт в телах ответов", ("endpoint",)
+)
+FILES_UPLOADED = Counter("nestcloud_files_uploaded_total", "Сохранено файлов")
+UPLOAD_FAILURES = Counter(
+    "nestcloud_upload_failures_total", "Файлы, которые не удалось сохранить"
+)
+PREVIEWS_GENERATED = Counter(
+    "nestcloud_previews_generated_total", "Построено превью изображений"
+)
+PREVIEW_FAILURES = Counter(
+    "nestcloud_preview_failures_total", "Ошибки построения превью изображений"
+)
+TRANSFERS_REJECTED = Counter(
+    "nestcloud_transfers_rejected_total",
+    "Загрузки и скачивания, отклонённые ограничением одновременных передач",
+    ("kind", "limit"),
+)
+TRANSFER_THROTTLED = Counter(
+    "nestcloud_transfer_throttled_seconds_total",
+    "Сколько передачи ждали по ограничению скорости",
+    ("kind",),
+)
+
+REGISTRY = [
+    REQUESTS,
+    REQUEST_DURATION,
+    STAGE_DURATION,
+    BYTES_RECEIVED,
+    BYTES_SENT,
+    FILES_UPLOADED,
+    UPLOAD_FAILURES,
+    PREVIEWS_GENERATED,
+    PREVIEW_FAILURES,
+    TRANSFERS_REJECTED,
+    TRANSFER_THROTTLED,
+]
+
+
+@contextmanager
+def timed(stage, **log_fields):
+    """Замеряет этап: гистограмма nestcloud_stage_duration_seconds и запись DEBUG"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.observe(elapsed, stage=stage)
+        logger.debug(
+            "этап %s: %.1f мс",
+            stage,
+            elapsed * 1000,
+            extra={"stage": stage, "duration_ms": round(elapsed * 1000, 3), **log_fields},
+        )
+
+
+class CallbackGauge:
+    """Значение, которое вычисляется при каждом запросе /metrics (например, из БД)"""
+
+    def __init__(self, name, documentation, labelnames, callback):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # callback() возвращает {кортеж значений меток: число}
+        self.callback = callback
+
+    def collect(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        try:
+            values = self.callback()
+        except Exception:
+            logger.exception("Не удалось вычислить метрику %s", self.name)
+            return lines
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+def observe_until_close(response, stage):
+    """Замеряет отдачу тела ответа: от создания ответа до закрытия его сервером"""
+    started = time.perf_counter()
+
+    def observe():
+        STAGE_DURATION.observe(time.perf_counter() - started, stage=stage)
+
+    return call_when_sent(response, observe)
+
+
+def call_when_sent(response, callback):
+    """Вызывает callback, когда сервер закончит отдачу тела ответа (или прервёт её)"""
+    body = response.response
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+    elif inspect.isgenerator(body) or isinstance(body, (list, tuple)):
+        # Тело direct_passthrough отдаётся серверу как есть, Response.close не вызывается
+        # (список — например, пустое тело ответа 304 или X-Accel-Redirect)
+        def observed():
+            try:
+                yield from body
+            finally:
+                callback()
+
+        response.response = observed()
+    else:
+        # Файловую обёртку не заменяем: по её типу сервер отдаёт файл через sendfile
+        close = getattr(body, "close", None)
+
+        def closed():
+            try:
+                if close is not None:
+                    close()
+            finally:
+                callback()
+
+        body.close = closed
+    return response
+
+
+def process_exists(pid) -> bool:
+    if os.name != "posix":
+        # os.kill без сигнала есть только в POSIX — снимок считается живым
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedMetrics:
+    """
+    Общий для процессов сервера каталог снимков метрик. Процесс, начавший
+    обрабатывать запросы, пишет свой файл <pid>-<метка>.json (фоновым потоком
+    раз в METRICS_FLUSH_INTERVAL секунд, перед ответом /metrics и при выходе);
+    метка отличает процессы с повторно выданным pid.
+    """
+
+    ARCHIVE = "archive.json"
+
+    def __init__(self):
+        self._pid = None
+        self._filename = None
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def get_folder(self):
+        return app.config["METRICS_DIR"] or os.path.join(
+            app.config["UPLOAD_FOLDER"], ".metrics"
+        )
+
+    def start(self):
+        """Начинает запись снимков этого процесса (после fork — заново)"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._filename = f"{pid}-{uuid.uuid4().hex[:8]}.json"
+            self._pid = pid
+            threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config["METRICS_FLUSH_INTERVAL"])
+            self.flush()
+
+    def flush(self):
+        """Записывает снимок метрик процесса (через временный файл — атомарно)"""
+        if self._pid != os.getpid():
+            return
+        folder = self.get_folder()
+        path = os.path.join(folder, self._filename)
+        snapshot = {
+            metric.name: metric.dump() for metric in REGISTRY if hasattr(metric, "dump")
+        }
+        with self._flush_lock:
+            try:
+                os.makedirs(folder, exist_ok=True)
+                write_json(path, snapshot)
+            except OSError as e:
+                logger.warning("Не удалось записать метрики процесса: %s", e)
+
+    @contextmanager
+    def _locked(self, folder):
+        """Разбор снимков — одним процессом за раз (иначе архив может задвоиться)"""
+        if fcntl is None:
+            with self._flush_lock:
+                yield
+            return
+        with open(os.path.join(folder, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def collect(self):
+        """Сумма снимков всех процессов: {имя метрики: {метки: значение}}"""
+        self.flush()
+        folder = self.get_folder()
+        os.makedirs(folder, exist_ok=True)
+        with self._locked(folder):
+            self._archive_finished(folder)
+            merged = {}
+            for name in sorted(os.listdir(folder)):
+                if name.endswith(".json"):
+                    merge_snapshot(merged, read_json(os.path.join(folder, name)))
+        return merged
+
+    def _archive_finished(self, folder):
+        """Сливает снимки завершившихся процессов в archive.json"""
+        finished = []
+        for name in os.listdir(folder):
+            pid = name.split("-", 1)[0]
+            if name.endswith(".json") and pid.isdigit() and not process_exists(int(pid)):
+                finished.append(os.path.join(folder, name))
+        if not finished:
+            return
+        archive_path = os.path.join(folder, self.ARCHIVE)
+        merged = {}
+        for path in [archive_path] + finished:
+            merge_snapshot(merged, read_json(path))
+        write_json(
+            archive_path,
+            {
+                metric.name: metric.dump(merged[metric.name])
+                for metric in REGISTRY
+                if metric.name in merged
+            },
+        )
+        for path in finished:
+            os.remove(path)
+
+    def clear(self):
+        """Удаляет все снимки — при запуске сервера (gunicorn on_starting)"""
+        folder = self.get_folder()
+        if not os.path.isdir(folder):
+            return
+        for name in os.listdir(folder):
+            if name.endswith((".json", ".tmp")):
+                os.remove(os.path.join(folder, name))
+
+
+def read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning("Повреждённый снимок метрик: %s", path)
+        return {}
+
+
+def write_json(path, data):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def merge_snapshot(merged, snapshot):
+    """Добавляет снимок процесса к сумме {имя метрики: {метки: значение}}"""
+    for metric in REGISTRY:
+        if hasattr(metric, "merge") and metric.name in snapshot:
+            metric.merge(merged.setdefault(metric.name, {}), snapshot[metric.name])
+
+
+shared_metrics = SharedMetrics()
+atexit.register(shared_metrics.flush)
+
+
+def render_metrics():
+    try:
+        merged = shared_metrics.collect()
+    except OSError as e:
+        # Без общего каталога отдаём хотя бы значения этого процесса
+        logger.warning("Не удалось прочитать метрики процессов: %s", e)
+        merged = None
+    lines = []
+    for metric in REGISTRY:
+        if merged is not None and hasattr(metric, "merge"):
+            lines.extend(metric.collect(merged.get(metric.name, {})))
+        else:
+            lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+@app.before_request
+def start_request_timer():
+    shared_metrics.start()
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    endpoint = request.endpoint or "unmatched"
+    if started is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if request.content_length:
+        BYTES_RECEIVED.inc(request.content_length, endpoint=endpoint)
+    # Потоковые ответы без Content-Length (ZIP) считаются при отдаче
+    if response.content_length and request.method != "HEAD":
+        BYTES_SENT.inc(response.content_length, endpoint=endpoint)
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    token = app.config["METRICS_TOKEN"]
+    if token:
+        provided = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(provided, f"Bearer {token}"):
+            abort(401)
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -1,6 +1,9 @@
-from nestcloud import db, manager
+from nestcloud import db
 from flask_login import UserMixin
 from datetime import datetime
+from functools import cached_property
+import json
+from sqlalchemy import event, insert, inspect, literal, select, update
 
 
 class User(db.Model, UserMixin):
@@ -8,24 +11,374 @@ class User(db.Model, UserMixin):
     login = db.Column(db.String(64), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     files = db.relationship("File", backref="user", lazy=True)
+    # Занятое место и число файлов — обновляются в той же транзакции,
+    # что и записи File (см. события ниже), исправляются командой reconcile-usage.
+    # Файлы в корзине занимают место до окончательного удаления, но в число
+    # файлов не входят
+    used_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    file_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Личная квота в байтах; None — квота по умолчанию (USER_QUOTA_BYTES)
+    quota_bytes = db.Column(db.BigInteger, nullable=True)
 
     def __repr__(self):
         return "<User %r>" % self.id
 
 
+# Условия частичных индексов File: файлы вне корзины и в корзине
+LIVE = {
+    "sqlite_where": db.text("deleted_at IS NULL"),
+    "postgresql_where": db.text("deleted_at IS NULL"),
+}
+TRASHED = {
+    "sqlite_where": db.text("deleted_at IS NOT NULL"),
+    "postgresql_where": db.text("deleted_at IS NOT NULL"),
+}
+
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     stored_filename = db.Column(db.String(255), nullable=False)
     preview_path = db.Column(db.String(255), nullable=True)
+    # Статус превью изображения: pending / ready / failed (None — превью не нужно)
+    preview_status = db.Column(db.String(16), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     file_size = db.Column(db.String(255), nullable=False)
+    # Размер в байтах — для сортировки и подсчётов (file_size — строка для показа)
+    size_bytes = db.Column(db.BigInteger, nullable=True)
+    # Сколько файл занимает на диске (меньше size_bytes, если содержимое сжато)
+    # и чем сжато: None — хранится как есть, "zstd" — см. STORAGE_COMPRESSION
+    stored_size = db.Column(db.BigInteger, nullable=True)
+    encoding = db.Column(db.String(16), nullable=True)
     upload_time = db.Column(db.DateTime, default=datetime)
+    # Хеш содержимого в хранилище блобов (режим STORAGE_MODE=cas), иначе None
+    blob_hash = db.Column(
+        db.String(64), db.ForeignKey("blob.hash"), nullable=True, index=True
+    )
+    # Индекс дубликатов: SHA-256 размера, первых и последних 4 КБ (sample_hash)
+    # и SHA-256 всего содержимого (content_hash)
+    sample_hash = db.Column(db.String(64), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    # Категория для фильтра списка: image / document / audio / video / archive / other
+    category = db.Column(db.String(16), nullable=True)
+    # Папка файла (None — корень); перенос меняет только это поле
+    folder_id = db.Column(db.Integer, db.ForeignKey("folder.id"), nullable=True)
+    # Что нашла проверка хранилища (flask scrub): None — в порядке,
+    # "missing" — содержимого нет на диске, "corrupt" — не совпал хеш
+    content_status = db.Column(db.String(16), nullable=True)
+    # Номер текущей версии и манифест её содержимого — JSON-список
+    # [SHA-256 блока, размер] (nestcloud.chunking); None — ещё не строился
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    manifest = db.deferred(db.Column(db.Text, nullable=True))
+    # Когда файл перенесён в корзину (None — не в корзине) и с какого момента
+    # его можно окончательно удалить (flask purge-trash)
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    purge_at = db.Column(db.DateTime, nullable=True)
+    # Предыдущие версии удаляются вместе с файлом явно (files.purge_file_records)
+    versions = db.relationship(
+        "FileVersion",
+        backref="file",
+        lazy=True,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+        order_by="FileVersion.number",
+    )
+
+    # Индексы под сортировки списка файлов (keyset-пагинация по полю и id).
+    # Частичные: в них только файлы вне корзины, поэтому файлы в корзине
+    # не замедляют списки
+    __table_args__ = (
+        db.Index("ix_file_live_upload_time", "user_id", "upload_time", "id", **LIVE),
+        db.Index("ix_file_live_filename", "user_id", "filename", "id", **LIVE),
+        db.Index("ix_file_live_size_bytes", "user_id", "size_bytes", "id", **LIVE),
+        db.Index("ix_file_user_dedup", "user_id", "size_bytes", "sample_hash"),
+        db.Index("ix_file_live_category", "user_id", "category", "id", **LIVE),
+        # Те же сортировки внутри одной папки
+        db.Index("ix_file_live_folder_upload_time", "user_id", "folder_id", "upload_time", "id", **LIVE),
+        db.Index("ix_file_live_folder_filename", "user_id", "folder_id", "filename", "id", **LIVE),
+        db.Index("ix_file_live_folder_size_bytes", "user_id", "folder_id", "size_bytes", "id", **LIVE),
+        # Корзина пользователя и очередь окончательного удаления
+        db.Index("ix_file_trash", "user_id", "deleted_at", "id", **TRASHED),
+        db.Index("ix_file_purge_at", "purge_at", **TRASHED),
+    )
 
     def __repr__(self):
         return "<File %r>" % self.id
 
 
-@manager.user_loader
-def load_user(user_id):
-    return User.query.get(user_id)
+class Folder(db.Model):
+    """
+    Папка пользователя. path — материализованный путь из id предков и самой
+    папки ("/3/17/"): поддерево выбирается диапазоном по индексу (user_id, path).
+    Файлы ссылаются на папку по folder_id, поэтому перенос и переименование
+    папки меняют только строки папок, а не файлы (ни в БД, ни на диске).
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey("folder.id"), nullable=True)
+    name = db.Column(db.String(255), nullable=False)
+    # Пути сравниваются побайтово (folders.subtree_filter): в PostgreSQL — collation "C"
+    path = db.Column(
+        db.String(1024).with_variant(db.String(1024, collation="C"), "postgresql"),
+        nullable=False,
+        default="",
+    )
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index("ix_folder_user_parent_name", "user_id", "parent_id", "name"),
+        db.Index("ix_folder_user_path", "user_id", "path"),
+    )
+
+    def __repr__(self):
+        return "<Folder %r>" % self.id
+
+
+class FileVersion(db.Model):
+    """
+    Предыдущая версия файла: содержимое, которое запись File хранила
+    до загрузки новой версии. Удаляется по сроку хранения (VERSION_KEEP_*)
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey("file.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    # Содержимое — как у File: stored_filename или blob_hash, сжатие
+    stored_filename = db.Column(db.String(255), nullable=False)
+    blob_hash = db.Column(db.String(64), db.ForeignKey("blob.hash"), nullable=True)
+    size_bytes = db.Column(db.BigInteger, nullable=True)
+    stored_size = db.Column(db.BigInteger, nullable=True)
+    encoding = db.Column(db.String(16), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    manifest = db.deferred(db.Column(db.Text, nullable=True))
+    content_status = db.Column(db.String(16), nullable=True)
+    # Когда версия была загружена и когда её заменила следующая
+    created_at = db.Column(db.DateTime, nullable=True)
+    replaced_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint("file_id", "number"),
+        db.Index("ix_file_version_replaced_at", "replaced_at"),
+    )
+
+    def __repr__(self):
+        return "<FileVersion %r:%r>" % (self.file_id, self.number)
+
+
+class Blob(db.Model):
+    """Содержимое файла в хранилище с адресацией по SHA-256.
+    Один блоб может использоваться многими записями File"""
+
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return "<Blob %r>" % self.hash
+
+
+class UploadSession(db.Model):
+    """Сессия загрузки файла по частям (чанкам)"""
+
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    stored_filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    # Загрузка новой версии файла file_id: чанки — блоки манифеста
+    # (JSON-список [SHA-256, размер]) переменного размера
+    file_id = db.Column(db.Integer, db.ForeignKey("file.id"), nullable=True)
+    manifest = db.Column(db.Text, nullable=True)
+    # Папка, в которую попадёт новый файл
+    folder_id = db.Column(db.Integer, db.ForeignKey("folder.id"), nullable=True)
+    chunks = db.relationship(
+        "UploadChunk", backref="session", lazy=True, cascade="all, delete-orphan"
+    )
+
+    @cached_property
+    def manifest_entries(self):
+        return json.loads(self.manifest) if self.manifest else None
+
+    @cached_property
+    def manifest_offsets(self):
+        offsets = [0]
+        for _, size in self.manifest_entries or []:
+            offsets.append(offsets[-1] + size)
+        return offsets
+
+    @property
+    def chunk_count(self):
+        if self.manifest_entries is not None:
+            return len(self.manifest_entries)
+        return max(1, -(-self.total_size // self.chunk_size))
+
+    def chunk_offset(self, index):
+        if self.manifest_entries is not None:
+            return self.manifest_offsets[index]
+        return index * self.chunk_size
+
+    def chunk_length(self, index):
+        """Ожидаемый размер чанка с данным номером (последний может быть короче)"""
+        if self.manifest_entries is not None:
+            return self.manifest_entries[index][1]
+        offset = index * self.chunk_size
+        return min(self.chunk_size, self.total_size - offset)
+
+    def __repr__(self):
+        return "<UploadSession %r>" % self.id
+
+
+class UploadChunk(db.Model):
+    """Полученный чанк сессии загрузки; отдельная строка на чанк,
+    чтобы параллельные PUT-запросы не конфликтовали за одну запись"""
+
+    session_id = db.Column(
+        db.String(32), db.ForeignKey("upload_session.id"), primary_key=True
+    )
+    index = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    def __repr__(self):
+        return "<UploadChunk %r:%r>" % (self.session_id, self.index)
+
+
+class PreviewJob(db.Model):
+    """Задание очереди построения превью (обрабатывается flask preview-worker)"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(
+        db.Integer, db.ForeignKey("file.id"), nullable=False, unique=True
+    )
+    # pending — ждёт обработчика, running — взято обработчиком claimed_by
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    file = db.relationship(
+        "File", backref=db.backref("preview_job", uselist=False, cascade="all, delete-orphan")
+    )
+
+    __table_args__ = (db.Index("ix_preview_job_status_id", "status", "id"),)
+
+    def __repr__(self):
+        return "<PreviewJob %r>" % self.id
+
+
+class ScrubState(db.Model):
+    """
+    Состояние проверки хранилища (flask scrub) по этапам: files, versions, disk.
+    Курсор сохраняется после каждой пачки, поэтому прерванный проход продолжается.
+    """
+
+    phase = db.Column(db.String(16), primary_key=True)
+    # Позиция в текущем проходе (id записи или путь на диске); None — проход не начат
+    cursor = db.Column(db.Text, nullable=True)
+    pass_started_at = db.Column(db.DateTime, nullable=True)
+    last_pass_finished_at = db.Column(db.DateTime, nullable=True)
+    # Найденное в текущем и в последнем завершённом проходе: JSON {вид: число}
+    current_stats = db.Column(db.Text, nullable=True)
+    last_stats = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return "<ScrubState %r>" % self.phase
+
+
+class FileChange(db.Model):
+    """
+    Журнал изменений файлов пользователя для синхронизации клиентов.
+    seq монотонно растёт (AUTOINCREMENT не переиспользует номера),
+    клиент запрашивает изменения после последнего известного ему seq.
+    """
+
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    # id файла без внешнего ключа: запись остаётся и после удаления файла
+    file_id = db.Column(db.Integer, nullable=False)
+    # created / updated / deleted (перенос в корзину — deleted,
+    # восстановление из неё — created)
+    op = db.Column(db.String(16), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index("ix_file_change_user_seq", "user_id", "seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+    def __repr__(self):
+        return "<FileChange %r>" % self.seq
+
+
+def record_file_change(connection, target, op):
+    """Пишет изменение в журнал в той же транзакции, что и само изменение"""
+    connection.execute(
+        insert(FileChange).values(
+            user_id=target.user_id,
+            file_id=target.id,
+            op=op,
+            changed_at=datetime.now(),
+        )
+    )
+
+
+def record_file_changes(connection, condition, op):
+    """Пишет в журнал изменение всех файлов, подходящих под условие, — одним запросом"""
+    connection.execute(
+        insert(FileChange).from_select(
+            ["user_id", "file_id", "op", "changed_at"],
+            select(
+                File.user_id,
+                File.id,
+                literal(op, db.String),
+                literal(datetime.now(), db.DateTime),
+            )
+            .where(condition)
+            .order_by(File.id),
+        )
+    )
+
+
+def update_user_usage(connection, user_id, delta_bytes, delta_count):
+    """Сдвигает счётчики пользователя атомарным UPDATE в текущей транзакции"""
+    if not delta_bytes and not delta_count:
+        return
+    connection.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(
+            used_bytes=User.used_bytes + delta_bytes,
+            file_count=User.file_count + delta_count,
+        )
+    )
+
+
+@event.listens_for(File, "after_insert")
+def file_created(mapper, connection, target):
+    record_file_change(connection, target, "created")
+    update_user_usage(connection, target.user_id, target.size_bytes or 0, 1)
+
+
+@event.listens_for(File, "after_update")
+def file_updated(mapper, connection, target):
+    if db.session.is_modified(target, include_collections=False):
+        record_file_change(connection, target, "updated")
+    history = inspect(target).attrs.size_bytes.history
+    if history.has_changes():
+        old_size = (history.deleted or [None])[0] or 0
+        delta = (target.size_bytes or 0) - old_size
+        update_user_usage(connection, target.user_id, delta, 0)
+
+
+@event.listens_for(File, "after_delete")
+def file_deleted(mapper, connection, target):
+    if target.deleted_at is None:
+        record_file_change(connection, target, "deleted")
+        update_user_usage(connection, target.user_id, -(target.size_bytes or 0), -1)
+    else:
+        # Файл из корзины уже удалён для клиентов и не входит в число файлов
+        update_user_usage(connection, target.user_id, -(target.size_bytes or 0), 0)
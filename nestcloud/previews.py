@@ -0,0 +1,177 @@
+"""
+Фоновое построение превью изображений.
+
+Загрузка только ставит задание в очередь (таблица preview_job), а превью
+строит отдельный процесс `flask preview-worker` с пулом процессов.
+Задания, взятые обработчиком и не завершённые (например, после падения),
+по истечении PREVIEW_JOB_TIMEOUT возвращаются в очередь.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import logging
+import os
+import time
+import uuid
+
+import click
+from flask import jsonify, request
+from flask_login import login_required, current_user
+from sqlalchemy import func, select, update
+
+from nestcloud import app, db, storage
+from nestcloud.metrics import REGISTRY, CallbackGauge
+from nestcloud.models import File, PreviewJob
+from utils import generate_image_preview, get_file_icon
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_preview(file_record):
+    """Ставит построение превью в очередь (коммит остаётся за вызывающим кодом)"""
+    if file_record.preview_status == "pending":
+        db.session.add(PreviewJob(file=file_record))
+
+
+def count_preview_jobs():
+    """Задания в очереди по статусу (обработчик — отдельный процесс, поэтому из БД)"""
+    counts = {("pending",): 0, ("running",): 0}
+    rows = db.session.execute(
+        select(PreviewJob.status, func.count()).group_by(PreviewJob.status)
+    )
+    for status, count in rows:
+        counts[(status,)] = count
+    return counts
+
+
+REGISTRY.append(
+    CallbackGauge(
+        "nestcloud_preview_jobs",
+        "Задания построения превью в очереди",
+        ("status",),
+        count_preview_jobs,
+    )
+)
+
+
+def requeue_stale_jobs():
+    """Возвращает в очередь задания, обработчик которых завис или упал"""
+    deadline = datetime.now() - timedelta(seconds=app.config["PREVIEW_JOB_TIMEOUT"])
+    result = db.session.execute(
+        update(PreviewJob)
+        .where(PreviewJob.status == "running", PreviewJob.claimed_at < deadline)
+        .values(status="pending", claimed_by=None, claimed_at=None)
+    )
+    db.session.commit()
+    if result.rowcount:
+        logger.warning("Возвращено в очередь зависших заданий: %d", result.rowcount)
+
+
+def claim_jobs(limit):
+    """Атомарно забирает до limit заданий (безопасно при нескольких обработчиках)"""
+    token = uuid.uuid4().hex
+    pending_ids = (
+        select(PreviewJob.id)
+        .where(PreviewJob.status == "pending")
+        .order_by(PreviewJob.id)
+        .limit(limit)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        update(PreviewJob)
+        .where(PreviewJob.id.in_(pending_ids), PreviewJob.status == "pending")
+        .values(
+            status="running",
+            claimed_by=token,
+            claimed_at=datetime.now(),
+            attempts=PreviewJob.attempts + 1,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return PreviewJob.query.filter_by(claimed_by=token).all()
+
+
+def finish_job(job, preview_absolute, error=None):
+    """Записывает результат задания в File и убирает задание из очереди"""
+    file_record = job.file
+    user_folder = storage.get_user_root(file_record.user_id)
+
+    if preview_absolute:
+        file_record.preview_path = os.path.relpath(preview_absolute, user_folder).replace(
+            os.sep, "/"
+        )
+        file_record.preview_status = "ready"
+        db.session.delete(job)
+    elif job.attempts >= app.config["PREVIEW_MAX_ATTEMPTS"]:
+        # Превью построить не удалось — показываем обычную иконку
+        file_record.preview_path = get_file_icon(file_record.filename)
+        file_record.preview_status = "failed"
+        db.session.delete(job)
+        logger.warning("Превью для файла %s не построено: %s", file_record.id, error)
+    else:
+        job.status = "pending"
+        job.claimed_by = None
+        job.claimed_at = None
+        job.last_error = error
+    db.session.commit()
+
+
+def process_batch(pool, batch_size):
+    """Обрабатывает одну пачку заданий; возвращает число взятых заданий"""
+    jobs = claim_jobs(batch_size)
+    futures = {}
+    for job in jobs:
+        file_record = job.file
+        source_path = storage.get_file_path(file_record)
+        future = pool.submit(
+            generate_image_preview,
+            source_path,
+            output_dir=storage.get_preview_dir(file_record.user_id, source_path),
+        )
+        futures[future] = job
+
+    for future in as_completed(futures):
+        job = futures[future]
+        try:
+            finish_job(job, future.result())
+        except Exception as e:
+            db.session.rollback()
+            finish_job(job, None, error=str(e))
+    return len(jobs)
+
+
+@app.cli.command("preview-worker")
+@click.option("--processes", default=os.cpu_count() or 1, show_default=True)
+@click.option("--batch-size", default=16, show_default=True)
+@click.option("--poll-interval", default=1.0, show_default=True)
+@click.option("--once", is_flag=True, help="Обработать очередь и завершиться")
+def preview_worker(processes, batch_size, poll_interval, once):
+    """Строит превью изображений из очереди в пуле процессов"""
+    logger.info("Обработчик превью запущен, процессов: %d", processes)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while True:
+            requeue_stale_jobs()
+            processed = process_batch(pool, batch_size)
+            if processed:
+                continue
+            if once:
+                break
+            time.sleep(poll_interval)
+
+
+@app.route("/preview/status")
+@login_required
+def preview_status():
+    """Статусы превью для списка файлов (?ids=1,2,3) — для замены заглушек на странице"""
+    try:
+        ids = [int(i) for i in request.args.get("ids", "").split(",") if i]
+    except ValueError:
+        return jsonify(error="Неверный список файлов"), 400
+
+    rows = (
+        db.session.query(File.id, File.preview_status)
+        .filter(File.user_id == current_user.id, File.id.in_(ids[:500]))
+        .all()
+    )
+    return jsonify({str(file_id): status or "ready" for file_id, status in rows})
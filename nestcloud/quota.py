@@ -0,0 +1,80 @@
+"""
+Квоты на занятое место.
+
+Занятое место берётся из счётчика User.used_bytes (без обхода файлов).
+Загрузка отклоняется ещё до чтения тела — по заявленному Content-Length
+(для сессий загрузки по частям — по заявленному размеру файла).
+"""
+
+import logging
+
+from flask import flash, jsonify, redirect, request, url_for
+from flask_login import current_user
+
+from nestcloud import app, db
+from utils import get_human_readable_size
+
+logger = logging.getLogger(__name__)
+
+# Обычные загрузки, которые проверяются по Content-Length запроса
+QUOTA_CHECKED_ENDPOINTS = {"upload_file", "api_upload_file"}
+
+
+def get_quota(user):
+    """Квота пользователя в байтах или None, если место не ограничено"""
+    quota = user.quota_bytes
+    if quota is None:
+        quota = app.config["USER_QUOTA_BYTES"]
+    return quota or None
+
+
+def refresh_usage(user):
+    """Свежие значения счётчиков (объект пользователя может быть взят из кеша)"""
+    db.session.refresh(user, ["used_bytes", "file_count", "quota_bytes"])
+
+
+def fits_quota(user, incoming_bytes) -> bool:
+    """Поместятся ли ещё incoming_bytes байт"""
+    refresh_usage(user)
+    quota = get_quota(user)
+    return quota is None or user.used_bytes + incoming_bytes <= quota
+
+
+def get_usage(user) -> dict:
+    refresh_usage(user)
+    quota = get_quota(user)
+    return {
+        "used_bytes": user.used_bytes,
+        "used_human": get_human_readable_size(user.used_bytes),
+        "file_count": user.file_count,
+        "quota_bytes": quota,
+        "quota_human": get_human_readable_size(quota) if quota else None,
+        "percent": min(100, round(user.used_bytes * 100 / quota)) if quota else None,
+    }
+
+
+def quota_exceeded_response():
+    message = "Недостаточно места: квота хранилища исчерпана"
+    if request.path.startswith("/api/") or (
+        request.accept_mimetypes.best == "application/json"
+    ):
+        return jsonify(error=message), 413
+    flash(message, "danger")
+    return redirect(url_for("home"))
+
+
+@app.before_request
+def enforce_upload_quota():
+    """Отклоняет загрузку, если заявленный размер запроса не помещается в квоту"""
+    if request.endpoint not in QUOTA_CHECKED_ENDPOINTS:
+        return None
+    if not current_user.is_authenticated or not request.content_length:
+        return None
+    if not fits_quota(current_user, request.content_length):
+        logger.info(
+            "Загрузка отклонена по квоте: пользователь %s, %d байт",
+            current_user.id,
+            request.content_length,
+        )
+        return quota_exceeded_response()
+    return None
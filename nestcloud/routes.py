@@ -8,15 +8,61 @@ from flask import (
     send_from_directory,
     send_file,
     abort,
+    jsonify,
 )
-from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.exceptions import RequestEntityTooLarge, MethodNotAllowed
+from werkzeug.exceptions import RequestEntityTooLarge, MethodNotAllowed, HTTPException
+import logging
 from flask_login import login_user, logout_user, login_required, current_user
-from nestcloud import db, app
-from nestcloud.models import User, File
+from nestcloud import db, app, storage, listing, quota, folders
+from nestcloud.transfer import (
+    send_stored_file,
+    send_zip,
+    guess_mimetype,
+    set_cache_headers,
+)
+from nestcloud.files import (
+    get_own_file,
+    get_own_files,
+    get_preview_max_age,
+    parse_file_ids,
+    create_uploaded_files,
+    prepare_new_filename,
+    trash_files,
+)
+from nestcloud.metrics import timed
+from nestcloud.models import File, User
+from nestcloud.security import authenticate, hash_password
 from forms import UploadForm
+import base64
+import hashlib
 import os
-from utils import save_file
+from utils import is_compressed_format, FILE_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+# Типы, которые можно открывать в браузере без риска выполнения скриптов
+INLINE_MIMETYPE_PREFIXES = (
+    "video/",
+    "audio/",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+    "image/gif",
+)
+
+
+# Иконки типов файлов страница берёт напрямую из static (без авторизации и БД),
+# поэтому им нужен срок кеширования, отличный от остальной статики
+default_send_file_max_age = app.get_send_file_max_age
+
+
+def get_send_file_max_age(filename):
+    if filename and filename.startswith("file_icons/"):
+        return app.config["ICON_MAX_AGE"]
+    return default_send_file_max_age(filename)
+
+
+app.get_send_file_max_age = get_send_file_max_age
 
 
 def truncate_filename(filename, max_length=15):
@@ -37,68 +83,137 @@ def root():
     return redirect("/home")
 
 
+def get_listing_folder_id(folder, search_text, category):
+    """Поиск и фильтр по типу идут по всем папкам, иначе показывается одна папка"""
+    if search_text or category:
+        return listing.ALL_FOLDERS
+    return folder.id if folder else None
+
+
+def redirect_to_folder(folder_id):
+    return redirect(url_for("home", folder=folder_id))
+
+
 @app.route("/home")
 def home():
     if current_user.is_authenticated:
-        user_files = (
-            File.query.filter_by(user_id=current_user.id)
-            .order_by(File.upload_time.desc())
-            .all()
+        sort = listing.normalize_sort(request.args.get("sort"))
+        search_text = request.args.get("q", "").strip()
+        category = listing.normalize_category(request.args.get("type"))
+        folder = folders.get_target_folder(request.args.get("folder"))
+        folder_id = get_listing_folder_id(folder, search_text, category)
+        user_files, next_cursor = listing.list_files_page(
+            current_user.id,
+            sort,
+            search_text=search_text,
+            category=category,
+            folder_id=folder_id,
         )
+        subfolders = []
+        if folder_id != listing.ALL_FOLDERS:
+            subfolders = folders.list_subfolders(current_user.id, folder_id)
         form = UploadForm()  # Создаём форму
+        # get_usage обновляет счётчики — число файлов берётся из них
+        usage = quota.get_usage(current_user)
         return render_template(
-            "home.html", files=user_files, form=form
+            "home.html",
+            files=user_files,
+            form=form,
+            sort=sort,
+            sort_labels=listing.SORT_LABELS,
+            search_text=search_text,
+            category=category,
+            categories=FILE_CATEGORIES,
+            next_cursor=next_cursor,
+            total_files=usage["file_count"],
+            usage=usage,
+            folder=folder,
+            subfolders=subfolders,
+            breadcrumbs=folders.get_breadcrumbs(folder),
         )  # Передаём form
     return render_template("home.html")
 
 
+@app.route("/files/page")
+@login_required
+def files_page():
+    """Следующая страница списка файлов (для бесконечной прокрутки)"""
+    sort = listing.normalize_sort(request.args.get("sort"))
+    search_text = request.args.get("q", "").strip()
+    category = listing.normalize_category(request.args.get("type"))
+    folder = folders.get_target_folder(request.args.get("folder"))
+    user_files, next_cursor = listing.list_files_page(
+        current_user.id,
+        sort,
+        request.args.get("cursor"),
+        search_text=search_text,
+        category=category,
+        folder_id=get_listing_folder_id(folder, search_text, category),
+    )
+    return jsonify(
+        html=render_template("_file_rows.html", files=user_files),
+        next_cursor=next_cursor,
+    )
+
+
 @app.route("/upload", methods=["POST"])
 @login_required
 def upload_file():
-    print("\n" + "=" * 50)
-    print("ЗАГРУЗКА ФАЙЛА ЧЕРЕЗ ФОРМУ")
+    # Тело multipart читается и разбирается при первом обращении к request.files
+    with timed("receive_body"):
+        request.files
 
     form = UploadForm()
     if not form.validate_on_submit():
-        print("Валидация формы провалена")
         for error in form.file.errors:
-            print(f"   • {error}")
+            logger.info("Загрузка отклонена формой: %s", error)
             flash(error, "danger")
         return redirect(url_for("home"))
 
-    file = form.file.data
-    print(f"Получен файл: {file.filename}")
+    files = form.file.data
+    wants_json = request.accept_mimetypes.best == "application/json"
+    folder = folders.get_target_folder(request.form.get("folder_id"))
+    folder_id = folder.id if folder else None
 
     try:
-        saved_data = save_file(file, current_user.id)
-        print(f"   → Данные для БД: preview_path = {saved_data.get('preview_relpath')}")
-
-        new_file = File(
-            filename=saved_data["original_filename"],
-            stored_filename=saved_data["stored_filename"],
-            user_id=current_user.id,
-            file_size=saved_data["human_size"],
-            upload_time=saved_data["upload_time"],
-            preview_path=saved_data["preview_relpath"],
+        results = create_uploaded_files(files, current_user.id, folder_id)
+    except Exception:
+        logger.exception("Ошибка при загрузке файлов через форму")
+        if wants_json:
+            return jsonify(error="Ошибка при загрузке файлов"), 500
+        flash("Ошибка при загрузке файлов", "danger")
+        return redirect_to_folder(folder_id)
+
+    uploaded = [r for r in results if "file" in r]
+    failed = [r for r in results if "error" in r]
+    logger.info(
+        "Загрузка через форму: пользователь %s, загружено %d, с ошибками %d",
+        current_user.id,
+        len(uploaded),
+        len(failed),
+    )
+
+    # Загрузка из JS (fetch) — результат по каждому файлу в JSON
+    if wants_json:
+        return jsonify(
+            results=[
+                {"filename": r["filename"], "id": r["file"].id}
+                if "file" in r
+                else {"filename": r["filename"], "error": "Ошибка при загрузке файла"}
+                for r in results
+            ]
         )
-        db.session.add(new_file)
-        db.session.commit()
 
-        print(
-            f"Файл успешно загружен и сохранён в БД (preview_path: {new_file.preview_path})"
-        )
-        truncated_name = truncate_filename(saved_data["original_filename"])
+    if len(uploaded) == 1 and not failed:
+        truncated_name = truncate_filename(uploaded[0]["filename"])
         flash(f"Файл '{truncated_name}' загружен!", "success")
-
-    except Exception as e:
-        print(f"ОШИБКА: {str(e)}")
-        import traceback
-
-        traceback.print_exc()
-        flash("Ошибка при загрузке файла", "danger")
-
-    print("=" * 50 + "\n")
-    return redirect(url_for("home"))
+    elif uploaded:
+        flash(f"Загружено файлов: {len(uploaded)}", "success")
+    for r in failed:
+        flash(
+            f"Ошибка при загрузке файла '{truncate_filename(r['filename'])}'", "danger"
+        )
+    return redirect_to_folder(folder_id)
 
 
 @app.route("/register", methods=["POST", "GET"])
@@ -115,20 +230,19 @@ def register():
                 flash("Пользователь с данным логином уже существует!")
                 return render_template("register.html")
             else:
-                print(login, password)
-                hash_pwd = generate_password_hash(password)
+                logger.info("Регистрация пользователя %s", login)
+                hash_pwd = hash_password(password)
                 new_user = User(login=login, password=hash_pwd)
                 db.session.add(new_user)
                 db.session.commit()
         # === СОЗДАЁМ ПАПКУ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===
         try:
-            user_folder = os.path.join(app.config["UPLOAD_FOLDER"], f"{new_user.id}")
+            user_folder = storage.get_user_root(new_user.id)
             os.makedirs(
                 user_folder, exist_ok=True
             )  # exist_ok=True предотвратит ошибку, если папка уже есть
-            print(f"Папка создана: {user_folder}")
-        except Exception as e:
-            print(f"Ошибка создания папки: {str(e)}")
+        except Exception:
+            logger.exception("Ошибка создания папки пользователя %s", new_user.id)
 
         return redirect(url_for("login_page"))
     return render_template("register.html")
@@ -144,8 +258,8 @@ def login_page():
             flash("Пожалуйста, заполните все поля!")
             return render_template("login.html")
         else:
-            user = User.query.filter_by(login=login).first()
-            if user and check_password_hash(user.password, password):
+            user = authenticate(login, password)
+            if user:
                 login_user(user)
                 return redirect(url_for("home"))
             else:
@@ -164,61 +278,116 @@ def logout():
 @app.route("/preview/<int:file_id>")
 @login_required
 def preview_file(file_id):
-    file_record = File.query.get_or_404(file_id)
-    if file_record.user_id != current_user.id:
-        abort(403)
+    file_record = get_own_file(file_id)
 
     if not file_record.preview_path:
         abort(404)
 
+    max_age = get_preview_max_age(file_record)
     # Если preview_path начинается с "file_icons/", это статическая иконка
     if file_record.preview_path.startswith("file_icons/"):
-        return send_from_directory("static", file_record.preview_path)
+        # Иконка может смениться с обновлением приложения — не дольше ICON_MAX_AGE
+        rv = send_from_directory(
+            "static",
+            file_record.preview_path,
+            max_age=min(max_age or 0, app.config["ICON_MAX_AGE"]),
+        )
+        if not max_age:
+            rv.cache_control.no_cache = True
+        return rv
 
     # Иначе это сгенерированное превью в папке пользователя
-    user_folder = os.path.join(app.config["UPLOAD_FOLDER"], f"{file_record.user_id}")
-    preview_full_path = os.path.join(user_folder, file_record.preview_path)
+    preview_full_path = storage.get_preview_path(file_record)
 
     if not os.path.exists(preview_full_path):
         abort(404)
 
-    directory, filename = os.path.split(preview_full_path)
-    return send_from_directory(directory, filename)
+    # Превью одной версии строится один раз — по адресу с версией кешируется надолго
+    return send_stored_file(
+        preview_full_path,
+        download_name=os.path.basename(preview_full_path),
+        etag=storage.get_content_etag(file_record) + "-preview",
+        as_attachment=False,
+        mimetype="image/jpeg",
+        max_age=max_age,
+        immutable=bool(max_age),
+    )
+
+
+@app.route("/preview/batch")
+@login_required
+def preview_batch():
+    """
+    Превью для страницы списка одним ответом: {id: data:-URI превью или URL иконки}.
+    Права проверяются одним запросом; ответ кешируется браузером с проверкой ETag.
+    """
+    file_ids = parse_file_ids(request.args.getlist("ids"))
+    file_records = get_own_files(file_ids[: app.config["PREVIEW_BATCH_MAX"]])
+
+    # ETag по содержимому всех превью пачки — до чтения файлов с диска
+    etag_source = "|".join(
+        f"{f.id}:{f.preview_status}:{f.preview_path}:{storage.get_content_etag(f)}"
+        for f in file_records
+    )
+    etag = hashlib.sha1(etag_source.encode("utf-8")).hexdigest()
+    if request.if_none_match.contains(etag):
+        return set_cache_headers(
+            app.response_class(status=304), etag, None, None, False
+        )
+
+    previews = {}
+    for file_record in file_records:
+        preview = None
+        if file_record.preview_status == "pending" or not file_record.preview_path:
+            pass
+        elif file_record.preview_path.startswith("file_icons/"):
+            preview = url_for("static", filename=file_record.preview_path)
+        else:
+            try:
+                with open(storage.get_preview_path(file_record), "rb") as f:
+                    encoded = base64.b64encode(f.read()).decode("ascii")
+                preview = "data:image/jpeg;base64," + encoded
+            except OSError:
+                logger.warning("Превью не найдено: %s", file_record.preview_path)
+        previews[str(file_record.id)] = preview
+
+    return set_cache_headers(jsonify(previews), etag, None, None, False)
 
 
 @app.route("/download/<int:file_id>")
 @login_required
 def download_file(file_id):
-    """Скачивает файл с оригинальным именем"""
-    file_record = File.query.get_or_404(file_id)
-
-    # Проверяем, что файл принадлежит текущему пользователю
-    if file_record.user_id != current_user.id:
-        abort(403)
+    """Скачивает файл с оригинальным именем (поддерживаются Range и условные запросы)"""
+    file_record = get_own_file(file_id)
 
     try:
-        user_folder = os.path.join(
-            app.config["UPLOAD_FOLDER"], f"{file_record.user_id}"
-        )
-        file_path = os.path.join(user_folder, file_record.stored_filename)
+        file_path = storage.get_file_path(file_record)
 
         if not os.path.exists(file_path):
             flash("Файл не найден на сервере", "danger")
             return redirect(url_for("home"))
 
-        # Отправляем файл с оригинальным именем
-        return send_file(
+        # Отправляем файл с оригинальным именем; ?inline=1 — для просмотра
+        # и перемотки видео/аудио прямо в браузере
+        mimetype = guess_mimetype(file_record.filename)
+        inline = request.args.get("inline") == "1" and mimetype.startswith(
+            INLINE_MIMETYPE_PREFIXES
+        )
+        return send_stored_file(
             file_path,
-            as_attachment=True,
             download_name=file_record.filename,
-            mimetype="application/octet-stream",
+            etag=storage.get_content_etag(file_record),
+            last_modified=file_record.upload_time,
+            as_attachment=not inline,
+            mimetype=mimetype,
+            encoding=file_record.encoding,
+            size=file_record.size_bytes,
         )
 
-    except Exception as e:
-        print(f"ОШИБКА при скачивании файла: {str(e)}")
-        import traceback
-
-        traceback.print_exc()
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Ошибка при скачивании файла %s", file_id)
         flash("Ошибка при скачивании файла", "danger")
         return redirect(url_for("home"))
 
@@ -226,87 +395,83 @@ def download_file(file_id):
 @app.route("/delete/<int:file_id>", methods=["POST"])
 @login_required
 def delete_file(file_id):
-    """Удаляет файл, его превью и запись из БД"""
-    file_record = File.query.get_or_404(file_id)
-
-    # Проверяем, что файл принадлежит текущему пользователю
-    if file_record.user_id != current_user.id:
-        abort(403)
+    """Переносит файл в корзину (меняется только запись в БД)"""
+    file_record = get_own_file(file_id)
 
     try:
-        user_folder = os.path.join(
-            app.config["UPLOAD_FOLDER"], f"{file_record.user_id}"
-        )
-
-        # Удаляем основной файл
-        file_path = os.path.join(user_folder, file_record.stored_filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"Файл удалён: {file_path}")
-
-        # Удаляем превью, если оно есть
-        if file_record.preview_path:
-            preview_full_path = os.path.join(user_folder, file_record.preview_path)
-            if os.path.exists(preview_full_path):
-                os.remove(preview_full_path)
-                print(f"Превью удалено: {preview_full_path}")
-
-        # Удаляем запись из БД
         filename = file_record.filename
-        db.session.delete(file_record)
+        trash_files(current_user.id, File.id == file_record.id)
         db.session.commit()
 
         truncated_name = truncate_filename(filename)
-        flash(f"Файл '{truncated_name}' успешно удалён", "success")
-        print(f"Запись из БД удалена для файла: {filename}")
+        flash(f"Файл '{truncated_name}' перемещён в корзину", "success")
 
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"ОШИБКА при удалении файла: {str(e)}")
-        import traceback
-
-        traceback.print_exc()
+        logger.exception("Ошибка при удалении файла %s", file_id)
         flash("Ошибка при удалении файла", "danger")
 
     return redirect(url_for("home"))
 
 
-@app.route("/rename/<int:file_id>", methods=["POST"])
+@app.route("/download/bulk", methods=["POST"])
 @login_required
-def rename_file(file_id):
-    """Переименовывает файл (изменяет только имя в БД, физический файл не переименовывается)"""
-    file_record = File.query.get_or_404(file_id)
+def download_files_bulk():
+    """Скачивает выбранные файлы одним ZIP-архивом, который собирается по мере отдачи"""
+    file_records = get_own_files(parse_file_ids(request.form.getlist("file_ids")))
+    if not file_records:
+        flash("Не выбрано ни одного файла", "danger")
+        return redirect(url_for("home"))
 
-    # Проверяем, что файл принадлежит текущему пользователю
-    if file_record.user_id != current_user.id:
-        abort(403)
+    # Пути и имена собираем заранее: генератор работает уже после закрытия сессии БД
+    entries = [
+        (
+            f.filename,
+            storage.get_file_path(f),
+            f.upload_time,
+            not is_compressed_format(f.filename),
+            f.encoding,
+            f.size_bytes,
+        )
+        for f in file_records
+    ]
+    logger.info("Архив из %d файлов для пользователя %s", len(entries), current_user.id)
+    return send_zip(entries, "NestCloud.zip")
 
-    new_filename = request.form.get("new_filename", "").strip()
 
-    if not new_filename:
-        flash("Имя файла не может быть пустым", "danger")
+@app.route("/delete/bulk", methods=["POST"])
+@login_required
+def delete_files_bulk():
+    """Переносит выбранные файлы в корзину одним запросом"""
+    file_ids = parse_file_ids(request.form.getlist("file_ids"))
+    if not file_ids:
+        flash("Не выбрано ни одного файла", "danger")
         return redirect(url_for("home"))
 
-    # Проверяем, что имя файла не содержит опасных символов
-    if any(
-        char in new_filename
-        for char in ["/", "\\", "..", "<", ">", ":", '"', "|", "?", "*"]
-    ):
-        flash("Имя файла содержит недопустимые символы", "danger")
-        return redirect(url_for("home"))
+    try:
+        trashed = trash_files(current_user.id, File.id.in_(file_ids))
+        db.session.commit()
+        flash(f"Перемещено в корзину файлов: {trashed}", "success")
+    except Exception:
+        db.session.rollback()
+        logger.exception("Ошибка при удалении файлов")
+        flash("Ошибка при удалении файлов", "danger")
 
-    # Получаем расширение оригинального файла
-    old_extension = ""
-    if "." in file_record.filename:
-        old_extension = "." + file_record.filename.rsplit(".", 1)[1]
+    return redirect(url_for("home"))
 
-    # Удаляем расширение из введенного имени (если есть)
-    if "." in new_filename:
-        new_filename = new_filename.rsplit(".", 1)[0]
 
-    # Всегда добавляем оригинальное расширение
-    if old_extension:
-        new_filename = new_filename + old_extension
+@app.route("/rename/<int:file_id>", methods=["POST"])
+@login_required
+def rename_file(file_id):
+    """Переименовывает файл (изменяет только имя в БД, физический файл не переименовывается)"""
+    file_record = get_own_file(file_id)
+
+    new_filename, error = prepare_new_filename(
+        file_record, request.form.get("new_filename", "")
+    )
+    if error:
+        flash(error, "danger")
+        return redirect(url_for("home"))
 
     try:
         old_filename = file_record.filename
@@ -314,14 +479,11 @@ def rename_file(file_id):
         db.session.commit()
 
         flash("Имя файла изменено", "success")
-        print(f"Файл переименован: {old_filename} -> {new_filename}")
+        logger.info("Файл переименован: %s -> %s", old_filename, new_filename)
 
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"ОШИБКА при переименовании файла: {str(e)}")
-        import traceback
-
-        traceback.print_exc()
+        logger.exception("Ошибка при переименовании файла %s", file_id)
         flash("Ошибка при переименовании файла", "danger")
 
     return redirect(url_for("home"))
@@ -342,3 +504,64 @@ def handle_method_not_allowed(e):
 @app.route("/about")
 def about_page():
     return render_template("about.html")
+
+
+@app.route("/folders", methods=["POST"])
+@login_required
+def create_folder():
+    """Создаёт папку внутри текущей папки"""
+    parent = folders.get_target_folder(request.form.get("parent_id"))
+    folder, error = folders.create_folder(current_user.id, request.form.get("name"), parent)
+    if error:
+        flash(error, "danger")
+    else:
+        db.session.commit()
+        flash(f"Папка '{truncate_filename(folder.name)}' создана", "success")
+    return redirect_to_folder(parent.id if parent else None)
+
+
+@app.route("/folders/<int:folder_id>/rename", methods=["POST"])
+@login_required
+def rename_folder(folder_id):
+    """Переименовывает папку (только запись в БД)"""
+    folder = folders.get_own_folder(folder_id)
+    error = folders.rename_folder(folder, request.form.get("name"))
+    if error:
+        flash(error, "danger")
+    else:
+        db.session.commit()
+        flash("Имя папки изменено", "success")
+    return redirect_to_folder(folder.parent_id)
+
+
+@app.route("/folders/<int:folder_id>/delete", methods=["POST"])
+@login_required
+def delete_folder(folder_id):
+    """Удаляет папку со всем содержимым"""
+    folder = folders.get_own_folder(folder_id)
+    parent_id = folder.parent_id
+    try:
+        trashed = folders.delete_folder(folder)
+        flash(f"Папка удалена, файлов перемещено в корзину: {trashed}", "success")
+    except Exception:
+        db.session.rollback()
+        logger.exception("Ошибка при удалении папки %s", folder_id)
+        flash("Ошибка при удалении папки", "danger")
+    return redirect_to_folder(parent_id)
+
+
+@app.route("/files/move", methods=["POST"])
+@login_required
+def move_files_bulk():
+    """Переносит выбранные файлы в другую папку (меняется только запись в БД)"""
+    target = folders.get_target_folder(request.form.get("folder_id"))
+    target_id = target.id if target else None
+    file_records = get_own_files(parse_file_ids(request.form.getlist("file_ids")))
+    if not file_records:
+        flash("Не выбрано ни одного файла", "danger")
+        return redirect_to_folder(target_id)
+
+    folders.move_files(file_records, target)
+    db.session.commit()
+    flash(f"Перенесено файлов: {len(file_records)}", "success")
+    return redirect_to_folder(target_id)
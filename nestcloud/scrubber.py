@@ -0,0 +1,464 @@
+"""
+Фоновая проверка хранилища (`flask scrub`).
+
+Проход состоит из трёх этапов, каждый идёт пачками и сохраняет курсор
+в таблице scrub_state, так что прерванную проверку можно продолжить:
+
+- files / versions — записи File и FileVersion по возрастанию id: есть ли
+  содержимое на диске и совпадает ли его SHA-256 с сохранённым хешем.
+  Результат записывается в content_status (None / "missing" / "corrupt").
+  Пропавшие превью изображений ставятся в очередь на построение заново.
+- disk — файлы в UPLOAD_FOLDER (папки пользователей и blobs/) в порядке
+  путей: файлы, на которые не ссылается ни одна запись (остались после
+  неудачного коммита или удаления), переносятся в карантин, удаляются
+  или только учитываются (SCRUB_ORPHAN_ACTION). Недавно изменённые файлы
+  не трогаются — их запись может быть ещё не закоммичена.
+
+Чтение с диска ограничено SCRUB_IO_BYTES_PER_SECOND. Итоги проходов
+отдаются в /metrics из БД (сканер — отдельный процесс).
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from itertools import islice
+
+import click
+from sqlalchemy import func, select, update
+
+from nestcloud import app, db, storage
+from nestcloud.metrics import REGISTRY, CallbackGauge
+from nestcloud.models import (
+    Blob,
+    File,
+    FileVersion,
+    PreviewJob,
+    ScrubState,
+    UploadSession,
+)
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("files", "versions", "disk")
+ORPHAN_ACTIONS = ("quarantine", "delete", "report")
+QUARANTINE_FOLDER = ".quarantine"
+# Во сколько байт бюджета обходится проверка одного файла без чтения (stat, запросы)
+STAT_COST = 4096
+
+
+class IOBudget:
+    """Ограничение скорости чтения: spend() ждёт, если прочитано больше, чем позволяет rate"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.spent = 0
+
+    def spend(self, amount):
+        if self.rate <= 0:
+            return
+        self.spent += amount
+        delay = self.spent / self.rate - (time.monotonic() - self.started)
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            # После простоя не копим запас — иначе следующий проход пойдёт рывком
+            self.reset()
+
+
+def get_state(phase):
+    state = db.session.get(ScrubState, phase)
+    if state is None:
+        state = ScrubState(phase=phase)
+        db.session.add(state)
+    if state.pass_started_at is None:
+        state.pass_started_at = datetime.now()
+    return state
+
+
+def add_stats(state, **found):
+    stats = json.loads(state.current_stats or "{}")
+    for kind, count in found.items():
+        if count:
+            stats[kind] = stats.get(kind, 0) + count
+    state.current_stats = json.dumps(stats, sort_keys=True)
+
+
+def finish_pass(state):
+    """Закрывает проход этапа: итоги становятся итогами последнего прохода"""
+    state.last_stats = state.current_stats or "{}"
+    state.last_pass_finished_at = datetime.now()
+    state.current_stats = None
+    state.cursor = None
+    state.pass_started_at = None
+    logger.info("Проверка хранилища, этап %s завершён: %s", state.phase, state.last_stats)
+
+
+def hash_content(path, encoding, budget):
+    """SHA-256 исходного содержимого (сжатое распаковывается) с учётом бюджета чтения"""
+    digest = hashlib.sha256()
+    with storage.open_content(path, encoding) as source:
+        while True:
+            block = source.read(storage.COPY_BUFFER_SIZE)
+            if not block:
+                break
+            budget.spend(len(block))
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check_content(record, budget, verified_blobs):
+    """
+    Проверяет содержимое записи File / FileVersion.
+
+    :param verified_blobs: {хеш блоба: статус} — блоб проверяется один раз за пачку
+    :return: (статус для content_status, проверен ли хеш)
+    """
+    path = storage.get_file_path(record)
+    budget.spend(STAT_COST)
+    if record.blob_hash and record.blob_hash in verified_blobs:
+        return verified_blobs[record.blob_hash], True
+    if not os.path.exists(path):
+        status = "missing"
+    else:
+        # В режиме cas блоб называется хешем своего содержимого
+        expected = record.blob_hash or record.content_hash
+        if not expected:
+            return None, False
+        try:
+            actual = hash_content(path, None if record.blob_hash else record.encoding, budget)
+        except Exception:
+            logger.exception("Не удалось прочитать содержимое %s", path)
+            actual = None
+        status = None if actual == expected else "corrupt"
+    if record.blob_hash:
+        verified_blobs[record.blob_hash] = status
+    return status, True
+
+
+def check_preview(file_record):
+    """
+    Пропавшее сгенерированное превью строится заново.
+
+    :return: True, если превью поставлено в очередь
+    """
+    if not file_record.preview_path or not file_record.preview_path.startswith("previews/"):
+        return False
+    if os.path.exists(storage.get_preview_path(file_record)):
+        return False
+    # UPDATE без событий модели: для клиентов синхронизации файл не менялся
+    db.session.execute(
+        update(File)
+        .where(File.id == file_record.id)
+        .values(preview_path=None, preview_status="pending")
+    )
+    if db.session.query(PreviewJob.id).filter_by(file_id=file_record.id).first() is None:
+        db.session.add(PreviewJob(file_id=file_record.id))
+    return True
+
+
+def scrub_records(phase, model, batch_size, budget):
+    """Одна пачка этапа files / versions. :return: True, если проход этапа завершён"""
+    state = get_state(phase)
+    records = (
+        model.query.filter(model.id > int(state.cursor or 0))
+        .order_by(model.id)
+        .limit(batch_size)
+        .all()
+    )
+    if not records:
+        finish_pass(state)
+        db.session.commit()
+        return True
+
+    found = {"checked": 0, "verified": 0, "missing": 0, "corrupt": 0, "recovered": 0}
+    previews = 0
+    verified_blobs = {}
+    for record in records:
+        status, verified = check_content(record, budget, verified_blobs)
+        found["checked"] += 1
+        found["verified"] += int(verified)
+        if status:
+            found[status] += 1
+            logger.warning(
+                "Проверка хранилища: %s %s — %s", model.__name__, record.id, status
+            )
+        elif record.content_status:
+            found["recovered"] += 1
+        if status != record.content_status:
+            db.session.execute(
+                update(model).where(model.id == record.id).values(content_status=status)
+            )
+        if model is File and status is None:
+            previews += int(check_preview(record))
+
+    add_stats(state, previews_requeued=previews, **found)
+    state.cursor = str(records[-1].id)
+    db.session.commit()
+    db.session.expire_all()
+    return False
+
+
+def iter_storage_files(root, after=()):
+    """
+    Файлы хранилища в порядке путей (кортежей частей пути) строго после after.
+    Каталоги, целиком лежащие до курсора, не читаются.
+    """
+
+    def walk(folder, parts):
+        try:
+            entries = sorted(os.scandir(folder), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            entry_parts = parts + (entry.name,)
+            if entry.is_dir(follow_symlinks=False):
+                if not parts and not (entry.name.isdigit() or entry.name == "blobs"):
+                    # Карантин, кеш производных превью и прочие служебные папки
+                    continue
+                if entry_parts < after[: len(entry_parts)]:
+                    continue
+                yield from walk(entry.path, entry_parts)
+            elif parts and entry_parts > after:
+                yield entry_parts, entry.path
+
+    yield from walk(root, ())
+
+
+def find_referenced(entries):
+    """
+    Какие файлы пачки нужны записям БД.
+
+    :param entries: [(части пути, полный путь)]
+    :return: множество кортежей частей пути, на которые есть ссылки
+    """
+    blobs = set()
+    user_paths = {}
+    for parts, _ in entries:
+        if parts[0] == "blobs":
+            blobs.add(parts[-1])
+        else:
+            user_paths.setdefault(int(parts[0]), set()).add("/".join(parts[1:]))
+
+    referenced = set()
+    referenced_blobs = set()
+    if blobs:
+        for (blob_hash,) in db.session.execute(
+            select(Blob.hash).where(Blob.hash.in_(blobs), Blob.refcount > 0)
+        ):
+            referenced_blobs.add(blob_hash)
+    for user_id, relpaths in user_paths.items():
+        # Недокачанные файлы сессий загрузки — <stored_filename>.part
+        sessions = {path[: -len(".part")] for path in relpaths if path.endswith(".part")}
+        queries = [
+            select(File.stored_filename).where(
+                File.user_id == user_id, File.stored_filename.in_(relpaths)
+            ),
+            select(File.preview_path).where(
+                File.user_id == user_id, File.preview_path.in_(relpaths)
+            ),
+            select(FileVersion.stored_filename).where(
+                FileVersion.user_id == user_id, FileVersion.stored_filename.in_(relpaths)
+            ),
+        ]
+        for query in queries:
+            for (relpath,) in db.session.execute(query):
+                referenced.add((str(user_id),) + tuple(relpath.split("/")))
+        if sessions:
+            for (relpath,) in db.session.execute(
+                select(UploadSession.stored_filename).where(
+                    UploadSession.user_id == user_id,
+                    UploadSession.stored_filename.in_(sessions),
+                )
+            ):
+                referenced.add((str(user_id),) + tuple((relpath + ".part").split("/")))
+
+    return {
+        parts
+        for parts, _ in entries
+        if parts in referenced or (parts[0] == "blobs" and parts[-1] in referenced_blobs)
+    }
+
+
+def handle_orphan(parts, path, action):
+    """Переносит в карантин или удаляет файл без ссылок"""
+    if action == "quarantine":
+        target = os.path.join(
+            app.config["UPLOAD_FOLDER"],
+            QUARANTINE_FOLDER,
+            datetime.now().strftime("%Y%m%d"),
+            *parts,
+        )
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    elif action == "delete":
+        os.remove(path)
+    logger.warning("Проверка хранилища: файл без записи в БД %s (%s)", path, action)
+
+
+def purge_quarantine():
+    """Удаляет из карантина папки старше SCRUB_QUARANTINE_DAYS"""
+    folder = os.path.join(app.config["UPLOAD_FOLDER"], QUARANTINE_FOLDER)
+    keep_days = app.config["SCRUB_QUARANTINE_DAYS"]
+    if not keep_days or not os.path.isdir(folder):
+        return
+    cutoff = (datetime.now() - timedelta(days=keep_days)).strftime("%Y%m%d")
+    for name in os.listdir(folder):
+        if name < cutoff:
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+            logger.info("Карантин за %s удалён", name)
+
+
+def scrub_disk(batch_size, budget, action):
+    """Одна пачка этапа disk. :return: True, если проход этапа завершён"""
+    state = get_state("disk")
+    if state.cursor is None:
+        purge_quarantine()
+    after = tuple(json.loads(state.cursor)) if state.cursor else ()
+    entries = list(
+        islice(iter_storage_files(app.config["UPLOAD_FOLDER"], after), batch_size)
+    )
+    if not entries:
+        finish_pass(state)
+        db.session.commit()
+        return True
+
+    referenced = find_referenced(entries)
+    grace = app.config["SCRUB_ORPHAN_GRACE_SECONDS"]
+    found = {"scanned": len(entries), "orphans": 0, "recent": 0, "orphan_bytes": 0}
+    for parts, path in entries:
+        budget.spend(STAT_COST)
+        if parts in referenced:
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        # ctime меняется и при переименовании / жёсткой ссылке (migrate-layout, store_blob)
+        if time.time() - max(stat.st_mtime, stat.st_ctime) < grace:
+            found["recent"] += 1
+            continue
+        found["orphans"] += 1
+        found["orphan_bytes"] += stat.st_size
+        try:
+            handle_orphan(parts, path, action)
+        except OSError as e:
+            logger.warning("Не удалось обработать %s: %s", path, e)
+
+    add_stats(state, **found)
+    state.cursor = json.dumps(entries[-1][0])
+    db.session.commit()
+    return False
+
+
+def scrub_pass(batch_size, budget, action):
+    """Доводит до конца текущий проход всех этапов"""
+    for phase in PHASES:
+        while True:
+            if phase == "disk":
+                done = scrub_disk(batch_size, budget, action)
+            else:
+                model = File if phase == "files" else FileVersion
+                done = scrub_records(phase, model, batch_size, budget)
+            if done:
+                break
+
+
+@app.cli.command("scrub")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option(
+    "--io-rate",
+    type=float,
+    default=None,
+    help="Не больше стольких МБ/с чтения (по умолчанию SCRUB_IO_BYTES_PER_SECOND, 0 — без ограничения)",
+)
+@click.option(
+    "--orphans",
+    type=click.Choice(ORPHAN_ACTIONS),
+    default=None,
+    help="Что делать с файлами без записи в БД (по умолчанию SCRUB_ORPHAN_ACTION)",
+)
+@click.option("--once", is_flag=True, help="Завершить текущий проход и выйти")
+def scrub(batch_size, io_rate, orphans, once):
+    """
+    Проверяет хранилище: содержимое и хеши записей, пропавшие превью,
+    файлы без записей в БД. Прерванный проход продолжается с места остановки.
+    """
+    rate = (
+        io_rate * 1024 * 1024
+        if io_rate is not None
+        else app.config["SCRUB_IO_BYTES_PER_SECOND"]
+    )
+    action = orphans or app.config["SCRUB_ORPHAN_ACTION"]
+    budget = IOBudget(rate)
+    logger.info("Проверка хранилища запущена (файлы без записей: %s)", action)
+    while True:
+        budget.reset()
+        scrub_pass(batch_size, budget, action)
+        if once:
+            break
+        time.sleep(app.config["SCRUB_PASS_INTERVAL"])
+
+
+def collect_scrub_findings():
+    """Итоги последнего завершённого прохода по этапам"""
+    values = {}
+    for state in ScrubState.query.all():
+        for kind, count in json.loads(state.last_stats or "{}").items():
+            values[(state.phase, kind)] = count
+    return values
+
+
+def collect_scrub_finished():
+    return {
+        (state.phase,): state.last_pass_finished_at.timestamp()
+        for state in ScrubState.query.all()
+        if state.last_pass_finished_at
+    }
+
+
+def count_content_problems():
+    """Записи, содержимое которых проверка нашла пропавшим или повреждённым"""
+    values = {}
+    for name, model in (("file", File), ("version", FileVersion)):
+        rows = db.session.execute(
+            select(model.content_status, func.count())
+            .where(model.content_status.isnot(None))
+            .group_by(model.content_status)
+        )
+        for status, count in rows:
+            values[(name, status)] = count
+    return values
+
+
+REGISTRY.append(
+    CallbackGauge(
+        "nestcloud_scrub_findings",
+        "Итоги последнего прохода проверки хранилища по этапам",
+        ("phase", "kind"),
+        collect_scrub_findings,
+    )
+)
+REGISTRY.append(
+    CallbackGauge(
+        "nestcloud_scrub_last_pass_timestamp_seconds",
+        "Время завершения последнего прохода проверки хранилища",
+        ("phase",),
+        collect_scrub_finished,
+    )
+)
+REGISTRY.append(
+    CallbackGauge(
+        "nestcloud_content_problems",
+        "Записи с пропавшим или повреждённым содержимым",
+        ("record", "status"),
+        count_content_problems,
+    )
+)
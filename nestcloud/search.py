@@ -0,0 +1,132 @@
+"""
+Поиск файлов по имени.
+
+В SQLite имена индексируются таблицей FTS5 с токенизатором trigram:
+она находит любую подстроку от 3 символов (в том числе кириллицу, без учёта
+регистра) за миллисекунды на миллионах строк. Таблица поддерживается
+триггерами на таблице file, поэтому загрузка, переименование и удаление
+обновляют индекс в той же транзакции, какой бы код их ни выполнял.
+
+Слова короче 3 символов (и все слова в других СУБД) ищутся через LIKE
+внутри уже отобранных файлов пользователя.
+"""
+
+import sqlite3
+
+from sqlalchemy import Integer, event, func, text
+from sqlalchemy.engine import Engine
+
+from nestcloud import db
+from nestcloud.models import File
+
+# Минимальная длина слова, которое можно искать по триграммам
+MIN_TRIGRAM_LENGTH = 3
+
+SEARCH_INDEX_DDL = [
+    # owner — "<id пользователя>": ограничивает поиск файлами пользователя
+    # внутри самого индекса (скобки не дают "<1>" совпасть с "<12>")
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS file_search
+    USING fts5(owner, filename, tokenize='trigram')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS file_search_insert AFTER INSERT ON file BEGIN
+        INSERT INTO file_search(rowid, owner, filename)
+        VALUES (new.id, '<' || new.user_id || '>', new.filename);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS file_search_delete AFTER DELETE ON file BEGIN
+        DELETE FROM file_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS file_search_update
+    AFTER UPDATE OF filename, user_id ON file BEGIN
+        UPDATE file_search
+        SET owner = '<' || new.user_id || '>', filename = new.filename
+        WHERE rowid = new.id;
+    END
+    """,
+]
+
+
+def is_sqlite(connection) -> bool:
+    return connection.dialect.name == "sqlite"
+
+
+def create_search_index(connection):
+    """Создаёт таблицу FTS5 и триггеры (только SQLite; повторный вызов безопасен)"""
+    if not is_sqlite(connection):
+        return
+    for ddl in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(ddl)
+
+
+def fill_search_index(connection, rebuild=False):
+    """Добавляет в индекс файлы, которых в нём нет (rebuild — строит заново)"""
+    if not is_sqlite(connection):
+        return
+    if rebuild:
+        connection.exec_driver_sql("DELETE FROM file_search")
+    connection.exec_driver_sql(
+        """
+        INSERT INTO file_search(rowid, owner, filename)
+        SELECT id, '<' || user_id || '>', filename FROM file
+        WHERE id NOT IN (SELECT rowid FROM file_search)
+        """
+    )
+
+
+@event.listens_for(File.__table__, "after_create")
+def file_table_created(target, connection, **kw):
+    create_search_index(connection)
+
+
+@event.listens_for(Engine, "connect")
+def register_sqlite_functions(dbapi_connection, connection_record):
+    # lower() в SQLite понимает только латиницу — для коротких слов нужен casefold
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            "casefold",
+            1,
+            lambda value: value.casefold() if value is not None else None,
+            deterministic=True,
+        )
+
+
+def quote_fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def filter_by_search(query, user_id, search_text):
+    """Добавляет к запросу файлов пользователя условие поиска по имени"""
+    terms = search_text.split()
+    if not terms:
+        return query
+
+    use_index = db.engine.dialect.name == "sqlite"
+    indexed = [t for t in terms if use_index and len(t) >= MIN_TRIGRAM_LENGTH]
+    short = [t for t in terms if t not in indexed]
+
+    if indexed:
+        match = " AND ".join(
+            [f'owner:"<{int(user_id)}>"']
+            + [f"filename:{quote_fts_phrase(t)}" for t in indexed]
+        )
+        matching_ids = (
+            text("SELECT rowid FROM file_search WHERE file_search MATCH :match")
+            .bindparams(match=match)
+            .columns(rowid=Integer)
+        )
+        query = query.filter(File.id.in_(matching_ids))
+
+    for term in short:
+        if use_index and not term.isascii():
+            query = query.filter(
+                func.casefold(File.filename).contains(term.casefold(), autoescape=True)
+            )
+        else:
+            # Латиницу LIKE в SQLite сравнивает без учёта регистра сам (и быстрее)
+            query = query.filter(File.filename.icontains(term, autoescape=True))
+    return query
@@ -0,0 +1,174 @@
+"""
+Аутентификация без лишней нагрузки на каждый запрос.
+
+- Кеш пользователей: загрузчик Flask-Login не ходит в БД на каждый запрос
+  (страница с N превью — это N запросов). Запись живёт USER_CACHE_TTL секунд
+  и сбрасывается при любом изменении пользователя.
+- Хеширование паролей выполняется в ограниченном пуле потоков: всплеск входов
+  не занимает все рабочие потоки, а лишние попытки получают 503.
+  Сложность задаётся PASSWORD_HASH_METHOD; при её смене хеш пересчитывается
+  при следующем успешном входе.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from nestcloud import app, db, manager
+from nestcloud.models import User, File
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """Небольшой LRU-кеш снимков строк User с ограниченным временем жизни"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return values
+
+    def put(self, user_id, values):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache(app.config["USER_CACHE_TTL"], app.config["USER_CACHE_MAX_SIZE"])
+
+
+def snapshot_user(user):
+    return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+
+@manager.user_loader
+def load_user(user_id):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    values = user_cache.get(user_id)
+    if values is not None:
+        # Восстанавливаем объект из снимка и присоединяем к сессии без запроса к БД
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.put(user_id, snapshot_user(user))
+    return user
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def user_changed(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+
+@event.listens_for(File, "after_insert")
+@event.listens_for(File, "after_update")
+@event.listens_for(File, "after_delete")
+def user_files_changed(mapper, connection, target):
+    # Изменились счётчики used_bytes / file_count владельца
+    user_cache.invalidate(target.user_id)
+
+
+# Пул для хеширования паролей: hashlib отпускает GIL, но сами вычисления
+# дорогие, поэтому одновременно их выполняется не больше PASSWORD_HASH_WORKERS
+password_executor = ThreadPoolExecutor(
+    max_workers=app.config["PASSWORD_HASH_WORKERS"],
+    thread_name_prefix="password-hash",
+)
+# Ограничение очереди: сверх него запрос сразу получает 503
+password_slots = threading.BoundedSemaphore(
+    app.config["PASSWORD_HASH_WORKERS"] + app.config["PASSWORD_HASH_MAX_PENDING"]
+)
+
+
+def run_password_task(func, *args):
+    if not password_slots.acquire(blocking=False):
+        logger.warning("Очередь хеширования паролей переполнена")
+        raise ServiceUnavailable(
+            "Слишком много попыток входа, повторите позже", retry_after=1
+        )
+    try:
+        return password_executor.submit(func, *args).result()
+    finally:
+        password_slots.release()
+
+
+def get_hash_method():
+    return app.config["PASSWORD_HASH_METHOD"] or "scrypt"
+
+
+@lru_cache(maxsize=8)
+def get_hash_prefix(method):
+    """Строка метода с параметрами, как её записывает werkzeug: "scrypt:32768:8:1" """
+    return generate_password_hash("", method=method).split("$", 1)[0]
+
+
+def hash_password(password):
+    return run_password_task(generate_password_hash, password, get_hash_method())
+
+
+def verify_password(password_hash, password):
+    return run_password_task(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Хеш создан с другим методом или сложностью, чем задано сейчас"""
+    method = get_hash_method()
+    current_prefix = run_password_task(get_hash_prefix, method)
+    return password_hash.split("$", 1)[0] != current_prefix
+
+
+def authenticate(login, password):
+    """
+    Проверяет логин и пароль; при устаревшей сложности хеша пересчитывает его.
+
+    :return: пользователь или None
+    """
+    user = User.query.filter_by(login=login).first()
+    if not user or not verify_password(user.password, password or ""):
+        return None
+
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+        logger.info("Хеш пароля пользователя %s пересчитан", user.id)
+    return user
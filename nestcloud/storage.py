@@ -0,0 +1,377 @@
+"""
+Хранилище содержимого файлов.
+
+В режиме STORAGE_MODE=cas содержимое хранится один раз под своим SHA-256
+в папке blobs/ (blobs/ab/cd/<hash>), а записи File ссылаются на блоб.
+Блоб удаляется с диска только когда на него не осталось ссылок.
+
+В обычном режиме файлы лежат в папке пользователя, разложенные по
+подкаталогам по хешу имени (<user_id>/ab/cd/<имя>, превью —
+<user_id>/previews/ab/cd/preview_<имя>.jpg); глубина — STORAGE_FANOUT.
+Все пути внутри папки пользователя строятся через resolve_user_path.
+
+При STORAGE_COMPRESSION=zstd сжимаемые файлы (режим files) пишутся на диск
+сжатыми; File.encoding говорит, как читать содержимое (open_content).
+"""
+
+import hashlib
+import logging
+import os
+import posixpath
+import uuid
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from nestcloud import app, db
+from nestcloud.models import Blob
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при копировании и хешировании
+COPY_BUFFER_SIZE = 1024 * 1024
+# Сколько байт с начала и с конца файла входит в sample_hash
+SAMPLE_BYTES = 4096
+# Значение File.encoding для содержимого, сжатого zstd
+ENCODING_ZSTD = "zstd"
+
+
+def is_cas_enabled() -> bool:
+    return app.config.get("STORAGE_MODE") == "cas"
+
+
+def get_blob_folder() -> str:
+    return os.path.join(app.config["UPLOAD_FOLDER"], "blobs")
+
+
+def get_blob_path(blob_hash: str) -> str:
+    """Путь к блобу: двухуровневый префикс хеша, чтобы не было огромных каталогов"""
+    return os.path.join(get_blob_folder(), blob_hash[:2], blob_hash[2:4], blob_hash)
+
+
+def get_user_root(user_id: int) -> str:
+    """Папка пользователя (без создания)"""
+    return os.path.join(app.config["UPLOAD_FOLDER"], f"{user_id}")
+
+
+def resolve_user_path(user_id: int, relpath: str) -> str:
+    """Полный путь по пути относительно папки пользователя (stored_filename, preview_path)"""
+    return os.path.join(get_user_root(user_id), relpath)
+
+
+def get_shard_dir(name: str, fanout=None) -> str:
+    """Подкаталоги для имени: по 2 символа SHA-1 имени на уровень ("ab/cd")"""
+    if fanout is None:
+        fanout = app.config["STORAGE_FANOUT"]
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+    return "/".join(digest[2 * i : 2 * i + 2] for i in range(fanout))
+
+
+def make_file_relpath(stored_name: str, fanout=None) -> str:
+    """stored_filename для нового файла: имя на диске внутри своего подкаталога"""
+    return posixpath.join(get_shard_dir(stored_name, fanout), stored_name)
+
+
+def get_preview_dir(user_id: int, source_path: str) -> str:
+    """Каталог превью для исходного файла (имя превью строится из его имени)"""
+    shard = get_shard_dir(os.path.basename(source_path))
+    return os.path.join(get_user_root(user_id), "previews", shard)
+
+
+def make_preview_relpath(preview_name: str, fanout=None) -> str:
+    """preview_path превью preview_<имя>.jpg в раскладке с заданной глубиной"""
+    source_name = preview_name[len("preview_") : -len(".jpg")]
+    return posixpath.join("previews", get_shard_dir(source_name, fanout), preview_name)
+
+
+def get_file_path(file_record) -> str:
+    """Полный путь к содержимому записи File"""
+    if file_record.blob_hash:
+        return get_blob_path(file_record.blob_hash)
+    return resolve_user_path(file_record.user_id, file_record.stored_filename)
+
+
+def get_preview_path(file_record) -> str:
+    """Полный путь к сгенерированному превью записи File"""
+    return resolve_user_path(file_record.user_id, file_record.preview_path)
+
+
+def get_content_etag(file_record) -> str:
+    """
+    Сильный ETag содержимого. Записанный файл никогда не перезаписывается
+    (переименование меняет только имя в БД), поэтому имени на диске достаточно;
+    подкаталог в ключ не входит — перенос в другую раскладку ETag не меняет.
+    """
+    if file_record.blob_hash:
+        return file_record.blob_hash
+    key = f"{file_record.user_id}/{posixpath.basename(file_record.stored_filename)}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def make_temp_path() -> str:
+    """Временный файл внутри хранилища блобов (та же ФС — переименование атомарно)"""
+    temp_folder = os.path.join(get_blob_folder(), "tmp")
+    os.makedirs(temp_folder, exist_ok=True)
+    return os.path.join(temp_folder, uuid.uuid4().hex)
+
+
+def copy_and_hash(stream, dest_path: str) -> str:
+    """Копирует поток в файл блоками, одновременно считая SHA-256"""
+    digest = hashlib.sha256()
+    with open(dest_path, "wb") as dest:
+        while True:
+            block = stream.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            dest.write(block)
+    return digest.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        while True:
+            block = source.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_sample_hash(size: int, head: bytes, tail: bytes) -> str:
+    """
+    Быстрый отпечаток файла для поиска дубликатов: SHA-256 от "<размер>:",
+    первых SAMPLE_BYTES и последних SAMPLE_BYTES байт (без перекрытия).
+    Клиент считает то же самое до загрузки (static/js/home.js).
+
+    :param head: начало содержимого (не меньше SAMPLE_BYTES байт, если файл длиннее)
+    :param tail: конец содержимого (не меньше SAMPLE_BYTES байт, если файл длиннее)
+    """
+    digest = hashlib.sha256(f"{size}:".encode("ascii"))
+    digest.update(head[:SAMPLE_BYTES])
+    tail_start = max(SAMPLE_BYTES, size - SAMPLE_BYTES)
+    if size > tail_start:
+        digest.update(tail[-(size - tail_start) :])
+    return digest.hexdigest()
+
+
+def sample_hash_file(path: str) -> str:
+    """sample_hash файла, хранящегося как есть"""
+    size = os.path.getsize(path)
+    tail = b""
+    with open(path, "rb") as source:
+        head = source.read(SAMPLE_BYTES)
+        tail_start = max(SAMPLE_BYTES, size - SAMPLE_BYTES)
+        if size > tail_start:
+            source.seek(tail_start)
+            tail = source.read(size - tail_start)
+    return make_sample_hash(size, head, tail)
+
+
+def import_zstandard():
+    # zstandard нужен только при сжатии: без него работает всё остальное
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "zstandard не установлен. Установите пакет 'zstandard' в виртуальное окружение."
+        )
+    return zstandard
+
+
+def is_compression_enabled() -> bool:
+    return app.config.get("STORAGE_COMPRESSION") == ENCODING_ZSTD and not is_cas_enabled()
+
+
+def is_compressible(sample: bytes) -> bool:
+    """Стоит ли сжимать содержимое: проба сжимается до COMPRESSION_MAX_RATIO или меньше"""
+    if not sample:
+        return False
+    compressor = import_zstandard().ZstdCompressor(level=app.config["COMPRESSION_LEVEL"])
+    ratio = len(compressor.compress(sample)) / len(sample)
+    return ratio <= app.config["COMPRESSION_MAX_RATIO"]
+
+
+def write_content(stream, dest_path: str, compress: bool = False) -> dict:
+    """
+    Копирует поток в файл блоками, считая SHA-256, размер и sample_hash.
+    При compress содержимое сжимается zstd, если хорошо сжимается его
+    начало (COMPRESSION_SAMPLE_BYTES байт), иначе пишется как есть.
+
+    :return: {"content_hash", "size_bytes", "sample_hash", "encoding", "stored_size"}
+    """
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    tail = b""
+    block = stream.read(COPY_BUFFER_SIZE)
+    encoding = None
+    if compress and is_compressible(block[: app.config["COMPRESSION_SAMPLE_BYTES"]]):
+        encoding = ENCODING_ZSTD
+
+    with open(dest_path, "wb") as dest:
+        writer = dest
+        if encoding:
+            compressor = import_zstandard().ZstdCompressor(
+                level=app.config["COMPRESSION_LEVEL"]
+            )
+            writer = compressor.stream_writer(dest, closefd=False)
+        while block:
+            digest.update(block)
+            if size < SAMPLE_BYTES:
+                head += block[: SAMPLE_BYTES - size]
+            tail = (tail + block[-SAMPLE_BYTES:])[-SAMPLE_BYTES:]
+            size += len(block)
+            writer.write(block)
+            block = stream.read(COPY_BUFFER_SIZE)
+        if encoding:
+            # Дописывает конец кадра zstd, dest остаётся открытым
+            writer.close()
+        stored_size = dest.tell()
+
+    if encoding:
+        logger.debug("Файл сжат: %d → %d байт (%s)", size, stored_size, dest_path)
+    return {
+        "content_hash": digest.hexdigest(),
+        "size_bytes": size,
+        "sample_hash": make_sample_hash(size, head, tail),
+        "encoding": encoding,
+        "stored_size": stored_size,
+    }
+
+
+class ZstdContentReader:
+    """
+    Чтение сжатого файла как исходного содержимого. Перемотка вперёд
+    распаковывает и пропускает данные, назад — начинает чтение заново.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader = None
+        self._open()
+
+    def _open(self):
+        if self._reader is not None:
+            self._reader.close()
+        decompressor = import_zstandard().ZstdDecompressor()
+        self._reader = decompressor.stream_reader(open(self.path, "rb"), closefd=True)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._reader.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence != os.SEEK_SET:
+            raise OSError("Сжатое содержимое перематывается только от начала")
+        if offset < self._reader.tell():
+            self._open()
+        return self._reader.seek(offset)
+
+    def tell(self) -> int:
+        return self._reader.tell()
+
+    def close(self):
+        self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_content(path: str, encoding=None):
+    """Открывает содержимое файла для чтения (сжатое — с распаковкой на лету)"""
+    if encoding == ENCODING_ZSTD:
+        return ZstdContentReader(path)
+    if encoding:
+        raise ValueError(f"Неизвестное сжатие: {encoding}")
+    return open(path, "rb")
+
+
+def add_blob_reference(blob_hash: str, size: int) -> bool:
+    """
+    Увеличивает счётчик ссылок блоба, создавая запись при необходимости.
+    Коммит остаётся за вызывающим кодом.
+
+    :return: True, если блоб новый и его содержимое нужно положить на диск
+    """
+    result = db.session.execute(
+        update(Blob).where(Blob.hash == blob_hash).values(refcount=Blob.refcount + 1)
+    )
+    if result.rowcount:
+        return False
+    try:
+        with db.session.begin_nested():
+            db.session.add(Blob(hash=blob_hash, size=size, refcount=1))
+        return True
+    except IntegrityError:
+        # Параллельная загрузка того же содержимого успела создать запись
+        db.session.execute(
+            update(Blob)
+            .where(Blob.hash == blob_hash)
+            .values(refcount=Blob.refcount + 1)
+        )
+        return False
+
+
+def place_blob(temp_path: str, blob_hash: str):
+    """
+    Добавляет ссылку на блоб и переносит временный файл в хранилище, если
+    такого содержимого там ещё нет. Иначе временный файл остаётся на месте:
+    его удаляет вызывающий код (store_blob — сразу, сессия загрузки — после коммита).
+
+    :return: (путь к блобу, перенесён ли временный файл)
+    """
+    blob_path = get_blob_path(blob_hash)
+    is_new = add_blob_reference(blob_hash, os.path.getsize(temp_path))
+    if is_new or not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(temp_path, blob_path)
+        logger.debug("Новый блоб сохранён: %s", blob_hash)
+        return blob_path, True
+    logger.debug("Блоб уже существует, дубликат не записан: %s", blob_hash)
+    return blob_path, False
+
+
+def store_blob(temp_path: str, blob_hash: str) -> str:
+    """
+    Помещает временный файл в хранилище под его хешем или удаляет его,
+    если такое содержимое уже хранится.
+
+    :return: путь к блобу
+    """
+    blob_path, moved = place_blob(temp_path, blob_hash)
+    if not moved:
+        os.remove(temp_path)
+    return blob_path
+
+
+def release_blob(blob_hash: str, count: int = 1) -> bool:
+    """
+    Уменьшает счётчик ссылок блоба на count. Коммит остаётся за вызывающим кодом,
+    после коммита файл удаляет remove_unreferenced_blob.
+
+    :return: True, если ссылок не осталось
+    """
+    db.session.execute(
+        update(Blob)
+        .where(Blob.hash == blob_hash)
+        .values(refcount=Blob.refcount - count)
+    )
+    blob = db.session.get(Blob, blob_hash, populate_existing=True)
+    if blob is not None and blob.refcount <= 0:
+        db.session.delete(blob)
+        return True
+    return False
+
+
+def remove_unreferenced_blob(blob_hash: str) -> None:
+    """Удаляет файл блоба, если запись о нём так и не появилась снова"""
+    if db.session.get(Blob, blob_hash) is not None:
+        return
+    blob_path = get_blob_path(blob_hash)
+    if os.path.exists(blob_path):
+        os.remove(blob_path)
+        logger.debug("Блоб удалён: %s", blob_hash)
@@ -0,0 +1,435 @@
+"""
+Отдача файлов клиенту: условные запросы (ETag / Last-Modified → 304),
+диапазоны байтов (в том числе несколько диапазонов сразу — multipart/byteranges)
+и передача отдачи веб-серверу через X-Accel-Redirect (nginx) или X-Sendfile.
+
+Сжатые при хранении файлы (File.encoding) распаковываются на лету, а клиенту,
+принимающему то же сжатие (Accept-Encoding), отдаются как есть
+с Content-Encoding.
+"""
+
+from datetime import datetime, timezone
+import io
+import logging
+import mimetypes
+import os
+import unicodedata
+from urllib.parse import quote
+import uuid
+import zipfile
+
+from flask import request
+from werkzeug.datastructures import ContentRange, Headers
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified
+import werkzeug.utils
+
+from nestcloud import app, storage
+from nestcloud.metrics import BYTES_SENT, observe_until_close
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при чтении файла для ответа
+READ_BUFFER_SIZE = 256 * 1024
+# Больше диапазонов в одном запросе не обслуживаем — отдаём файл целиком
+MAX_RANGES = 16
+
+
+def guess_mimetype(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def set_cache_headers(rv, etag, last_modified, max_age, immutable):
+    """Файлы пользователей приватные: кешировать может только браузер"""
+    rv.set_etag(etag)
+    rv.last_modified = last_modified
+    rv.cache_control.public = False
+    rv.cache_control.private = True
+    if max_age:
+        rv.cache_control.no_cache = None
+        rv.cache_control.max_age = max_age
+        rv.cache_control.immutable = immutable
+    else:
+        rv.cache_control.no_cache = True
+    rv.headers["X-Content-Type-Options"] = "nosniff"
+    return rv
+
+
+def if_range_matches(etag, last_modified) -> bool:
+    """
+    Совпадает ли If-Range с текущим содержимым (RFC 9110, 13.1.5): сравнивается
+    сильный ETag или точное время изменения. Без If-Range — всегда совпадает.
+    """
+    if "If-Range" not in request.headers:
+        return True
+    if request.headers["If-Range"].lstrip().startswith("W/"):
+        # Слабый ETag для диапазонов не годится
+        return False
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date and last_modified:
+        # Наивное время werkzeug считает UTC — так же оно попадает в Last-Modified
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        return if_range.date == last_modified.replace(microsecond=0)
+    return False
+
+
+def resolve_ranges(size: int, etag=None, last_modified=None):
+    """
+    Возвращает список диапазонов (start, stop) из заголовка Range
+    или None, если запрос нужно обслужить целиком: Range нет, If-Range
+    не совпал (по RFC 9110 отдаётся весь файл) или диапазонов слишком много.
+    """
+    rng = request.range
+    if rng is None or rng.units != "bytes" or not size:
+        return None
+    if not if_range_matches(etag, last_modified):
+        return None
+    if len(rng.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in rng.ranges:
+        if stop is None:
+            stop = size
+            if start < 0:
+                start = max(0, size + start)
+        stop = min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(length=size)
+    return ranges
+
+
+def make_range_environ(ranges):
+    """
+    Окружение запроса для werkzeug.utils.send_file: диапазоны уже разобраны
+    в resolve_ranges, поэтому werkzeug получает либо один нормализованный
+    Range, либо ни одного (и отдаёт файл целиком), а If-Range — никогда
+    """
+    environ = dict(request.environ)
+    environ.pop("HTTP_IF_RANGE", None)
+    if ranges:
+        start, stop = ranges[0]
+        environ["HTTP_RANGE"] = f"bytes={start}-{stop - 1}"
+    else:
+        environ.pop("HTTP_RANGE", None)
+    return environ
+
+
+def iter_range(source, start, stop):
+    """Блоки содержимого [start, stop) из открытого файла"""
+    source.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        block = source.read(min(READ_BUFFER_SIZE, remaining))
+        if not block:
+            return
+        remaining -= len(block)
+        yield block
+
+
+def iter_content(path, encoding, start, stop):
+    """Генератор тела ответа с распаковкой сжатого файла на лету"""
+    with storage.open_content(path, encoding) as source:
+        yield from iter_range(source, start, stop)
+
+
+def iter_file_ranges(path, ranges, boundary, mimetype, size, encoding=None):
+    """Генератор тела multipart/byteranges: файл читается блоками, без буферизации частей"""
+    with storage.open_content(path, encoding) as source:
+        for start, stop in ranges:
+            yield make_part_header(boundary, mimetype, start, stop, size)
+            yield from iter_range(source, start, stop)
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def make_part_header(boundary, mimetype, start, stop, size):
+    return (
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {mimetype}\r\n"
+        f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+    ).encode()
+
+
+def send_multiple_ranges(path, ranges, mimetype, size, encoding=None):
+    boundary = uuid.uuid4().hex
+    content_length = len(f"\r\n--{boundary}--\r\n")
+    for start, stop in ranges:
+        content_length += len(make_part_header(boundary, mimetype, start, stop, size))
+        content_length += stop - start
+
+    rv = app.response_class(
+        iter_file_ranges(path, ranges, boundary, mimetype, size, encoding),
+        status=206,
+        mimetype=f"multipart/byteranges; boundary={boundary}",
+        direct_passthrough=True,
+    )
+    rv.content_length = content_length
+    rv.accept_ranges = "bytes"
+    return rv
+
+
+def send_decoded(path, encoding, size, mimetype, ranges):
+    """Полный ответ или один диапазон сжатого файла, распакованного на лету"""
+    start, stop = ranges[0] if ranges else (0, size)
+    rv = app.response_class(
+        iter_content(path, encoding, start, stop),
+        status=206 if ranges else 200,
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    rv.content_length = stop - start
+    if ranges:
+        rv.content_range = ContentRange("bytes", start, stop, size)
+    rv.accept_ranges = "bytes"
+    return rv
+
+
+def accepts_encoding(encoding) -> bool:
+    """
+    Можно ли отдать сжатые байты как есть. Диапазоны обслуживаются
+    по исходному содержимому, поэтому запрос с Range всегда распаковывается.
+    """
+    return request.range is None and request.accept_encodings[encoding] > 0
+
+
+def send_offloaded(path, mimetype, as_attachment, download_name):
+    """Пустой ответ с заголовком, по которому файл отдаст веб-сервер"""
+    rv = werkzeug.utils.send_file(
+        path,
+        request.environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=False,
+        etag=False,
+        use_x_sendfile=True,
+        response_class=app.response_class,
+        _root_path=app.root_path,
+    )
+    if app.config["SENDFILE_MODE"] == "x-accel":
+        del rv.headers["X-Sendfile"]
+        relpath = os.path.relpath(path, app.config["UPLOAD_FOLDER"])
+        prefix = app.config["SENDFILE_PREFIX"].rstrip("/")
+        rv.headers["X-Accel-Redirect"] = f"{prefix}/{relpath.replace(os.sep, '/')}"
+    return rv
+
+
+def send_stored_file(
+    path,
+    download_name,
+    etag,
+    last_modified=None,
+    as_attachment=True,
+    mimetype=None,
+    max_age=None,
+    immutable=False,
+    encoding=None,
+    size=None,
+):
+    """
+    Отдаёт файл из хранилища с поддержкой условных запросов и диапазонов.
+
+    :param path: полный путь к файлу
+    :param download_name: имя файла для клиента
+    :param etag: сильный ETag, однозначно определяющий содержимое
+    :param last_modified: время изменения (по умолчанию mtime файла)
+    :param as_attachment: отдавать как вложение (Content-Disposition: attachment)
+    :param mimetype: тип содержимого (по умолчанию определяется по имени)
+    :param max_age: срок кеширования в браузере, секунды
+    :param immutable: содержимое по этому URL никогда не меняется
+    :param encoding: чем сжат файл на диске (File.encoding)
+    :param size: размер исходного содержимого сжатого файла (File.size_bytes)
+    """
+    stat = os.stat(path)
+    mimetype = mimetype or guess_mimetype(download_name)
+    if last_modified is None:
+        last_modified = datetime.fromtimestamp(stat.st_mtime)
+    passthrough = bool(encoding) and accepts_encoding(encoding)
+    if passthrough:
+        # Сжатое представление — другие байты, поэтому и другой ETag
+        etag = f"{etag}-{encoding}"
+
+    # Условный запрос: содержимое не изменилось — 304 без тела
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        rv = app.response_class(status=304)
+        return set_encoding_headers(
+            set_cache_headers(rv, etag, last_modified, max_age, immutable),
+            encoding,
+            passthrough,
+        )
+
+    # Сжатые файлы Flask отдаёт сам: веб-серверу неизвестно их сжатие
+    if encoding and not passthrough:
+        ranges = resolve_ranges(size, etag, last_modified)
+        if ranges is not None and len(ranges) > 1:
+            rv = send_multiple_ranges(path, ranges, mimetype, size, encoding)
+        else:
+            rv = send_decoded(path, encoding, size, mimetype, ranges)
+        if as_attachment:
+            rv.headers["Content-Disposition"] = send_file_disposition(download_name)
+        observe_until_close(rv, "send_file")
+        rv = set_cache_headers(rv, etag, last_modified, max_age, immutable)
+        return set_encoding_headers(rv, encoding, passthrough)
+
+    if app.config.get("SENDFILE_MODE") and not encoding:
+        rv = send_offloaded(path, mimetype, as_attachment, download_name)
+        return set_cache_headers(rv, etag, last_modified, max_age, immutable)
+
+    ranges = resolve_ranges(stat.st_size, etag, last_modified)
+    if ranges is not None and len(ranges) > 1:
+        rv = send_multiple_ranges(path, ranges, mimetype, stat.st_size)
+        if as_attachment:
+            rv.headers["Content-Disposition"] = send_file_disposition(download_name)
+        observe_until_close(rv, "send_file")
+        return set_cache_headers(rv, etag, last_modified, max_age, immutable)
+
+    # Один диапазон и полный ответ отдаёт send_file (с wsgi.file_wrapper)
+    rv = werkzeug.utils.send_file(
+        path,
+        make_range_environ(ranges),
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=etag,
+        last_modified=last_modified,
+        max_age=max_age,
+        response_class=app.response_class,
+        _root_path=app.root_path,
+    )
+    observe_until_close(rv, "send_file")
+    rv = set_cache_headers(rv, etag, last_modified, max_age, immutable)
+    return set_encoding_headers(rv, encoding, passthrough)
+
+
+def set_encoding_headers(rv, encoding, passthrough):
+    """Ответ по сжатому файлу зависит от Accept-Encoding клиента"""
+    if encoding:
+        rv.vary.add("Accept-Encoding")
+    if passthrough:
+        rv.content_encoding = encoding
+        # Диапазоны отсчитываются по исходному содержимому, а не по этим байтам
+        rv.accept_ranges = "none"
+    return rv
+
+
+def send_file_disposition(download_name):
+    """Заголовок Content-Disposition для вложения (как его формирует send_file)"""
+    headers = Headers()
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+-.^_`|~")
+        names = {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    else:
+        names = {"filename": download_name}
+    headers.set("Content-Disposition", "attachment", **names)
+    return headers["Content-Disposition"]
+
+
+class ZipSink(io.RawIOBase):
+    """
+    Приёмник для zipfile без возможности перемотки: zipfile пишет в него
+    заголовки и данные, а генератор забирает накопленные байты.
+    Поскольку seek недоступен, размеры записываются в data descriptor
+    после содержимого каждого файла.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def unique_arcname(name, used):
+    """Одинаковые имена внутри архива получают суффикс: file (2).txt"""
+    candidate = name
+    counter = 1
+    while candidate.lower() in used:
+        counter += 1
+        base, ext = os.path.splitext(name)
+        candidate = f"{base} ({counter}){ext}"
+    used.add(candidate.lower())
+    return candidate
+
+
+def iter_zip(entries):
+    """
+    Генератор ZIP-архива «на лету»: без временных файлов, в памяти
+    одновременно находится не больше одного блока чтения.
+
+    :param entries: итератор (имя в архиве, путь, datetime, сжимать ли,
+                    сжатие на диске, размер содержимого) — последние два
+                    нужны для сжатых при хранении файлов, иначе None
+    """
+    sink = ZipSink()
+    used_names = set()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for arcname, path, modified, compress, encoding, size in entries:
+            try:
+                stored_size = os.path.getsize(path)
+            except OSError:
+                logger.warning("Файл для архива не найден: %s", path)
+                continue
+            info = zipfile.ZipInfo(
+                unique_arcname(arcname, used_names),
+                date_time=modified.timetuple()[:6],
+            )
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            info.external_attr = 0o644 << 16
+            # Известный заранее размер позволяет zipfile выбрать ZIP64 для больших файлов
+            info.file_size = size if encoding else stored_size
+            with storage.open_content(path, encoding) as source, archive.open(
+                info, "w"
+            ) as dest:
+                while True:
+                    block = source.read(READ_BUFFER_SIZE)
+                    if not block:
+                        break
+                    dest.write(block)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def send_zip(entries, download_name):
+    """Ответ с ZIP-архивом, который собирается по мере отдачи"""
+    endpoint = request.endpoint
+
+    # Размер архива заранее неизвестен — отданные байты считаются по блокам
+    def counted():
+        for block in iter_zip(entries):
+            BYTES_SENT.inc(len(block), endpoint=endpoint)
+            yield block
+
+    rv = app.response_class(
+        counted(), mimetype="application/zip", direct_passthrough=True
+    )
+    observe_until_close(rv, "send_zip")
+    rv.headers["Content-Disposition"] = send_file_disposition(download_name)
+    rv.cache_control.no_store = True
+    return rv
@@ -0,0 +1,206 @@
+"""
+Корзина: просмотр, восстановление и окончательное удаление файлов.
+
+Удаление файла (files.trash_files) только помечает запись — запрос не ждёт
+диска и его время не зависит от размера файла. Файл хранится в корзине
+TRASH_RETENTION_DAYS дней, затем `flask purge-trash` удаляет содержимое
+пачками с ограничением скорости и уменьшает занятое место одним запросом
+на пользователя. "Удалить навсегда" лишь переносит срок на текущий момент.
+"""
+
+from datetime import datetime
+import logging
+import time
+
+import click
+from flask import flash, jsonify, redirect, render_template, request, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import func, select
+
+from nestcloud import app, db, listing
+from nestcloud.api import API_PREFIX, api_login_required, file_to_dict, get_limit
+from nestcloud.files import (
+    parse_file_ids,
+    purge_file_records,
+    restore_files,
+    schedule_purge,
+)
+from nestcloud.metrics import REGISTRY, CallbackGauge
+from nestcloud.models import File
+from utils import get_human_readable_size
+
+logger = logging.getLogger(__name__)
+
+
+def trash_file_to_dict(file_record):
+    return {
+        "id": file_record.id,
+        "filename": file_record.filename,
+        "size": file_record.size_bytes,
+        "size_human": file_record.file_size,
+        "deleted_at": file_record.deleted_at.isoformat(),
+        "purge_at": file_record.purge_at.isoformat(),
+    }
+
+
+def get_trash_size(user_id):
+    """Число файлов в корзине и их размер"""
+    return db.session.execute(
+        select(func.count(File.id), func.coalesce(func.sum(File.size_bytes), 0)).where(
+            File.user_id == user_id,
+            File.deleted_at.isnot(None),
+            File.purge_at > datetime.now(),
+        )
+    ).one()
+
+
+@app.route("/trash")
+@login_required
+def trash_page():
+    files, next_cursor = listing.list_trash_page(current_user.id, request.args.get("cursor"))
+    count, size = get_trash_size(current_user.id)
+    return render_template(
+        "trash.html",
+        files=files,
+        next_cursor=next_cursor,
+        trash_count=count,
+        trash_size=get_human_readable_size(size),
+        retention_days=app.config["TRASH_RETENTION_DAYS"],
+    )
+
+
+@app.route("/trash/restore", methods=["POST"])
+@login_required
+def restore_trash_files():
+    """Возвращает выбранные файлы из корзины (в корень, если их папки удалены)"""
+    file_ids = parse_file_ids(request.form.getlist("file_ids"))
+    restored = restore_files(current_user.id, File.id.in_(file_ids)) if file_ids else 0
+    db.session.commit()
+    flash(f"Восстановлено файлов: {restored}", "success")
+    return redirect(url_for("trash_page"))
+
+
+@app.route("/trash/delete", methods=["POST"])
+@login_required
+def purge_trash_files():
+    """Удаляет выбранные файлы из корзины навсегда"""
+    file_ids = parse_file_ids(request.form.getlist("file_ids"))
+    purged = schedule_purge(current_user.id, File.id.in_(file_ids)) if file_ids else 0
+    db.session.commit()
+    flash(f"Удалено навсегда файлов: {purged}", "success")
+    return redirect(url_for("trash_page"))
+
+
+@app.route("/trash/empty", methods=["POST"])
+@login_required
+def empty_trash():
+    purged = schedule_purge(current_user.id, db.true())
+    db.session.commit()
+    flash(f"Корзина очищена, файлов: {purged}", "success")
+    return redirect(url_for("trash_page"))
+
+
+@app.route(f"{API_PREFIX}/trash", methods=["GET"])
+@api_login_required
+def api_list_trash():
+    """Страница корзины, недавно удалённые сначала"""
+    files, next_cursor = listing.list_trash_page(
+        current_user.id, request.args.get("cursor"), get_limit(listing.PAGE_SIZE)
+    )
+    return jsonify(files=[trash_file_to_dict(f) for f in files], next_cursor=next_cursor)
+
+
+@app.route(f"{API_PREFIX}/trash", methods=["DELETE"])
+@api_login_required
+def api_empty_trash():
+    purged = schedule_purge(current_user.id, db.true())
+    db.session.commit()
+    return jsonify(purged=purged)
+
+
+@app.route(f"{API_PREFIX}/trash/<int:file_id>/restore", methods=["POST"])
+@api_login_required
+def api_restore_file(file_id):
+    if not restore_files(current_user.id, File.id == file_id):
+        return jsonify(error="Файла нет в корзине"), 404
+    db.session.commit()
+    return jsonify(file_to_dict(db.session.get(File, file_id)))
+
+
+@app.route(f"{API_PREFIX}/trash/<int:file_id>", methods=["DELETE"])
+@api_login_required
+def api_purge_file(file_id):
+    if not schedule_purge(current_user.id, File.id == file_id):
+        return jsonify(error="Файла нет в корзине"), 404
+    db.session.commit()
+    return "", 204
+
+
+def purge_expired(batch_size, rate):
+    """
+    Окончательно удаляет все файлы с истёкшим сроком в корзине, пачками
+    по batch_size и не быстрее rate файлов в секунду (0 — без ограничения).
+
+    :return: число удалённых файлов
+    """
+    purged = 0
+    while True:
+        started = time.monotonic()
+        batch = (
+            File.query.filter(File.deleted_at.isnot(None), File.purge_at <= datetime.now())
+            .order_by(File.purge_at, File.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            return purged
+        purge_file_records(batch)
+        purged += len(batch)
+
+        # Ограничение скорости, чтобы удаление не мешало работающему сервису
+        if rate > 0:
+            time.sleep(max(0.0, len(batch) / rate - (time.monotonic() - started)))
+
+
+@app.cli.command("purge-trash")
+@click.option("--batch-size", default=200, show_default=True)
+@click.option(
+    "--rate",
+    type=float,
+    default=None,
+    help="Не больше стольких файлов в секунду (по умолчанию TRASH_PURGE_FILES_PER_SECOND, 0 — без ограничения)",
+)
+@click.option("--once", is_flag=True, help="Удалить файлы с истёкшим сроком и выйти")
+def purge_trash(batch_size, rate, once):
+    """Окончательно удаляет файлы, срок хранения которых в корзине истёк"""
+    if rate is None:
+        rate = app.config["TRASH_PURGE_FILES_PER_SECOND"]
+    logger.info("Очистка корзины запущена")
+    while True:
+        purged = purge_expired(batch_size, rate)
+        if purged:
+            logger.info("Из корзины окончательно удалено файлов: %d", purged)
+        if once:
+            click.echo(f"Окончательно удалено файлов: {purged}")
+            break
+        time.sleep(app.config["TRASH_PURGE_INTERVAL"])
+
+
+def count_purge_backlog():
+    """Файлы, которые уже можно удалить окончательно, — растёт, если очистка не запущена"""
+    count = (
+        db.session.query(func.count(File.id))
+        .filter(File.deleted_at.isnot(None), File.purge_at <= datetime.now())
+        .scalar()
+    )
+    return {(): count}
+
+
+REGISTRY.append(
+    CallbackGauge(
+        "nestcloud_trash_purge_backlog",
+        "Файлы корзины с истёкшим сроком, ещё не удалённые окончательно",
+        (),
+        count_purge_backlog,
+    )
+)
@@ -0,0 +1,389 @@
+"""
+Возобновляемая загрузка больших файлов по частям.
+
+Клиент создаёт сессию, отправляет чанки фиксированного размера в любом порядке
+(в том числе параллельно), может спросить, какие чанки уже получены, и завершает
+сессию. Каждый чанк пишется сразу на своё место в итоговом файле, а запись File
+создаётся только при завершении.
+
+Сессия с file_id загружает новую версию существующего файла: чанками служат
+блоки манифеста клиента (nestcloud.chunking), а уже известные серверу блоки
+копируются в сессию при её создании (см. nestcloud.versions).
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+import click
+from flask import request, jsonify, abort
+from flask_login import login_required, current_user
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from nestcloud import app, db, storage, versions, folders
+from nestcloud.files import create_file_record, get_own_file, remove_paths, remove_released
+from nestcloud.metrics import FILES_UPLOADED, UPLOAD_FAILURES, timed
+from nestcloud.models import File, UploadSession, UploadChunk
+from nestcloud.quota import fits_quota
+from utils import (
+    get_user_folder,
+    make_stored_filename,
+    describe_stored_file,
+    is_compressible_format,
+)
+
+logger = logging.getLogger(__name__)
+
+# Размер блока, которым тело запроса копируется в файл
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def get_own_session(session_id):
+    """Возвращает сессию текущего пользователя или прерывает запрос"""
+    upload = db.get_or_404(UploadSession, session_id)
+    if upload.user_id != current_user.id:
+        abort(403)
+    return upload
+
+
+def get_part_path(upload):
+    """Путь к недокачанному файлу сессии"""
+    return storage.resolve_user_path(upload.user_id, upload.stored_filename + ".part")
+
+
+def should_compress(filename, part_path):
+    """Сжимать ли собранный файл: формат допускает сжатие и начало файла хорошо сжимается"""
+    if not storage.is_compression_enabled() or not is_compressible_format(filename):
+        return False
+    with open(part_path, "rb") as part:
+        return storage.is_compressible(part.read(app.config["COMPRESSION_SAMPLE_BYTES"]))
+
+
+def session_to_dict(upload, received):
+    data = {
+        "id": upload.id,
+        "filename": upload.filename,
+        "size": upload.total_size,
+        "chunk_size": upload.chunk_size,
+        "chunk_count": upload.chunk_count,
+        "received": sorted(received),
+        "received_offsets": [upload.chunk_offset(i) for i in sorted(received)],
+    }
+    if upload.file_id is not None:
+        data["file_id"] = upload.file_id
+        data["missing"] = [i for i in range(upload.chunk_count) if i not in received]
+    return data
+
+
+def remove_session(upload):
+    """Удаляет сессию вместе с недокачанным файлом (без коммита)"""
+    part_path = get_part_path(upload)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    db.session.delete(upload)
+
+
+def get_expiry_cutoff():
+    """Сессии, созданные раньше этого момента, просрочены"""
+    return datetime.now() - timedelta(hours=app.config["UPLOAD_SESSION_TTL_HOURS"])
+
+
+def is_expired(upload):
+    return upload.created_at < get_expiry_cutoff()
+
+
+def expired_session_response(upload):
+    """Удаляет просроченную сессию; клиент начинает загрузку заново"""
+    remove_session(upload)
+    db.session.commit()
+    logger.info("Просроченная сессия загрузки удалена: %s", upload.id)
+    return jsonify(error="Сессия загрузки истекла, начните загрузку заново"), 410
+
+
+def cleanup_expired_sessions(user_id=None, limit=None):
+    """
+    Удаляет просроченные сессии пользователя (None — всех пользователей).
+    Коммит остаётся за вызывающим кодом.
+
+    :return: число удалённых сессий
+    """
+    query = UploadSession.query.filter(UploadSession.created_at < get_expiry_cutoff())
+    if user_id is not None:
+        query = query.filter(UploadSession.user_id == user_id)
+    expired = query.order_by(UploadSession.created_at).limit(limit).all()
+    for upload in expired:
+        remove_session(upload)
+        logger.info("Просроченная сессия загрузки удалена: %s", upload.id)
+    return len(expired)
+
+
+@app.route("/upload/sessions", methods=["POST"])
+@login_required
+def create_upload_session():
+    """
+    Создаёт сессию загрузки и резервирует место под итоговый файл.
+    С file_id и chunks — сессию новой версии файла: известные блоки копируются сразу.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get("filename", "")).strip()
+    try:
+        total_size = int(data.get("size", -1))
+    except (TypeError, ValueError):
+        total_size = -1
+
+    target = manifest = None
+    if data.get("file_id") is not None:
+        try:
+            target = get_own_file(int(data["file_id"]))
+        except (TypeError, ValueError):
+            return jsonify(error="Неверный file_id"), 400
+        manifest, error = versions.parse_chunks(data.get("chunks"))
+        if error:
+            return jsonify(error=error), 400
+        chunks_size = sum(size for _, size in manifest)
+        if total_size < 0:
+            total_size = chunks_size
+        if total_size != chunks_size:
+            return jsonify(error="Размер файла не совпадает с суммой блоков"), 400
+        filename = filename or target.filename
+    folder = folders.get_target_folder(data.get("folder_id")) if target is None else None
+
+    if not filename:
+        return jsonify(error="Не указано имя файла"), 400
+    if total_size < 0:
+        return jsonify(error="Не указан размер файла"), 400
+    if total_size > app.config["UPLOAD_SESSION_MAX_SIZE"]:
+        return jsonify(error="Файл слишком большой"), 413
+
+    cleanup_expired_sessions(current_user.id)
+
+    # Квота проверяется до передачи данных, с учётом уже начатых загрузок
+    reserved = (
+        db.session.query(func.coalesce(func.sum(UploadSession.total_size), 0))
+        .filter(UploadSession.user_id == current_user.id)
+        .scalar()
+    )
+    # Новая версия занимает квоту целиком: прежнее содержимое остаётся версией
+    if not fits_quota(current_user, reserved + total_size):
+        return jsonify(error="Недостаточно места: квота хранилища исчерпана"), 413
+
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=current_user.id,
+        filename=filename,
+        stored_filename=storage.make_file_relpath(make_stored_filename(filename)),
+        total_size=total_size,
+        chunk_size=app.config["UPLOAD_CHUNK_SIZE"],
+        file_id=target.id if target else None,
+        folder_id=folder.id if folder else None,
+        manifest=json.dumps(manifest) if target else None,
+    )
+
+    # Создаём разреженный файл итогового размера: чанки пишутся сразу на свои места
+    part_path = get_part_path(upload)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    with open(part_path, "wb") as part:
+        part.truncate(total_size)
+
+    received = []
+    if target:
+        with timed("copy_known_chunks"):
+            received = versions.copy_known_chunks(target, manifest, part_path)
+        for index in received:
+            upload.chunks.append(UploadChunk(index=index))
+
+    db.session.add(upload)
+    db.session.commit()
+    logger.info(
+        "Создана сессия загрузки %s для файла %s (известных блоков: %d)",
+        upload.id,
+        filename,
+        len(received),
+    )
+    return jsonify(session_to_dict(upload, received)), 201
+
+
+@app.route("/upload/sessions/<session_id>", methods=["GET"])
+@login_required
+def upload_session_status(session_id):
+    """Сообщает, какие чанки уже сохранены"""
+    upload = get_own_session(session_id)
+    if is_expired(upload):
+        return expired_session_response(upload)
+    received = [chunk.index for chunk in upload.chunks]
+    return jsonify(session_to_dict(upload, received))
+
+
+@app.route("/upload/sessions/<session_id>/chunks/<int:index>", methods=["PUT"])
+@login_required
+def upload_chunk(session_id, index):
+    """Записывает тело запроса на место чанка с номером index"""
+    upload = get_own_session(session_id)
+    if is_expired(upload):
+        return expired_session_response(upload)
+    if index >= upload.chunk_count:
+        return jsonify(error="Неверный номер чанка"), 400
+
+    expected = upload.chunk_length(index)
+    if request.content_length is not None and request.content_length != expected:
+        return jsonify(error=f"Ожидается чанк размером {expected} байт"), 400
+
+    # Блок новой версии сверяется с хешем из манифеста сессии
+    digest = hashlib.sha256() if upload.manifest_entries is not None else None
+    written = 0
+    with open(get_part_path(upload), "r+b") as part:
+        part.seek(upload.chunk_offset(index))
+        while written < expected:
+            block = request.stream.read(min(COPY_BUFFER_SIZE, expected - written))
+            if not block:
+                break
+            part.write(block)
+            if digest is not None:
+                digest.update(block)
+            written += len(block)
+
+    if written != expected:
+        return jsonify(error=f"Получено {written} из {expected} байт"), 400
+    if digest is not None and digest.hexdigest() != upload.manifest_entries[index][0]:
+        return jsonify(error="Хеш блока не совпадает с манифестом"), 400
+
+    # Повторная отправка того же чанка допустима: запись уже есть
+    if db.session.get(UploadChunk, (upload.id, index)) is None:
+        try:
+            db.session.add(UploadChunk(session_id=upload.id, index=index))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+    return jsonify(index=index, offset=upload.chunk_offset(index), size=written)
+
+
+@app.route("/upload/sessions/<session_id>/complete", methods=["POST"])
+@login_required
+def complete_upload_session(session_id):
+    """Проверяет, что все чанки получены, и создаёт запись File (или новую версию файла)"""
+    upload = get_own_session(session_id)
+    if is_expired(upload):
+        return expired_session_response(upload)
+    received = {chunk.index for chunk in upload.chunks}
+    missing = [i for i in range(upload.chunk_count) if i not in received]
+    if missing and upload.total_size > 0:
+        return jsonify(error="Получены не все чанки", missing=missing), 409
+
+    target = None
+    if upload.file_id is not None:
+        target = db.session.get(File, upload.file_id)
+        if target is None or target.deleted_at is not None:
+            # Файл удалён, пока шла загрузка его новой версии
+            remove_session(upload)
+            db.session.commit()
+            return jsonify(error="Файл не найден"), 404
+    if not fits_quota(current_user, upload.total_size):
+        return jsonify(error="Недостаточно места: квота хранилища исчерпана"), 413
+
+    user_folder = get_user_folder(upload.user_id)
+    filepath = storage.resolve_user_path(upload.user_id, upload.stored_filename)
+    temp_path = get_part_path(upload)
+
+    # Изменения на диске до коммита: если он не удастся, они отменяются и
+    # сессия остаётся целой — завершение можно повторить
+    moved_to = None  # куда перенесён файл сессии (при ошибке — обратно)
+    written_path = None  # файл, записанный рядом с файлом сессии (при ошибке — удаляется)
+    try:
+        # Чанки приходят в произвольном порядке, поэтому хеш считается здесь,
+        # одним последовательным чтением собранного файла
+        if should_compress(upload.filename, temp_path):
+            # Сжатие идёт тем же проходом, что и подсчёт хеша
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            written_path = filepath
+            with open(temp_path, "rb") as source, timed("file_save"):
+                content = storage.write_content(source, filepath, compress=True)
+            content_hash = content["content_hash"]
+            saved_data = describe_stored_file(filepath, upload.filename, user_folder, content)
+            saved_data["stored_filename"] = upload.stored_filename
+        else:
+            with timed("hash_file"):
+                content_hash = storage.hash_file(temp_path)
+            if storage.is_cas_enabled():
+                blob_path, moved = storage.place_blob(temp_path, content_hash)
+                if moved:
+                    moved_to = blob_path
+                saved_data = describe_stored_file(blob_path, upload.filename, user_folder)
+                saved_data["stored_filename"] = upload.stored_filename
+                saved_data["blob_hash"] = content_hash
+            else:
+                os.replace(temp_path, filepath)
+                moved_to = filepath
+                saved_data = describe_stored_file(filepath, upload.filename, user_folder)
+                saved_data["stored_filename"] = upload.stored_filename
+        saved_data["content_hash"] = content_hash
+
+        released = ([], [])
+        if target is not None:
+            new_file = target
+            released = versions.add_version(target, saved_data, upload.manifest_entries)
+        else:
+            new_file = create_file_record(saved_data, upload.user_id, upload.folder_id)
+        db.session.delete(upload)
+        with timed("db_commit"):
+            db.session.commit()
+    except Exception:
+        # Файл возвращается на место до отката: пока транзакция не отменена,
+        # новый блоб с тем же хешем не может занять параллельная загрузка
+        if moved_to is not None:
+            os.replace(moved_to, temp_path)
+        if written_path is not None:
+            remove_paths([written_path])
+        db.session.rollback()
+        UPLOAD_FAILURES.inc()
+        logger.exception("Ошибка при завершении сессии загрузки %s", session_id)
+        return jsonify(error="Ошибка при сохранении файла"), 500
+
+    # Файл сессии не стал файлом или блобом (сжат или такой блоб уже был)
+    if moved_to is None:
+        remove_paths([temp_path])
+    remove_released(*released)
+    FILES_UPLOADED.inc()
+    logger.info(
+        "Сессия %s завершена, файл сохранён: %s", session_id, saved_data["absolute_path"]
+    )
+    return (
+        jsonify(
+            id=new_file.id,
+            filename=new_file.filename,
+            size=new_file.file_size,
+            version=new_file.version,
+        ),
+        201,
+    )
+
+
+@app.route("/upload/sessions/<session_id>", methods=["DELETE"])
+@login_required
+def cancel_upload_session(session_id):
+    """Отменяет загрузку и удаляет недокачанный файл"""
+    upload = get_own_session(session_id)
+    remove_session(upload)
+    db.session.commit()
+    return "", 204
+
+
+@app.cli.command("expire-upload-sessions")
+@click.option("--batch-size", default=200, show_default=True)
+def expire_upload_sessions(batch_size):
+    """
+    Удаляет сессии загрузки старше UPLOAD_SESSION_TTL_HOURS вместе с недокачанными
+    файлами (запускайте по расписанию, например из cron)
+    """
+    removed = 0
+    while True:
+        count = cleanup_expired_sessions(limit=batch_size)
+        db.session.commit()
+        removed += count
+        if count < batch_size:
+            break
+    click.echo(f"Удалено просроченных сессий: {removed}")
@@ -0,0 +1,337 @@
+"""
+Версии файлов и загрузка новой версии по блокам (дельта-загрузка).
+
+Запись File всегда описывает текущую версию: скачивание, превью и поиск
+работают с ней как раньше. При загрузке новой версии прежнее содержимое
+переходит в запись FileVersion и хранится по правилам VERSION_KEEP_*.
+
+Клиент берёт манифест текущей версии (GET /api/v1/files/<id>/manifest),
+разбивает новое содержимое тем же алгоритмом (nestcloud.chunking) и создаёт
+сессию загрузки с file_id и своим списком блоков. Блоки, которые уже есть
+в текущей или прежних версиях, сервер сразу копирует на место в сессии —
+клиенту остаётся отправить только недостающие (см. upload_sessions).
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import re
+
+import click
+from flask import jsonify, url_for
+from flask_login import login_required
+from sqlalchemy import func
+from sqlalchemy.orm import undefer
+
+from nestcloud import app, db, storage, chunking
+from nestcloud.api import API_PREFIX, api_login_required
+from nestcloud.files import (
+    get_own_file,
+    release_contents,
+    unused_preview_paths,
+    remove_released,
+)
+from nestcloud.models import FileVersion, update_user_usage
+from nestcloud.previews import enqueue_preview
+from nestcloud.security import user_cache
+from nestcloud.transfer import send_stored_file, guess_mimetype
+
+logger = logging.getLogger(__name__)
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def get_manifest(file_record):
+    """
+    Манифест текущей версии файла. Для файлов, загруженных целиком,
+    строится при первом запросе и сохраняется (коммит за вызывающим кодом).
+    """
+    if file_record.manifest is None:
+        path = storage.get_file_path(file_record)
+        with storage.open_content(path, file_record.encoding) as source:
+            file_record.manifest = json.dumps(chunking.build_manifest(source))
+    return json.loads(file_record.manifest)
+
+
+def parse_chunks(chunks):
+    """
+    Проверяет список блоков новой версии от клиента.
+
+    :param chunks: [{"hash": SHA-256, "size": байты}, ...]
+    :return: (манифест [[hash, size], ...], None) или (None, текст ошибки)
+    """
+    if not isinstance(chunks, list):
+        return None, "Список блоков должен быть массивом"
+    manifest = []
+    for i, chunk in enumerate(chunks):
+        if not isinstance(chunk, dict):
+            return None, f"Неверный блок {i}"
+        chunk_hash = str(chunk.get("hash", "")).lower()
+        size = chunk.get("size")
+        if not SHA256_RE.match(chunk_hash):
+            return None, f"Неверный хеш блока {i}"
+        # Все блоки, кроме последнего, — в пределах размеров алгоритма разбиения
+        min_size = 1 if i == len(chunks) - 1 else chunking.MIN_SIZE
+        if not isinstance(size, int) or not min_size <= size <= chunking.MAX_SIZE:
+            return None, f"Неверный размер блока {i}"
+        manifest.append([chunk_hash, size])
+    return manifest, None
+
+
+def get_version_sources(file_record):
+    """Текущая и прежние версии файла с известными манифестами"""
+    versions = (
+        FileVersion.query.options(undefer(FileVersion.manifest))
+        .filter(FileVersion.file_id == file_record.id, FileVersion.manifest.isnot(None))
+        .order_by(FileVersion.number.desc())
+        .all()
+    )
+    sources = [(file_record, get_manifest(file_record))]
+    sources += [(version, json.loads(version.manifest)) for version in versions]
+    return sources
+
+
+def copy_known_chunks(file_record, manifest, part_path):
+    """
+    Копирует в файл сессии блоки нового манифеста, которые уже хранятся
+    в версиях файла. Каждая версия читается один раз, по возрастанию смещения
+    (сжатое содержимое распаковывается потоком без перемоток назад).
+
+    :return: номера скопированных блоков
+    """
+    needed = {}
+    offset = 0
+    for index, (chunk_hash, size) in enumerate(manifest):
+        needed.setdefault((chunk_hash, size), []).append((index, offset))
+        offset += size
+
+    # Для каждой версии — список (смещение в версии, размер, хеш, [(номер, смещение)])
+    plan = []
+    for record, source_manifest in get_version_sources(file_record):
+        copies = []
+        source_offset = 0
+        for chunk_hash, size in source_manifest:
+            targets = needed.pop((chunk_hash, size), None)
+            if targets:
+                copies.append((source_offset, size, chunk_hash, targets))
+            source_offset += size
+        if copies:
+            plan.append((record, copies))
+        if not needed:
+            break
+
+    copied = []
+    with open(part_path, "r+b") as part:
+        for record, copies in plan:
+            path = storage.get_file_path(record)
+            with storage.open_content(path, record.encoding) as source:
+                for source_offset, size, chunk_hash, targets in copies:
+                    source.seek(source_offset)
+                    data = source.read(size)
+                    # Содержимое на диске могло измениться — такой блок клиент пришлёт сам
+                    if hashlib.sha256(data).hexdigest() != chunk_hash:
+                        logger.warning(
+                            "Блок %s не совпал с манифестом содержимого %s", chunk_hash, path
+                        )
+                        continue
+                    for index, target_offset in targets:
+                        part.seek(target_offset)
+                        part.write(data)
+                        copied.append(index)
+    return copied
+
+
+def add_version(file_record, saved_data, manifest):
+    """
+    Делает сохранённое содержимое новой текущей версией файла: прежнее
+    переходит в FileVersion, затем применяются правила хранения версий.
+    Прежние версии входят в занятое место пользователя. Коммит остаётся
+    за вызывающим кодом.
+
+    :param saved_data: данные describe_stored_file (как для create_file_record)
+    :param manifest: манифест нового содержимого
+    :return: (пути, блобы) для files.remove_released после коммита
+    """
+    db.session.add(
+        FileVersion(
+            file_id=file_record.id,
+            user_id=file_record.user_id,
+            number=file_record.version,
+            stored_filename=file_record.stored_filename,
+            blob_hash=file_record.blob_hash,
+            size_bytes=file_record.size_bytes,
+            stored_size=file_record.stored_size,
+            encoding=file_record.encoding,
+            content_hash=file_record.content_hash,
+            manifest=file_record.manifest,
+            created_at=file_record.upload_time,
+        )
+    )
+    # Событие File учтёт только разницу размеров — прежнее содержимое остаётся версией
+    update_user_usage(
+        db.session.connection(), file_record.user_id, file_record.size_bytes or 0, 0
+    )
+    old_preview = file_record.preview_path
+
+    file_record.stored_filename = saved_data["stored_filename"]
+    file_record.blob_hash = saved_data.get("blob_hash")
+    file_record.file_size = saved_data["human_size"]
+    file_record.size_bytes = saved_data["size_bytes"]
+    file_record.stored_size = saved_data.get("stored_size")
+    file_record.encoding = saved_data.get("encoding")
+    file_record.upload_time = saved_data["upload_time"]
+    file_record.sample_hash = saved_data.get("sample_hash")
+    file_record.content_hash = saved_data.get("content_hash")
+    file_record.preview_path = saved_data["preview_relpath"]
+    file_record.preview_status = saved_data["preview_status"]
+    file_record.manifest = json.dumps(manifest)
+    file_record.version += 1
+
+    # Превью прежнего содержимого больше не подходит — строим заново
+    job = file_record.preview_job
+    if file_record.preview_status == "pending" and job is not None:
+        job.status = "pending"
+        job.attempts = 0
+        job.claimed_by = None
+        job.claimed_at = None
+        job.last_error = None
+    else:
+        enqueue_preview(file_record)
+
+    paths, orphaned_blobs = release_contents(select_expired_versions(file_record.id))
+    paths += unused_preview_paths(file_record.user_id, [old_preview])
+    return paths, orphaned_blobs
+
+
+def select_expired_versions(file_id):
+    """
+    Удаляет из сессии версии файла сверх VERSION_KEEP_COUNT и старше
+    VERSION_KEEP_DAYS (0 — без ограничения), освобождает занятое ими место
+    и возвращает их
+    """
+    keep_count = app.config["VERSION_KEEP_COUNT"]
+    keep_days = app.config["VERSION_KEEP_DAYS"]
+    versions = (
+        FileVersion.query.filter_by(file_id=file_id)
+        .order_by(FileVersion.number.desc())
+        .all()
+    )
+    cutoff = datetime.now() - timedelta(days=keep_days)
+    expired = [
+        version
+        for i, version in enumerate(versions)
+        if (keep_count and i >= keep_count)
+        or (keep_days and version.replaced_at < cutoff)
+    ]
+    for version in expired:
+        db.session.delete(version)
+    freed_bytes = sum(version.size_bytes or 0 for version in expired)
+    if freed_bytes:
+        update_user_usage(db.session.connection(), expired[0].user_id, -freed_bytes, 0)
+        user_cache.invalidate(expired[0].user_id)
+    return expired
+
+
+def version_to_dict(version):
+    return {
+        "number": version.number,
+        "size": version.size_bytes,
+        "upload_time": version.created_at.isoformat() if version.created_at else None,
+        "replaced_at": version.replaced_at.isoformat(),
+        "download_url": url_for(
+            "download_file_version", file_id=version.file_id, number=version.number
+        ),
+    }
+
+
+@app.route(f"{API_PREFIX}/files/<int:file_id>/versions", methods=["GET"])
+@api_login_required
+def api_file_versions(file_id):
+    """Текущая и прежние версии файла, от новых к старым"""
+    file_record = get_own_file(file_id)
+    versions = (
+        FileVersion.query.filter_by(file_id=file_record.id)
+        .order_by(FileVersion.number.desc())
+        .all()
+    )
+    return jsonify(
+        current=file_record.version,
+        versions=[version_to_dict(version) for version in versions],
+    )
+
+
+@app.route(f"{API_PREFIX}/files/<int:file_id>/manifest", methods=["GET"])
+@api_login_required
+def api_file_manifest(file_id):
+    """Манифест текущей версии — по нему клиент решает, какие блоки отправлять"""
+    file_record = get_own_file(file_id)
+    was_built = file_record.manifest is not None
+    manifest = get_manifest(file_record)
+    if not was_built:
+        db.session.commit()
+    return jsonify(
+        id=file_record.id,
+        version=file_record.version,
+        size=file_record.size_bytes,
+        chunking=chunking.get_parameters(),
+        chunks=[{"hash": chunk_hash, "size": size} for chunk_hash, size in manifest],
+    )
+
+
+@app.route("/download/<int:file_id>/versions/<int:number>")
+@login_required
+def download_file_version(file_id, number):
+    """Скачивает прежнюю версию файла"""
+    file_record = get_own_file(file_id)
+    version = FileVersion.query.filter_by(
+        file_id=file_record.id, number=number
+    ).first_or_404()
+    return send_stored_file(
+        storage.get_file_path(version),
+        download_name=file_record.filename,
+        etag=storage.get_content_etag(version),
+        last_modified=version.created_at,
+        mimetype=guess_mimetype(file_record.filename),
+        encoding=version.encoding,
+        size=version.size_bytes,
+    )
+
+
+@app.cli.command("prune-versions")
+@click.option("--batch-size", default=200, show_default=True)
+def prune_versions(batch_size):
+    """
+    Удаляет прежние версии файлов по правилам VERSION_KEEP_COUNT
+    и VERSION_KEEP_DAYS (при загрузке новой версии они применяются сразу,
+    команда нужна для версий, устаревших со временем).
+    """
+    keep_count = app.config["VERSION_KEEP_COUNT"]
+    keep_days = app.config["VERSION_KEEP_DAYS"]
+    conditions = []
+    if keep_count:
+        conditions.append(func.count(FileVersion.id) > keep_count)
+    if keep_days:
+        cutoff = datetime.now() - timedelta(days=keep_days)
+        conditions.append(func.min(FileVersion.replaced_at) < cutoff)
+    if not conditions:
+        click.echo("Ограничения хранения версий не заданы")
+        return
+
+    file_ids = [
+        file_id
+        for (file_id,) in db.session.query(FileVersion.file_id)
+        .group_by(FileVersion.file_id)
+        .having(db.or_(*conditions))
+        .order_by(FileVersion.file_id)
+    ]
+    removed = 0
+    for start in range(0, len(file_ids), batch_size):
+        expired = []
+        for file_id in file_ids[start : start + batch_size]:
+            expired += select_expired_versions(file_id)
+        paths, orphaned_blobs = release_contents(expired)
+        db.session.commit()
+        remove_released(paths, orphaned_blobs)
+        removed += len(expired)
+    click.echo(f"Удалено версий: {removed}")
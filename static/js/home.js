@@ -22,41 +22,52 @@ document.addEventListener('DOMContentLoaded', function () {
     return Math.round(bytes / Math.pow(k, i) * 100) / 100 + ' ' + sizes[i];
   };
 
-  // Функция для получения списка уже загруженных файлов
-  const getUploadedFiles = function() {
-    const files = [];
-    const tbody = document.getElementById('filesTableBody');
-    if (tbody) {
-      const rows = tbody.querySelectorAll('tr');
-      rows.forEach(function(row) {
-        const filename = row.dataset.filename;
-        const fileSize = row.dataset.fileSize;
-        if (filename && fileSize) {
-          files.push({
-            name: filename,
-            size: fileSize
-          });
-        }
-      });
-    }
-    return files;
+  // Отпечаток файла для поиска дубликатов на сервере — тот же алгоритм,
+  // что storage.sample_hash_file: SHA-256 от "<размер>:", первых и последних 4 КБ
+  const SAMPLE_BYTES = 4096;
+  const DUPLICATE_CHECK_BATCH = 500;
+
+  const toHex = function(buffer) {
+    return Array.from(new Uint8Array(buffer)).map(function(b) {
+      return b.toString(16).padStart(2, '0');
+    }).join('');
   };
 
-  // Функция для парсинга размера файла в байты
-  const parseFileSize = function(sizeStr) {
-    if (!sizeStr) return 0;
-    const units = {
-      'B': 1,
-      'KB': 1024,
-      'MB': 1024 * 1024,
-      'GB': 1024 * 1024 * 1024,
-      'TB': 1024 * 1024 * 1024 * 1024
-    };
-    const match = sizeStr.trim().match(/^([\d.]+)\s*([A-Z]+)$/i);
-    if (!match) return 0;
-    const value = parseFloat(match[1]);
-    const unit = match[2].toUpperCase();
-    return value * (units[unit] || 1);
+  const sampleHash = function(file) {
+    const tailStart = Math.max(SAMPLE_BYTES, file.size - SAMPLE_BYTES);
+    const parts = [new TextEncoder().encode(file.size + ':'), file.slice(0, SAMPLE_BYTES)];
+    if (file.size > tailStart) parts.push(file.slice(tailStart, file.size));
+    return new Blob(parts).arrayBuffer().then(function(data) {
+      return crypto.subtle.digest('SHA-256', data);
+    }).then(toHex);
+  };
+
+  // Спрашивает сервер, какие из файлов уже загружены (до отправки содержимого).
+  // Возвращает массив той же длины: описание найденной копии или null
+  const findDuplicates = function(files) {
+    if (!window.crypto || !crypto.subtle) {
+      // Вне защищённого контекста (не https) хеш не посчитать — проверка пропускается
+      return Promise.resolve(files.map(function() { return null; }));
+    }
+    const batches = [];
+    for (let i = 0; i < files.length; i += DUPLICATE_CHECK_BATCH) {
+      batches.push(files.slice(i, i + DUPLICATE_CHECK_BATCH));
+    }
+    return Promise.all(batches.map(function(batch) {
+      return Promise.all(batch.map(sampleHash)).then(function(hashes) {
+        return requestJson('POST', '/api/v1/files/check-duplicates', {
+          files: batch.map(function(file, i) {
+            return { name: file.name, size: file.size, sample_hash: hashes[i] };
+          })
+        });
+      }).then(function(data) {
+        return data.results.map(function(result) { return result.duplicate_of; });
+      });
+    })).then(function(results) {
+      return [].concat.apply([], results);
+    }).catch(function() {
+      return files.map(function() { return null; });
+    });
   };
 
   // Функция для показа ошибки
@@ -88,43 +99,71 @@ document.addEventListener('DOMContentLoaded', function () {
 
   // Переменная для отслеживания последнего отправленного файла (чтобы предотвратить двойную отправку)
   let isUploading = false;
+  const MAX_FILE_SIZE = 512 * 1024 * 1024; // 512 МБ в байтах
 
-  fileInput.addEventListener('change', function () {
-    if (fileInput.files && fileInput.files.length > 0) {
-      const file = fileInput.files[0];
-      const fileName = file.name;
-      const fileSize = file.size;
-      const maxSize = 512 * 1024 * 1024; // 512 МБ в байтах
-
-      // Проверка размера файла
-      if (fileSize > maxSize) {
-        showError('Файл слишком большой! Максимальный размер — 512 МБ. Выбранный файл: ' + formatFileSize(fileSize));
-        fileInput.value = '';
-        resetLabels();
-        return;
+  // Выбранные для загрузки файлы (из выбора файлов или папки)
+  let selectedFiles = [];
+
+  const selectFiles = function (files) {
+    const skipped = [];
+    selectedFiles = [];
+
+    // Проверка размера файла
+    const candidates = files.filter(function (file) {
+      if (file.size > MAX_FILE_SIZE) {
+        skipped.push(file.name + ' (больше 512 МБ)');
+        return false;
       }
+      return true;
+    });
+
+    labelPrimary.textContent = 'Проверка файлов…';
+    labelSecondary.textContent = '';
 
-      // Проверка на дубликаты
-      const uploadedFiles = getUploadedFiles();
-      const duplicate = uploadedFiles.find(function(uploaded) {
-        return uploaded.name === fileName && 
-               Math.abs(parseFileSize(uploaded.size) - fileSize) < 1024; // Допуск 1KB
+    // Проверка на дубликаты
+    return findDuplicates(candidates).then(function (duplicates) {
+      candidates.forEach(function (file, i) {
+        if (duplicates[i]) {
+          skipped.push(file.name + ' (уже загружен как "' + duplicates[i].filename + '")');
+        } else {
+          selectedFiles.push(file);
+        }
       });
 
-      if (duplicate) {
-        showError('Файл с именем "' + fileName + '" уже загружен. Выберите другой файл или переименуйте существующий.');
-        fileInput.value = '';
+      if (skipped.length > 0) {
+        showError('Пропущено файлов: ' + skipped.length + '. ' + skipped.slice(0, 3).join(', ') +
+          (skipped.length > 3 ? '…' : ''));
+      }
+
+      if (selectedFiles.length === 0) {
         resetLabels();
-        return;
+      } else if (selectedFiles.length === 1) {
+        labelPrimary.textContent = selectedFiles[0].name;
+        labelSecondary.textContent = formatFileSize(selectedFiles[0].size) + ' • нажмите, чтобы выбрать другой файл';
+      } else {
+        const totalSize = selectedFiles.reduce(function (sum, file) { return sum + file.size; }, 0);
+        labelPrimary.textContent = 'Выбрано файлов: ' + selectedFiles.length;
+        labelSecondary.textContent = formatFileSize(totalSize) + ' • нажмите, чтобы выбрать другие';
       }
+    });
+  };
 
-      labelPrimary.textContent = fileName;
-      labelSecondary.textContent = formatFileSize(fileSize) + ' • нажмите, чтобы выбрать другой файл';
-    } else {
-      resetLabels();
-    }
+  fileInput.addEventListener('change', function () {
+    selectFiles(Array.from(fileInput.files || []));
   });
 
+  const folderInput = document.getElementById('folderInput');
+  const selectFolderBtn = document.getElementById('selectFolderBtn');
+  if (folderInput && selectFolderBtn) {
+    selectFolderBtn.addEventListener('click', function () {
+      folderInput.click();
+    });
+    folderInput.addEventListener('change', function () {
+      fileInput.value = '';
+      selectFiles(Array.from(folderInput.files || []));
+    });
+  }
+
   const timedAlerts = document.querySelectorAll('.alert-timed');
   timedAlerts.forEach(function (alert) {
     const duration = parseInt(alert.dataset.duration, 10) || 5000;
@@ -142,6 +181,16 @@ document.addEventListener('DOMContentLoaded', function () {
   });
 
   // Обработка модального окна переименования
+  const renameFolderModal = document.getElementById('renameFolderModal');
+  if (renameFolderModal) {
+    renameFolderModal.addEventListener('show.bs.modal', function (event) {
+      const button = event.relatedTarget;
+      renameFolderModal.querySelector('#renameFolderForm').action =
+        '/folders/' + button.getAttribute('data-folder-id') + '/rename';
+      renameFolderModal.querySelector('#newFolderName').value = button.getAttribute('data-folder-name');
+    });
+  }
+
   const renameModal = document.getElementById('renameModal');
   if (renameModal) {
     const newFilenameInput = renameModal.querySelector('#newFilename');
@@ -198,134 +247,379 @@ document.addEventListener('DOMContentLoaded', function () {
     }
   }
 
-  // Функция сортировки файлов
-  const sortFiles = function(sortType) {
-    const tbody = document.getElementById('filesTableBody');
-    if (!tbody) return;
-
-    const rows = Array.from(tbody.querySelectorAll('tr'));
-    if (rows.length === 0) return;
-
-    // Функция для парсинга размера файла в байты
-    const parseFileSize = function(sizeStr) {
-      if (!sizeStr) return 0;
-      const units = {
-        'B': 1,
-        'KB': 1024,
-        'MB': 1024 * 1024,
-        'GB': 1024 * 1024 * 1024,
-        'TB': 1024 * 1024 * 1024 * 1024
-      };
-      const match = sizeStr.trim().match(/^([\d.]+)\s*([A-Z]+)$/i);
-      if (!match) return 0;
-      const value = parseFloat(match[1]);
-      const unit = match[2].toUpperCase();
-      return value * (units[unit] || 1);
-    };
+  // Превью изображений загружаются пачками: один запрос /preview/batch
+  // на страницу списка вместо отдельного запроса на каждую строку
+  const PREVIEW_BATCH_SIZE = 100;
 
-    // Функция для парсинга времени
-    const parseTime = function(timeStr) {
-      return new Date(timeStr).getTime();
-    };
+  const loadBatchPreviews = function() {
+    const images = Array.from(document.querySelectorAll('img[data-preview-id]:not([data-preview-loaded])'));
+    for (let i = 0; i < images.length; i += PREVIEW_BATCH_SIZE) {
+      const batch = images.slice(i, i + PREVIEW_BATCH_SIZE);
+      // Пока запрос выполняется, повторно эти изображения не запрашиваем
+      batch.forEach(function(img) { img.dataset.previewLoaded = '1'; });
+      const ids = batch.map(function(img) { return img.dataset.previewId; });
+      fetch('/preview/batch?ids=' + ids.join(','), { credentials: 'same-origin' })
+        .then(function(response) {
+          if (!response.ok) throw new Error('HTTP ' + response.status);
+          return response.json();
+        })
+        .then(function(previews) {
+          batch.forEach(function(img) {
+            const preview = previews[img.dataset.previewId];
+            if (!preview) return;
+            img.src = preview;
+            // На экранах с высокой плотностью — превью большего размера
+            if (window.devicePixelRatio > 2 && img.dataset.previewHires) {
+              img.srcset = preview + ' 2x, ' + img.dataset.previewHires + ' 4x';
+            }
+          });
+        })
+        .catch(function() {
+          batch.forEach(function(img) { delete img.dataset.previewLoaded; });
+        });
+    }
+  };
+  loadBatchPreviews();
 
-    // Сортировка
-    rows.sort(function(a, b) {
-      let comparison = 0;
-      
-      if (sortType.startsWith('name-')) {
-        const nameA = (a.dataset.filename || '').toLowerCase();
-        const nameB = (b.dataset.filename || '').toLowerCase();
-        comparison = nameA.localeCompare(nameB, 'ru');
-        if (sortType === 'name-desc') comparison = -comparison;
-      } else if (sortType.startsWith('size-')) {
-        const sizeA = parseFileSize(a.dataset.fileSize);
-        const sizeB = parseFileSize(b.dataset.fileSize);
-        comparison = sizeA - sizeB;
-        if (sortType === 'size-desc') comparison = -comparison;
-      } else if (sortType.startsWith('time-')) {
-        const timeA = parseTime(a.dataset.uploadTime);
-        const timeB = parseTime(b.dataset.uploadTime);
-        comparison = timeA - timeB;
-        if (sortType === 'time-desc') comparison = -comparison;
+  // Сортировка выполняется на сервере (ссылки в меню сортировки),
+  // следующие страницы списка подгружаются при прокрутке до конца таблицы
+  const filesTableBody = document.getElementById('filesTableBody');
+  const pageSentinel = document.getElementById('filesPageSentinel');
+  let isLoadingPage = false;
+
+  const loadNextPage = function() {
+    const cursor = filesTableBody.dataset.nextCursor;
+    if (!cursor || isLoadingPage) return;
+    isLoadingPage = true;
+
+    const params = new URLSearchParams({
+      sort: filesTableBody.dataset.sort,
+      q: filesTableBody.dataset.search,
+      type: filesTableBody.dataset.type,
+      folder: filesTableBody.dataset.folder,
+      cursor: cursor
+    });
+    fetch('/files/page?' + params.toString(), { credentials: 'same-origin' })
+      .then(function(response) {
+        if (!response.ok) throw new Error('HTTP ' + response.status);
+        return response.json();
+      })
+      .then(function(page) {
+        filesTableBody.insertAdjacentHTML('beforeend', page.html);
+        loadBatchPreviews();
+        filesTableBody.dataset.nextCursor = page.next_cursor || '';
+        if (!page.next_cursor) pageSentinel.classList.add('d-none');
+      })
+      .catch(function() {
+        showError('Не удалось загрузить список файлов');
+      })
+      .then(function() {
+        isLoadingPage = false;
+      });
+  };
+
+  if (filesTableBody && pageSentinel && 'IntersectionObserver' in window) {
+    const observer = new IntersectionObserver(function(entries) {
+      if (entries.some(function(entry) { return entry.isIntersecting; })) {
+        loadNextPage();
       }
-      
-      return comparison;
+    }, { rootMargin: '400px' });
+    observer.observe(pageSentinel);
+  }
+
+  // Выбор файлов для групповых действий (архив, удаление)
+  const bulkForm = document.getElementById('bulkForm');
+  const selectAllFiles = document.getElementById('selectAllFiles');
+  const bulkSelectedCount = document.getElementById('bulkSelectedCount');
+
+  const getSelectedFileIds = function() {
+    return Array.from(document.querySelectorAll('.file-select:checked')).map(function(box) {
+      return box.value;
+    });
+  };
+
+  const updateBulkForm = function() {
+    if (!bulkForm) return;
+    const count = getSelectedFileIds().length;
+    bulkForm.classList.toggle('d-none', count === 0);
+    bulkSelectedCount.textContent = 'Выбрано: ' + count;
+  };
+
+  if (filesTableBody) {
+    // Делегирование: строки могут подгружаться при прокрутке
+    filesTableBody.addEventListener('change', function(e) {
+      if (e.target.classList.contains('file-select')) updateBulkForm();
+    });
+  }
+
+  if (selectAllFiles) {
+    selectAllFiles.addEventListener('change', function() {
+      document.querySelectorAll('.file-select').forEach(function(box) {
+        box.checked = selectAllFiles.checked;
+      });
+      updateBulkForm();
     });
+  }
 
-    // Очищаем tbody и добавляем отсортированные строки
-    tbody.innerHTML = '';
-    rows.forEach(function(row) {
-      tbody.appendChild(row);
+  if (bulkForm) {
+    bulkForm.addEventListener('submit', function(e) {
+      const ids = getSelectedFileIds();
+      if (e.submitter && e.submitter.dataset.confirm === 'delete' &&
+          !confirm('Переместить выбранные файлы (' + ids.length + ') в корзину?')) {
+        e.preventDefault();
+        return;
+      }
+      bulkForm.querySelectorAll('input[name="file_ids"]').forEach(function(input) {
+        input.remove();
+      });
+      ids.forEach(function(id) {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'file_ids';
+        input.value = id;
+        bulkForm.appendChild(input);
+      });
     });
+  }
+
+  // Превью изображений строятся в фоне: пока они не готовы, показывается заглушка,
+  // статусы опрашиваются одним запросом для всех заглушек на странице
+  const PREVIEW_POLL_INTERVAL = 3000;
+
+  const pollPendingPreviews = function() {
+    const placeholders = document.querySelectorAll('[data-preview-pending]');
+    if (placeholders.length === 0) {
+      // Заглушки могут появиться позже — с подгруженной страницей списка
+      setTimeout(pollPendingPreviews, PREVIEW_POLL_INTERVAL);
+      return;
+    }
+
+    const ids = Array.from(placeholders).map(function(el) { return el.dataset.previewPending; });
+    fetch('/preview/status?ids=' + ids.join(','), { credentials: 'same-origin' })
+      .then(function(response) { return response.ok ? response.json() : {}; })
+      .then(function(statuses) {
+        placeholders.forEach(function(placeholder) {
+          const status = statuses[placeholder.dataset.previewPending];
+          if (status && status !== 'pending') {
+            const img = document.createElement('img');
+            img.dataset.previewId = placeholder.dataset.previewPending;
+            img.alt = 'Превью';
+            img.className = 'file-thumb';
+            placeholder.replaceWith(img);
+          }
+        });
+        loadBatchPreviews();
+      })
+      .catch(function() {})
+      .then(function() {
+        setTimeout(pollPendingPreviews, PREVIEW_POLL_INTERVAL);
+      });
   };
+  setTimeout(pollPendingPreviews, PREVIEW_POLL_INTERVAL);
 
-  // Обработчики для кнопок сортировки
-  const sortDropdownItems = document.querySelectorAll('#sortDropdown .dropdown-item');
-  sortDropdownItems.forEach(function(item) {
-    item.addEventListener('click', function(e) {
-      e.preventDefault();
-      const sortType = this.dataset.sort;
-      if (sortType) {
-        sortFiles(sortType);
-        // Обновляем текст кнопки
-        const sortBtn = document.getElementById('sortBtn');
-        if (sortBtn) {
-          const icon = sortBtn.querySelector('i');
-          const text = this.textContent.trim();
-          sortBtn.innerHTML = icon ? icon.outerHTML + ' ' + text : text;
+  // Загрузка по частям: файлы больше порога отправляются чанками,
+  // несколько чанков параллельно; при обрыве загрузка продолжается с места остановки
+  const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+  const PARALLEL_CHUNKS = 4;
+  const CHUNK_RETRIES = 3;
+
+  // Сервер занят (429: слишком много одновременных передач) — ждём Retry-After
+  const waitRetryAfter = function(response) {
+    const seconds = parseInt(response.headers.get('Retry-After'), 10) || 2;
+    return new Promise(function(resolve) { setTimeout(resolve, seconds * 1000); });
+  };
+
+  const requestJson = function(method, url, body) {
+    return fetch(url, {
+      method: method,
+      headers: body ? { 'Content-Type': 'application/json' } : {},
+      body: body ? JSON.stringify(body) : undefined,
+      credentials: 'same-origin'
+    }).then(function(response) {
+      return response.json().catch(function() { return {}; }).then(function(data) {
+        if (!response.ok) {
+          const err = new Error(data.error || ('HTTP ' + response.status));
+          err.status = response.status;
+          throw err;
         }
-      }
+        return data;
+      });
     });
-  });
+  };
 
-  // Валидация формы загрузки перед отправкой
-  const uploadForm = document.getElementById('uploadForm');
-  if (uploadForm) {
-    uploadForm.addEventListener('submit', function(e) {
-      if (!fileInput.files || fileInput.files.length === 0) {
-        e.preventDefault();
-        showError('Пожалуйста, выберите файл для загрузки.');
-        return false;
+  const getUploadSession = function(file) {
+    const storageKey = 'upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+    const createSession = function() {
+      const folderId = document.getElementById('uploadFolderId').value || null;
+      return requestJson('POST', '/upload/sessions', { filename: file.name, size: file.size, folder_id: folderId })
+        .then(function(session) {
+          localStorage.setItem(storageKey, session.id);
+          return session;
+        });
+    };
+    const savedId = localStorage.getItem(storageKey);
+    const sessionPromise = savedId
+      ? requestJson('GET', '/upload/sessions/' + savedId).catch(createSession)
+      : createSession();
+    return sessionPromise.then(function(session) {
+      session.storageKey = storageKey;
+      return session;
+    });
+  };
+
+  const uploadInChunks = function(file) {
+    return getUploadSession(file).then(function(session) {
+      const received = new Set(session.received);
+      const pending = [];
+      for (let i = 0; i < session.chunk_count; i++) {
+        if (!received.has(i)) pending.push(i);
       }
+      let done = session.chunk_count - pending.length;
 
-      const file = fileInput.files[0];
-      const fileSize = file.size;
-      const maxSize = 512 * 1024 * 1024; // 512 МБ
+      const sendChunk = function(index, attempt) {
+        const start = index * session.chunk_size;
+        const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+        return fetch('/upload/sessions/' + session.id + '/chunks/' + index, {
+          method: 'PUT',
+          body: blob,
+          credentials: 'same-origin'
+        }).then(function(response) {
+          // Отказ из-за занятости сервера не считается неудачной попыткой
+          if (response.status === 429) {
+            return waitRetryAfter(response).then(function() { return sendChunk(index, attempt); });
+          }
+          if (!response.ok) throw new Error('HTTP ' + response.status);
+        }).catch(function(err) {
+          if (attempt >= CHUNK_RETRIES) throw err;
+          return sendChunk(index, attempt + 1);
+        });
+      };
 
-      // Повторная проверка размера перед отправкой
-      if (fileSize > maxSize) {
-        e.preventDefault();
-        showError('Файл слишком большой! Максимальный размер — 512 МБ.');
-        return false;
+      const worker = function() {
+        const index = pending.shift();
+        if (index === undefined) return Promise.resolve();
+        return sendChunk(index, 1).then(function() {
+          done += 1;
+          labelSecondary.textContent = 'Загружено ' + Math.round(done / session.chunk_count * 100) + '%';
+          return worker();
+        });
+      };
+
+      const workers = [];
+      for (let i = 0; i < PARALLEL_CHUNKS; i++) workers.push(worker());
+      return Promise.all(workers).then(function() {
+        return requestJson('POST', '/upload/sessions/' + session.id + '/complete');
+      }).then(function() {
+        localStorage.removeItem(session.storageKey);
+      });
+    });
+  };
+
+  // Небольшие файлы отправляются пачками: один запрос на много файлов,
+  // сервер пишет их на диск параллельно и добавляет в БД одной транзакцией
+  const BATCH_MAX_FILES = 100;
+  const BATCH_MAX_BYTES = 64 * 1024 * 1024;
+
+  const makeBatches = function(files) {
+    const batches = [];
+    let batch = [];
+    let batchBytes = 0;
+    files.forEach(function(file) {
+      if (batch.length >= BATCH_MAX_FILES || (batch.length > 0 && batchBytes + file.size > BATCH_MAX_BYTES)) {
+        batches.push(batch);
+        batch = [];
+        batchBytes = 0;
       }
+      batch.push(file);
+      batchBytes += file.size;
+    });
+    if (batch.length > 0) batches.push(batch);
+    return batches;
+  };
 
-      // Проверка на дубликаты перед отправкой
-      const uploadedFiles = getUploadedFiles();
-      const duplicate = uploadedFiles.find(function(uploaded) {
-        return uploaded.name === file.name && 
-               Math.abs(parseFileSize(uploaded.size) - fileSize) < 1024;
+  const uploadBatch = function(files) {
+    const formData = new FormData(uploadForm);
+    formData.delete('file');
+    files.forEach(function(file) {
+      formData.append('file', file, file.webkitRelativePath || file.name);
+    });
+    return fetch(uploadForm.action, {
+      method: 'POST',
+      body: formData,
+      headers: { 'Accept': 'application/json' },
+      credentials: 'same-origin'
+    }).then(function(response) {
+      if (response.status === 429) {
+        return waitRetryAfter(response).then(function() { return uploadBatch(files); });
+      }
+      return response.json().catch(function() { return {}; }).then(function(data) {
+        if (!response.ok) throw new Error(data.error || ('HTTP ' + response.status));
+        return data.results.filter(function(result) { return result.error; });
       });
+    });
+  };
 
-      if (duplicate) {
-        e.preventDefault();
-        showError('Файл с именем "' + file.name + '" уже загружен. Выберите другой файл или переименуйте существующий.');
+  const uploadSelectedFiles = function(files) {
+    const large = files.filter(function(file) { return file.size > CHUNKED_UPLOAD_THRESHOLD; });
+    const batches = makeBatches(files.filter(function(file) { return file.size <= CHUNKED_UPLOAD_THRESHOLD; }));
+    const failed = [];
+    let done = 0;
+
+    // Пачки и большие файлы отправляются по очереди, чтобы не перегружать сервер
+    let chain = Promise.resolve();
+    batches.forEach(function(batch) {
+      chain = chain.then(function() {
+        return uploadBatch(batch).then(function(errors) {
+          errors.forEach(function(result) { failed.push(result.filename); });
+        }).catch(function() {
+          batch.forEach(function(file) { failed.push(file.name); });
+        }).then(function() {
+          done += batch.length;
+          labelSecondary.textContent = 'Загружено ' + done + ' из ' + files.length;
+        });
+      });
+    });
+    large.forEach(function(file) {
+      chain = chain.then(function() {
+        return uploadInChunks(file).catch(function() {
+          failed.push(file.name);
+        }).then(function() {
+          done += 1;
+        });
+      });
+    });
+    return chain.then(function() { return failed; });
+  };
+
+  // Валидация формы загрузки перед отправкой
+  const uploadForm = document.getElementById('uploadForm');
+  if (uploadForm) {
+    uploadForm.addEventListener('submit', function(e) {
+      e.preventDefault();
+
+      if (selectedFiles.length === 0) {
+        showError('Пожалуйста, выберите файлы для загрузки.');
         return false;
       }
 
       // Предотвращаем двойную отправку
       if (isUploading) {
-        e.preventDefault();
-        showError('Идет загрузка файла. Пожалуйста, подождите...');
+        showError('Идет загрузка файлов. Пожалуйста, подождите...');
         return false;
       }
 
-      // Устанавливаем флаг загрузки
       isUploading = true;
-      
-      // Сбрасываем флаг через 10 секунд (на случай, если что-то пошло не так)
-      setTimeout(function() {
+      uploadSelectedFiles(selectedFiles).then(function(failed) {
+        if (failed.length === 0) {
+          window.location.reload();
+          return;
+        }
         isUploading = false;
-      }, 10000);
+        showError('Не удалось загрузить файлов: ' + failed.length + '. ' + failed.slice(0, 3).join(', ') +
+          (failed.length > 3 ? '…' : ''));
+        setTimeout(function() { window.location.reload(); }, 5000);
+      });
+      return false;
     });
   }
-});
\ No newline at end of file
+});
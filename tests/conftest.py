@@ -0,0 +1,134 @@
+"""
+Общие фикстуры тестов.
+
+Приложение одно на процесс (обработчики регистрируются на глобальном app),
+поэтому оно создаётся один раз через create_app(config) на временной БД
+SQLite, а перед каждым тестом схема БД пересоздаётся, папка загрузок
+заменяется новой временной, а изменённые тестом настройки возвращаются.
+
+    python -m pytest
+"""
+
+import io
+import os
+
+import pytest
+from flask.testing import FlaskClient
+
+# Ключ сессии читается при импорте nestcloud
+os.environ.setdefault("SECRET_KEY", "test")
+
+from nestcloud import chunking, create_app, db  # noqa: E402
+
+PASSWORD = "password"
+
+
+class ServerLikeClient(FlaskClient):
+    """
+    Тестовый клиент, который, как WSGI-сервер, читает ответ целиком и закрывает
+    его: место передачи (nestcloud.admission) и замеры отдачи завершаются сразу.
+    Каждый запрос получает свой контекст приложения (g, сессию БД), даже если
+    тест держит открытым свой, — иначе вошедший пользователь переходит
+    из запроса в запрос.
+    """
+
+    def open(self, *args, buffered=True, **kwargs):
+        with self.application.app_context():
+            return super().open(*args, buffered=buffered, **kwargs)
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    base = tmp_path_factory.mktemp("nestcloud")
+    flask_app = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{base / 'test.db'}",
+            "UPLOAD_FOLDER": str(base / "uploads"),
+            "TESTING": True,
+            "WTF_CSRF_ENABLED": False,
+            "LOG_LEVEL": "WARNING",
+            # Быстрое хеширование паролей: тесты проверяют не его стойкость
+            "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000",
+        }
+    )
+    flask_app.test_client_class = ServerLikeClient
+    return flask_app
+
+
+@pytest.fixture(autouse=True)
+def clean_app(app, tmp_path):
+    """Пустая БД, своя папка загрузок и исходные настройки для каждого теста"""
+    from nestcloud.security import user_cache
+
+    config = dict(app.config)
+    app.config["UPLOAD_FOLDER"] = str(tmp_path / "uploads")
+    os.makedirs(app.config["UPLOAD_FOLDER"])
+    with app.app_context():
+        db.drop_all()
+        # Таблица поиска FTS5 создаётся вместе с таблицей file, но не удаляется с ней
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("DROP TABLE IF EXISTS file_search")
+        db.create_all()
+    user_cache.clear()
+    yield
+    app.config.clear()
+    app.config.update(config)
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def make_client(app):
+    """make_client(login) — клиент зарегистрированного и вошедшего пользователя"""
+
+    def make(login="alice"):
+        client = app.test_client()
+        client.post("/register", data={"login": login, "password": PASSWORD})
+        response = client.post("/login", data={"login": login, "password": PASSWORD})
+        assert response.status_code == 302
+        return client
+
+    return make
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
+
+
+def upload_version(client, file_id, data):
+    """Загружает новую версию файла по блокам (отправляются только недостающие)"""
+    manifest = chunking.build_manifest(io.BytesIO(data))
+    response = client.post(
+        "/upload/sessions",
+        json={
+            "file_id": file_id,
+            "chunks": [{"hash": chunk_hash, "size": size} for chunk_hash, size in manifest],
+        },
+    )
+    assert response.status_code == 201, response.get_data(as_text=True)
+    session = response.get_json()
+    offsets = [0]
+    for _, size in manifest:
+        offsets.append(offsets[-1] + size)
+    for index in session["missing"]:
+        chunk = data[offsets[index] : offsets[index + 1]]
+        response = client.put(f"/upload/sessions/{session['id']}/chunks/{index}", data=chunk)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    response = client.post(f"/upload/sessions/{session['id']}/complete")
+    assert response.status_code == 201, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def upload(client, name, data, folder_id=None):
+    """Загружает файл через API и возвращает его описание"""
+    form = {"file": [(io.BytesIO(data), name)]}
+    if folder_id is not None:
+        form["folder_id"] = str(folder_id)
+    response = client.post("/api/v1/files", data=form, content_type="multipart/form-data")
+    assert response.status_code == 201, response.get_data(as_text=True)
+    return response.get_json()
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+from nestcloud.admission import ENVIRON_TRANSFER, Transfer, try_acquire
+from nestcloud.asgi import StreamingWSGIAdapter
+from tests.conftest import upload
+
+LEASE_SECONDS = 0.3
+
+
+@pytest.fixture
+def short_lease(app):
+    app.config["TRANSFER_LEASE_SECONDS"] = LEASE_SECONDS
+    app.config["UPLOAD_CONCURRENCY_PER_USER"] = 1
+    app.config["DOWNLOAD_CONCURRENCY_PER_USER"] = 1
+
+
+def test_second_download_is_rejected(client, short_lease):
+    file_id = upload(client, "a.bin", b"x" * 100)["id"]
+    first = client.get(f"/download/{file_id}", buffered=False)
+    response = client.get(f"/download/{file_id}")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    first.close()
+    assert client.get(f"/download/{file_id}").status_code == 200
+
+
+def test_slow_download_keeps_its_lease(client, short_lease):
+    # Скорость не ограничена, но передача идёт дольше срока аренды
+    file_id = upload(client, "a.bin", b"x" * 64 * 1024)["id"]
+    first = client.get(f"/download/{file_id}", buffered=False)
+    started = time.monotonic()
+    for _ in first.response:
+        time.sleep(LEASE_SECONDS / 4)
+    assert time.monotonic() - started > 2 * LEASE_SECONDS
+    assert client.get(f"/download/{file_id}").status_code == 429
+    first.close()
+    assert client.get(f"/download/{file_id}").status_code == 200
+
+
+def test_slow_asgi_upload_keeps_its_lease(app, short_lease):
+    lease_id, _ = try_acquire("upload", 1)
+    environ = {ENVIRON_TRANSFER: Transfer("upload", 1, lease_id)}
+    adapter = StreamingWSGIAdapter(app)
+    chunks = [b"x" * 1024] * 8
+
+    async def receive():
+        await asyncio.sleep(LEASE_SECONDS / 4)
+        return {"type": "http.request", "body": chunks.pop(), "more_body": bool(chunks)}
+
+    try:
+        status = asyncio.run(adapter.receive_body(environ, receive, None))
+    finally:
+        adapter.executor.shutdown(wait=True)
+    assert status == "ok"
+    assert environ[ENVIRON_TRANSFER].input_shaped
+    assert try_acquire("upload", 1) == (None, "user")
@@ -0,0 +1,55 @@
+from tests.conftest import PASSWORD, upload
+
+
+def test_api_requires_login_without_redirect(app):
+    client = app.test_client()
+    response = client.get("/api/v1/files")
+    assert response.status_code == 401
+    assert response.get_json() == {"error": "Требуется вход"}
+
+
+def test_api_login(app, make_client):
+    make_client("alice")
+    client = app.test_client()
+    response = client.post("/api/v1/login", json={"login": "alice", "password": "wrong"})
+    assert response.status_code == 401
+    response = client.post("/api/v1/login", json={"login": "alice", "password": PASSWORD})
+    assert response.status_code == 200
+    assert client.get("/api/v1/files").status_code == 200
+
+
+def test_change_feed_follows_file_lifecycle(client):
+    start = client.get("/api/v1/files").get_json()["change_cursor"]
+    file_id = upload(client, "a.txt", b"data")["id"]
+    response = client.patch(f"/api/v1/files/{file_id}", json={"filename": "b"})
+    assert response.get_json()["filename"] == "b.txt"
+    assert client.delete(f"/api/v1/files/{file_id}").status_code == 204
+
+    body = client.get("/api/v1/changes", query_string={"since": start}).get_json()
+    assert [(c["op"], c["file_id"]) for c in body["changes"]] == [
+        ("created", file_id),
+        ("updated", file_id),
+        ("deleted", file_id),
+    ]
+    # Удалённого файла уже нет — состояние не прикладывается
+    assert [c["file"] is None for c in body["changes"]] == [True, True, True]
+    assert body["has_more"] is False
+
+    again = client.get("/api/v1/changes", query_string={"since": body["cursor"]})
+    assert again.get_json()["changes"] == []
+
+
+def test_change_feed_pages_and_isolates_users(client, make_client):
+    for name in ("a.txt", "b.txt", "c.txt"):
+        upload(client, name, b"data")
+    upload(make_client("bob"), "other.txt", b"data")
+
+    body = client.get("/api/v1/changes", query_string={"limit": 2}).get_json()
+    assert body["has_more"] is True
+    assert [c["file"]["filename"] for c in body["changes"]] == ["a.txt", "b.txt"]
+    body = client.get(
+        "/api/v1/changes", query_string={"since": body["cursor"], "limit": 2}
+    ).get_json()
+    assert [c["file"]["filename"] for c in body["changes"]] == ["c.txt"]
+    assert body["has_more"] is False
+    assert client.get("/api/v1/changes?since=x").status_code == 400
@@ -0,0 +1,32 @@
+import pytest
+from sqlalchemy import text
+
+from nestcloud import create_app, db
+from nestcloud.database import get_engine_options
+
+
+def test_factory_returns_the_single_app(app):
+    assert create_app() is app
+    with pytest.raises(RuntimeError):
+        create_app({"TESTING": False})
+
+
+def test_sqlite_connections_use_wal(app_context):
+    with db.engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() > 0
+
+
+def test_engine_options_depend_on_backend(app):
+    config = dict(app.config, SQLALCHEMY_ENGINE_OPTIONS={})
+    config["SQLALCHEMY_DATABASE_URI"] = "postgresql+psycopg://u:p@db/nestcloud"
+    options = get_engine_options(config)
+    assert options["pool_pre_ping"] is True
+    assert options["pool_size"] == app.config["DB_POOL_SIZE"]
+
+    config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    assert get_engine_options(config) == {}
+
+    config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": 1}
+    config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///x.db"
+    assert get_engine_options(config)["pool_size"] == 1
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from nestcloud.asgi import StreamingWSGIAdapter
+from tests.conftest import upload
+
+READ_SIZE = 64 * 1024
+DATA = bytes(range(256)) * 4096  # 1 МиБ — 16 блоков отдачи
+
+
+@pytest.fixture
+def adapter(app):
+    app.config["ASGI_READ_SIZE"] = READ_SIZE
+    adapter = StreamingWSGIAdapter(app)
+    yield adapter
+    adapter.executor.shutdown(wait=True)
+
+
+def make_scope(path, cookies):
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": b"",
+        # HTTP/2 присылает каждую cookie отдельным заголовком
+        "headers": [(b"cookie", cookie.encode()) for cookie in cookies],
+        "http_version": "2",
+    }
+
+
+def session_cookie(client):
+    return f"session={client.get_cookie('session').value}"
+
+
+def run(adapter, scope, disconnect_after=None):
+    """
+    Выполняет запрос; клиент отключается после disconnect_after блоков тела.
+
+    :return: (статус, полученные блоки тела, закончен ли ответ)
+    """
+    sent = []
+    body_sent = asyncio.Event()
+
+    async def receive():
+        if not hasattr(receive, "started"):
+            receive.started = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        while disconnect_after is None or len(sent) - 1 < disconnect_after:
+            body_sent.clear()
+            await body_sent.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        body_sent.set()
+
+    asyncio.run(asyncio.wait_for(adapter(scope, receive, send), 10))
+    chunks = [m["body"] for m in sent[1:] if m["body"]]
+    return sent[0]["status"], chunks, not sent[-1].get("more_body", False)
+
+
+def test_cookies_from_separate_headers(adapter, client):
+    file_id = upload(client, "data.bin", b"hello")["id"]
+    scope = make_scope(f"/download/{file_id}", ["theme=dark", session_cookie(client)])
+    status, chunks, finished = run(adapter, scope)
+    assert status == 200 and finished
+    assert b"".join(chunks) == b"hello"
+
+
+def test_disconnect_stops_reading_the_file(adapter, client):
+    file_id = upload(client, "data.bin", DATA)["id"]
+    scope = make_scope(f"/download/{file_id}", [session_cookie(client)])
+
+    status, chunks, finished = run(adapter, scope)
+    assert finished and b"".join(chunks) == DATA
+
+    status, chunks, finished = run(adapter, scope, disconnect_after=2)
+    assert status == 200 and not finished
+    # Отдача остановилась сразу после отключения, а не дочитала файл
+    assert len(chunks) <= 4 < len(DATA) // READ_SIZE
@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks import compare
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_run(path, median):
+    result = {"group": "download", "name": "full", "params": {"mb": 1}, "median": median}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"meta": {"git_revision": "abc"}, "results": [result]}, f)
+    return str(path)
+
+
+def test_compare_fails_on_regression(tmp_path, capsys):
+    baseline = write_run(tmp_path / "old.json", 0.100)
+    current = write_run(tmp_path / "new.json", 0.130)
+
+    compare.main([baseline, current, "--threshold", "50"])
+    assert "+30.0%" in capsys.readouterr().out
+    with pytest.raises(SystemExit) as exc_info:
+        compare.main([baseline, current, "--threshold", "10"])
+    assert exc_info.value.code == 1
+
+
+def test_run_writes_results(tmp_path):
+    output = tmp_path / "run.json"
+    # Отдельный процесс: бенчмарк создаёт своё приложение на своей временной БД
+    subprocess.run(
+        [
+            sys.executable, "-m", "benchmarks.run",
+            "--only", "listing,download",
+            "--file-counts", "10",
+            "--download-mb", "2",
+            "--repeat", "1",
+            "--output", str(output),
+        ],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    with open(output, encoding="utf-8") as f:
+        data = json.load(f)
+    assert {r["group"] for r in data["results"]} == {"listing", "download"}
+    assert all(r["median"] > 0 for r in data["results"])
+    assert "git_revision" in data["meta"]
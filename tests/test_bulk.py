@@ -0,0 +1,43 @@
+import io
+import zipfile
+
+from nestcloud import db
+from nestcloud.models import File
+from tests.conftest import upload
+
+
+def test_bulk_download_streams_zip(app, client, make_client):
+    app.config["STORAGE_COMPRESSION"] = "zstd"
+    ids = [
+        upload(client, "a.txt", b"first " * 1000)["id"],
+        upload(client, "a.txt", b"second")["id"],
+        upload(client, "photo.jpg", b"\xff\xd8jpeg")["id"],
+    ]
+    foreign = upload(make_client("bob"), "secret.txt", b"bob")["id"]
+
+    response = client.post("/download/bulk", data={"file_ids": ids + [foreign]})
+    assert response.status_code == 200
+    assert response.mimetype == "application/zip"
+    assert "no-store" in response.headers["Cache-Control"]
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == ["a.txt", "a (2).txt", "photo.jpg"]
+        # Сжатый при хранении файл попадает в архив распакованным
+        assert archive.read("a.txt") == b"first " * 1000
+        assert archive.read("a (2).txt") == b"second"
+        # Уже сжатые форматы не пережимаются
+        assert archive.getinfo("photo.jpg").compress_type == zipfile.ZIP_STORED
+
+
+def test_bulk_delete_moves_only_own_files_to_trash(client, make_client, app_context):
+    ids = [upload(client, name, b"data")["id"] for name in ("a.txt", "b.txt", "c.txt")]
+    foreign = upload(make_client("bob"), "secret.txt", b"bob")["id"]
+
+    response = client.post("/delete/bulk", data={"file_ids": [f"{ids[0]},{ids[1]}", foreign]})
+    assert response.status_code == 302
+    assert {f["id"] for f in client.get("/api/v1/files").get_json()["files"]} == {ids[2]}
+    assert db.session.get(File, foreign).deleted_at is None
+    assert client.get("/api/v1/usage").get_json()["file_count"] == 1
+
+
+def test_bulk_download_without_files_redirects(client):
+    assert client.post("/download/bulk", data={}).status_code == 302
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+import zstandard
+
+from nestcloud import db, storage
+from nestcloud.models import File
+from tests.conftest import upload
+
+TEXT = b"a fairly repetitive line of text\n" * 4000
+
+
+@pytest.fixture(autouse=True)
+def zstd(app):
+    app.config["STORAGE_COMPRESSION"] = "zstd"
+
+
+def stored(file_id):
+    return db.session.get(File, file_id)
+
+
+def test_compressible_file_is_stored_compressed(client, app_context):
+    file_id = upload(client, "log.txt", TEXT)["id"]
+    file_record = stored(file_id)
+    assert file_record.encoding == "zstd"
+    assert file_record.size_bytes == len(TEXT)
+    assert file_record.stored_size == os.path.getsize(storage.get_file_path(file_record))
+    assert file_record.stored_size < len(TEXT) // 10
+
+    response = client.get(f"/download/{file_id}")
+    assert response.data == TEXT
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.vary
+
+
+def test_client_accepting_zstd_gets_stored_bytes(client):
+    file_id = upload(client, "log.txt", TEXT)["id"]
+    response = client.get(f"/download/{file_id}", headers={"Accept-Encoding": "gzip, zstd"})
+    assert response.headers["Content-Encoding"] == "zstd"
+    assert response.headers["Accept-Ranges"] == "none"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(response.data) == TEXT
+    plain_etag = client.get(f"/download/{file_id}").headers["ETag"]
+    assert response.headers["ETag"] != plain_etag
+
+
+def test_incompressible_files_are_stored_as_is(client, app_context):
+    random_id = upload(client, "noise.txt", os.urandom(64 * 1024))["id"]
+    image_id = upload(client, "photo.jpg", TEXT)["id"]
+    assert stored(random_id).encoding is None
+    # Уже сжатые форматы не пробуются вовсе
+    assert stored(image_id).encoding is None
+    assert client.get(f"/download/{image_id}").data == TEXT
@@ -0,0 +1,57 @@
+import hashlib
+
+from nestcloud.storage import make_sample_hash
+from tests.conftest import upload
+
+DATA = b"duplicate me " * 10000
+
+
+def candidate(name, data, sha256=True):
+    """Описание файла, как его считает браузер до загрузки"""
+    result = {
+        "name": name,
+        "size": len(data),
+        "sample_hash": make_sample_hash(len(data), data, data),
+    }
+    if sha256:
+        result["sha256"] = hashlib.sha256(data).hexdigest()
+    return result
+
+
+def check(client, *candidates):
+    response = client.post("/api/v1/files/check-duplicates", json={"files": list(candidates)})
+    assert response.status_code == 200
+    return [
+        r["duplicate_of"]["id"] if r["duplicate_of"] else None
+        for r in response.get_json()["results"]
+    ]
+
+
+def test_finds_uploaded_copies(client, make_client):
+    first = upload(client, "copy.bin", DATA)["id"]
+    same_name = upload(client, "orig.bin", DATA)["id"]
+    upload(make_client("bob"), "orig.bin", b"other")
+
+    assert check(
+        client,
+        candidate("orig.bin", DATA),
+        candidate("new.bin", DATA, sha256=False),
+        candidate("other.bin", DATA[:-1] + b"!"),
+    ) == [same_name, first, None]
+
+
+def test_full_hash_mismatch_is_not_a_duplicate(client):
+    upload(client, "a.bin", DATA)
+    changed = DATA[:70000] + b"X" + DATA[70001:]
+    fake = candidate("a.bin", changed)
+    # Быстрый отпечаток совпал, а полный хеш — нет
+    fake["sample_hash"] = candidate("a.bin", DATA)["sample_hash"]
+    assert check(client, fake) == [None]
+
+
+def test_trashed_files_and_bad_input(client):
+    file_id = upload(client, "a.bin", DATA)["id"]
+    client.delete(f"/api/v1/files/{file_id}")
+    assert check(client, candidate("a.bin", DATA)) == [None]
+    response = client.post("/api/v1/files/check-duplicates", json={"files": "a.bin"})
+    assert response.status_code == 400
@@ -0,0 +1,71 @@
+from nestcloud import db
+from nestcloud.folders import subtree_filter
+from nestcloud.models import Folder
+from tests.conftest import upload
+
+
+def create_folder(client, name, parent_id=None):
+    response = client.post("/api/v1/folders", json={"name": name, "parent_id": parent_id})
+    assert response.status_code == 201, response.get_data(as_text=True)
+    return response.get_json()["id"]
+
+
+def test_subtree_stats_and_move(client):
+    top = create_folder(client, "top")
+    child = create_folder(client, "child", top)
+    grandchild = create_folder(client, "grandchild", child)
+    other = create_folder(client, "other")
+    upload(client, "a.txt", b"x" * 10, folder_id=child)
+    upload(client, "b.txt", b"x" * 20, folder_id=grandchild)
+    upload(client, "c.txt", b"x" * 40, folder_id=other)
+
+    stats = client.get(f"/api/v1/folders/{top}").get_json()
+    assert (stats["folders"], stats["files"], stats["size"]) == (2, 2, 30)
+
+    # Перенос переписывает пути всего поддерева
+    response = client.patch(f"/api/v1/folders/{child}", json={"parent_id": other})
+    assert response.status_code == 200
+    stats = client.get(f"/api/v1/folders/{other}").get_json()
+    assert (stats["folders"], stats["files"], stats["size"]) == (2, 3, 70)
+    assert client.get(f"/api/v1/folders/{grandchild}").get_json()["path"] == [
+        "other",
+        "child",
+        "grandchild",
+    ]
+
+    response = client.patch(f"/api/v1/folders/{other}", json={"parent_id": grandchild})
+    assert response.status_code == 400
+
+
+def test_subtree_does_not_include_sibling_with_longer_id(client):
+    # Путь "/1/" — префикс строки "/1/...", но не "/10/"
+    first = create_folder(client, "first")
+    for i in range(9):
+        last = create_folder(client, f"f{i}")
+    assert str(last).startswith(str(first))
+    upload(client, "a.txt", b"x" * 10, folder_id=last)
+
+    assert client.get(f"/api/v1/folders/{first}").get_json()["files"] == 0
+    assert client.delete(f"/api/v1/folders/{first}").status_code == 204
+    assert client.get(f"/api/v1/folders/{last}").status_code == 200
+
+
+def test_delete_folder_trashes_subtree_files(client):
+    top = create_folder(client, "top")
+    child = create_folder(client, "child", top)
+    file_id = upload(client, "a.txt", b"x" * 10, folder_id=child)["id"]
+
+    assert client.delete(f"/api/v1/folders/{top}").status_code == 204
+    assert client.get(f"/api/v1/folders/{child}").status_code == 404
+    trash = client.get("/api/v1/trash").get_json()
+    assert [f["id"] for f in trash["files"]] == [file_id]
+
+
+def test_subtree_filter_uses_path_index(client, app_context):
+    folder = db.session.get(Folder, create_folder(client, "top"))
+    query = db.select(Folder.id).where(subtree_filter(folder))
+    sql = str(query.compile(db.engine, compile_kwargs={"literal_binds": True}))
+    plan = " ".join(
+        row[-1] for row in db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))
+    )
+    assert "ix_folder_user_path (user_id=? AND path>? AND path<?)" in plan
@@ -0,0 +1,40 @@
+import os
+
+from nestcloud import db, storage
+from nestcloud.models import File
+from tests.conftest import upload
+
+
+def test_new_files_are_sharded(app, client, app_context):
+    app.config["STORAGE_FANOUT"] = 2
+    file_id = upload(client, "a.txt", b"data")["id"]
+    stored = db.session.get(File, file_id).stored_filename
+    shard = storage.get_shard_dir(os.path.basename(stored))
+    assert stored == f"{shard}/{os.path.basename(stored)}"
+    assert len(shard.split("/")) == 2
+
+
+def test_migrate_layout_moves_files_online(app, client, app_context):
+    app.config["STORAGE_FANOUT"] = 0
+    ids = [upload(client, f"{i}.txt", f"data {i}".encode())["id"] for i in range(3)]
+    records = [db.session.get(File, i) for i in ids]
+    assert all("/" not in f.stored_filename for f in records)
+    old_paths = [storage.get_file_path(f) for f in records]
+
+    app.config["STORAGE_FANOUT"] = 1
+    result = app.test_cli_runner().invoke(
+        args=["migrate-layout", "--rate", "0", "--batch-size", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "перенесено файлов 3" in result.output
+
+    db.session.expire_all()
+    for i, (file_id, old_path) in enumerate(zip(ids, old_paths)):
+        file_record = db.session.get(File, file_id)
+        assert "/" in file_record.stored_filename
+        assert not os.path.exists(old_path)
+        assert client.get(f"/download/{file_id}").data == f"data {i}".encode()
+
+    # Повторный запуск ничего не переносит
+    result = app.test_cli_runner().invoke(args=["migrate-layout", "--rate", "0"])
+    assert "перенесено файлов 0" in result.output
@@ -0,0 +1,78 @@
+import re
+
+import pytest
+
+from nestcloud.listing import PAGE_SIZE
+from tests.conftest import upload
+
+SIZES = {"a.txt": 30, "b.txt": 10, "c.txt": 20, "d.txt": 10, "e.png": 40}
+
+
+@pytest.fixture
+def files(client):
+    return {name: upload(client, name, b"x" * size)["id"] for name, size in SIZES.items()}
+
+
+def list_all(client, **params):
+    """Все страницы списка файлов по курсору"""
+    pages = []
+    cursor = None
+    while True:
+        query = dict(params, limit=2)
+        if cursor:
+            query["cursor"] = cursor
+        body = client.get("/api/v1/files", query_string=query).get_json()
+        pages.append([f["filename"] for f in body["files"]])
+        cursor = body["next_cursor"]
+        if not cursor:
+            return pages
+
+
+def test_keyset_pages_cover_every_file_once(client, files):
+    pages = list_all(client, sort="size-asc")
+    assert [len(page) for page in pages] == [2, 2, 1]
+    # Равные размеры упорядочены по id
+    assert sum(pages, []) == ["b.txt", "d.txt", "c.txt", "a.txt", "e.png"]
+    assert sum(list_all(client, sort="name-desc"), []) == [
+        "e.png", "d.txt", "c.txt", "b.txt", "a.txt"
+    ]
+
+
+def test_new_file_does_not_shift_pages(client, files):
+    first = client.get("/api/v1/files", query_string={"sort": "size-asc", "limit": 2})
+    body = first.get_json()
+    # Файл, попавший в уже показанную часть списка, не сдвигает следующую страницу
+    upload(client, "tiny.txt", b"x")
+    second = client.get(
+        "/api/v1/files",
+        query_string={"sort": "size-asc", "limit": 2, "cursor": body["next_cursor"]},
+    )
+    assert [f["filename"] for f in second.get_json()["files"]] == ["c.txt", "a.txt"]
+
+
+def test_category_filter_and_sizes(client, files):
+    body = client.get("/api/v1/files", query_string={"type": "image"}).get_json()
+    assert [(f["filename"], f["size"]) for f in body["files"]] == [("e.png", 40)]
+
+
+def test_broken_cursor_starts_from_first_page(client, files):
+    query = {"sort": "size-asc", "limit": 2, "cursor": "garbage"}
+    body = client.get("/api/v1/files", query_string=query).get_json()
+    assert [f["filename"] for f in body["files"]] == ["b.txt", "d.txt"]
+
+
+def test_unknown_type_pages_stay_in_current_folder(client):
+    folder = client.post("/api/v1/folders", json={"name": "sub"}).get_json()["id"]
+    upload(client, "inside.txt", b"x", folder_id=folder)
+    for i in range(PAGE_SIZE + 1):
+        upload(client, f"root{i:02}.txt", b"x")
+
+    # Неизвестный тип игнорируется и на первой странице, и на следующих
+    query = {"sort": "name-desc", "type": "bogus"}
+    page = client.get("/home", query_string=query).get_data(as_text=True)
+    cursor = re.search(r'data-next-cursor="([^"]+)"', page).group(1)
+    assert "inside.txt" not in page
+    body = client.get("/files/page", query_string=dict(query, cursor=cursor)).get_json()
+    assert "inside.txt" not in body["html"]
+    assert "root00.txt" in body["html"]
+    assert body["next_cursor"] is None
@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from nestcloud.metrics import FILES_UPLOADED, shared_metrics
+from tests.conftest import upload
+
+# Завершившиеся процессы распознаются только в POSIX
+posix_only = pytest.mark.skipif(os.name != "posix", reason="нужен POSIX")
+
+
+def metric_value(text, line_prefix):
+    for line in text.splitlines():
+        if line.startswith(line_prefix + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def finished_pid():
+    """pid процесса, который уже завершился"""
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def write_snapshot(folder, name, uploaded):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name), "w") as f:
+        json.dump({FILES_UPLOADED.name: [[[], uploaded]]}, f)
+
+
+def test_metrics_count_requests(app, client):
+    upload(client, "a.txt", b"data")
+    text = client.get("/metrics").get_data(as_text=True)
+    requests = (
+        "nestcloud_http_requests_total"
+        '{endpoint="api_upload_file",method="POST",status="201"}'
+    )
+    assert metric_value(text, requests) >= 1
+    assert "# TYPE nestcloud_stage_duration_seconds histogram" in text
+
+
+def test_metrics_token(app, client):
+    app.config["METRICS_TOKEN"] = "secret"
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+
+
+@posix_only
+def test_metrics_sum_all_server_processes(app, client):
+    own = metric_value(client.get("/metrics").get_data(as_text=True), FILES_UPLOADED.name)
+    folder = shared_metrics.get_folder()
+    # Другой рабочий процесс (живой) и уже завершившийся
+    write_snapshot(folder, f"{os.getppid()}-worker.json", 5)
+    write_snapshot(folder, f"{finished_pid()}-gone.json", 7)
+
+    for _ in range(2):
+        text = client.get("/metrics").get_data(as_text=True)
+        assert metric_value(text, FILES_UPLOADED.name) == own + 12
+    # Снимок завершившегося процесса слит в архив и не считается дважды
+    assert not any(name.endswith("-gone.json") for name in os.listdir(folder))
+    assert os.path.exists(os.path.join(folder, "archive.json"))
+
+
+@posix_only
+def test_metrics_survive_worker_restart(app, client):
+    folder = shared_metrics.get_folder()
+    write_snapshot(folder, f"{finished_pid()}-old.json", 3)
+    client.get("/metrics")
+    write_snapshot(folder, f"{finished_pid()}-older.json", 4)
+    text = client.get("/metrics").get_data(as_text=True)
+    own = FILES_UPLOADED.dump()[0][1]
+    assert metric_value(text, FILES_UPLOADED.name) == own + 7
@@ -0,0 +1,153 @@
+import io
+
+import pytest
+from PIL import Image
+
+from nestcloud import db
+from nestcloud.models import File, PreviewJob
+from tests.conftest import upload, upload_version
+
+
+def make_png(size=(300, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def async_previews(app):
+    app.config["PREVIEW_MODE"] = "async"
+
+
+def run_worker(app):
+    result = app.test_cli_runner().invoke(
+        args=["preview-worker", "--once", "--processes", "1"]
+    )
+    assert result.exit_code == 0, result.output
+
+
+def test_upload_queues_preview_for_worker(app, client, app_context):
+    file_id = upload(client, "photo.png", make_png())["id"]
+    assert db.session.get(File, file_id).preview_status == "pending"
+    assert PreviewJob.query.count() == 1
+    assert client.get(f"/preview/status?ids={file_id}").get_json() == {str(file_id): "pending"}
+    assert client.get(f"/preview/{file_id}").status_code == 404
+
+    run_worker(app)
+    assert PreviewJob.query.count() == 0
+    assert client.get(f"/preview/status?ids={file_id}").get_json() == {str(file_id): "ready"}
+    response = client.get(f"/preview/{file_id}")
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+
+
+def test_broken_image_falls_back_to_icon_after_attempts(app, client, app_context):
+    app.config["PREVIEW_MAX_ATTEMPTS"] = 1
+    file_id = upload(client, "broken.png", b"not an image")["id"]
+
+    run_worker(app)
+    file_record = db.session.get(File, file_id)
+    assert file_record.preview_status == "failed"
+    assert file_record.preview_path.startswith("file_icons/")
+    assert PreviewJob.query.count() == 0
+
+
+@pytest.fixture
+def derivative_cache(app, monkeypatch):
+    """Кеш производных в папке загрузок этого теста"""
+    from nestcloud import derivatives
+
+    monkeypatch.setattr(derivatives, "_derivative_cache", None)
+    return derivatives.get_derivative_cache
+
+
+def test_derivative_is_resized_and_cached(client, derivative_cache):
+    file_id = upload(client, "photo.png", make_png())["id"]
+
+    response = client.get(f"/preview/{file_id}/100?format=jpeg")
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    with Image.open(io.BytesIO(response.data)) as img:
+        # Ширина округляется до ближайшей разрешённой (128)
+        assert img.size == (128, 85)
+    assert len(list(derivative_cache()._entries())) == 1
+
+    again = client.get(f"/preview/{file_id}/128?format=jpeg")
+    assert again.data == response.data
+    assert len(list(derivative_cache()._entries())) == 1
+
+
+def test_derivative_format_follows_accept(client, derivative_cache):
+    from nestcloud.derivatives import is_format_supported
+
+    if not is_format_supported("webp"):
+        pytest.skip("Pillow собран без WebP")
+    file_id = upload(client, "photo.png", make_png())["id"]
+
+    response = client.get(f"/preview/{file_id}/256", headers={"Accept": "image/webp"})
+    assert response.mimetype == "image/webp"
+    assert "Accept" in response.vary
+    response = client.get(f"/preview/{file_id}/256", headers={"Accept": "image/jpeg"})
+    assert response.mimetype == "image/jpeg"
+    assert client.get(f"/preview/{file_id}/256?format=gif").status_code == 404
+
+
+def test_derivative_of_non_image_is_not_found(client, derivative_cache):
+    file_id = upload(client, "notes.txt", b"text")["id"]
+    assert client.get(f"/preview/{file_id}/128").status_code == 404
+
+
+def test_batch_returns_all_previews_in_one_response(app, client, make_client):
+    app.config["PREVIEW_MODE"] = "inline"
+    image = upload(client, "photo.png", make_png())["id"]
+    text = upload(client, "notes.txt", b"text")["id"]
+    foreign = upload(make_client("bob"), "other.png", make_png())["id"]
+
+    response = client.get("/preview/batch", query_string={"ids": f"{image},{text},{foreign}"})
+    assert response.status_code == 200
+    previews = response.get_json()
+    assert set(previews) == {str(image), str(text)}
+    assert previews[str(image)].startswith("data:image/jpeg;base64,")
+    assert previews[str(text)].startswith("/static/file_icons/")
+
+    cached = client.get(
+        "/preview/batch",
+        query_string={"ids": f"{image},{text},{foreign}"},
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert cached.status_code == 304
+
+
+def test_preview_urls_change_with_file_version(app, client, derivative_cache):
+    app.config["PREVIEW_MODE"] = "inline"
+    uploaded = upload(client, "photo.png", make_png())
+    url = uploaded["preview_url"]
+    assert url.endswith("?v=1")
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.immutable and response.cache_control.max_age
+    # Без версии — только с проверкой по ETag
+    response = client.get(f"/preview/{uploaded['id']}")
+    assert response.cache_control.no_cache and not response.cache_control.immutable
+
+    upload_version(client, uploaded["id"], make_png((300, 300)))
+    current = client.get(f"/api/v1/files/{uploaded['id']}").get_json()
+    assert current["preview_url"].endswith("?v=2")
+    stale = client.get(url)
+    assert stale.cache_control.no_cache and not stale.cache_control.immutable
+    assert stale.headers["ETag"] != response.headers["ETag"]
+
+    derivative = client.get(f"/preview/{uploaded['id']}/128?v=2&format=jpeg")
+    assert derivative.cache_control.immutable
+    derivative = client.get(f"/preview/{uploaded['id']}/128?v=1&format=jpeg")
+    assert not derivative.cache_control.immutable
+    with Image.open(io.BytesIO(derivative.data)) as img:
+        assert img.size == (128, 128)
+
+
+def test_icon_preview_is_cached_no_longer_than_icons(app, client):
+    uploaded = upload(client, "notes.txt", b"text")
+    response = client.get(uploaded["preview_url"])
+    assert response.cache_control.max_age == app.config["ICON_MAX_AGE"]
+    assert client.get(f"/preview/{uploaded['id']}").cache_control.no_cache
@@ -0,0 +1,49 @@
+import io
+
+from sqlalchemy import update
+
+from nestcloud import db
+from nestcloud.models import User
+from tests.conftest import upload
+
+
+def usage(client):
+    return client.get("/api/v1/usage").get_json()
+
+
+def test_counters_follow_upload_trash_and_purge(app, client):
+    first = upload(client, "a.txt", b"x" * 100)["id"]
+    upload(client, "b.txt", b"x" * 50)
+    assert (usage(client)["used_bytes"], usage(client)["file_count"]) == (150, 2)
+
+    client.delete(f"/api/v1/files/{first}")
+    # Файл в корзине занимает место, но в число файлов не входит
+    assert (usage(client)["used_bytes"], usage(client)["file_count"]) == (150, 1)
+
+    client.delete(f"/api/v1/trash/{first}")
+    app.test_cli_runner().invoke(args=["purge-trash", "--once", "--rate", "0"])
+    assert (usage(client)["used_bytes"], usage(client)["file_count"]) == (50, 1)
+
+
+def test_upload_over_quota_is_rejected_before_reading(app, client):
+    app.config["USER_QUOTA_BYTES"] = 1000
+    upload(client, "a.txt", b"x" * 600)
+    response = client.post(
+        "/api/v1/files",
+        data={"file": [(io.BytesIO(b"x" * 600), "b.txt")]},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 413
+    assert usage(client)["used_bytes"] == 600
+    assert usage(client)["percent"] == 60
+
+
+def test_reconcile_usage_repairs_drifted_counters(app, client, app_context):
+    upload(client, "a.txt", b"x" * 100)
+    db.session.execute(update(User).values(used_bytes=5, file_count=7))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["reconcile-usage"])
+    assert result.exit_code == 0, result.output
+    assert "счётчиков пользователей 1" in result.output
+    assert (usage(client)["used_bytes"], usage(client)["file_count"]) == (100, 1)
@@ -0,0 +1,63 @@
+import json
+import os
+
+from nestcloud import db, storage
+from nestcloud.models import File, ScrubState
+from tests.conftest import upload
+
+
+def scrub(app, *args):
+    result = app.test_cli_runner().invoke(args=["scrub", "--once", "--io-rate", "0", *args])
+    assert result.exit_code == 0, result.output
+
+
+def last_stats(phase):
+    return json.loads(db.session.get(ScrubState, phase).last_stats)
+
+
+def test_scrub_marks_missing_and_corrupt_content(app, client, app_context):
+    intact = upload(client, "intact.txt", b"intact")["id"]
+    corrupt = upload(client, "corrupt.txt", b"original")["id"]
+    missing = upload(client, "missing.txt", b"gone")["id"]
+    with open(storage.get_file_path(db.session.get(File, corrupt)), "wb") as f:
+        f.write(b"tampered")
+    os.remove(storage.get_file_path(db.session.get(File, missing)))
+
+    scrub(app)
+    db.session.expire_all()
+    statuses = {f.id: f.content_status for f in File.query}
+    assert statuses == {intact: None, corrupt: "corrupt", missing: "missing"}
+    stats = last_stats("files")
+    assert (stats["checked"], stats["corrupt"], stats["missing"]) == (3, 1, 1)
+
+    # Восстановленное содержимое снова считается исправным
+    with open(storage.get_file_path(db.session.get(File, corrupt)), "wb") as f:
+        f.write(b"original")
+    scrub(app)
+    db.session.expire_all()
+    assert db.session.get(File, corrupt).content_status is None
+    assert last_stats("files")["recovered"] == 1
+
+
+def test_scrub_quarantines_orphans_after_grace_period(app, client, app_context):
+    app.config["SCRUB_ORPHAN_GRACE_SECONDS"] = 3600
+    file_id = upload(client, "kept.txt", b"kept")["id"]
+    user_id = db.session.get(File, file_id).user_id
+    orphan = storage.resolve_user_path(user_id, "orphan.bin")
+    recent = storage.resolve_user_path(user_id, "recent.bin")
+    for path in (orphan, recent):
+        with open(path, "wb") as f:
+            f.write(b"x" * 10)
+    # Файлы без записей моложе срока ожидания не трогаются
+    scrub(app)
+    assert os.path.exists(orphan) and os.path.exists(recent)
+    assert last_stats("disk")["recent"] == 2
+
+    app.config["SCRUB_ORPHAN_GRACE_SECONDS"] = 0
+    scrub(app, "--orphans", "quarantine")
+    assert not os.path.exists(orphan)
+    quarantine = os.path.join(app.config["UPLOAD_FOLDER"], ".quarantine")
+    quarantined = [name for _, _, names in os.walk(quarantine) for name in names]
+    assert sorted(quarantined) == ["orphan.bin", "recent.bin"]
+    assert last_stats("disk")["orphans"] == 2
+    assert os.path.exists(storage.get_file_path(db.session.get(File, file_id)))
@@ -0,0 +1,29 @@
+from tests.conftest import upload
+
+
+def search(client, text):
+    body = client.get("/api/v1/files", query_string={"q": text}).get_json()
+    return sorted(f["filename"] for f in body["files"])
+
+
+def test_substring_search_is_case_insensitive(client, make_client):
+    for name in ("Отчёт за май.pdf", "report-final.docx", "photo.jpg"):
+        upload(client, name, b"data")
+    upload(make_client("bob"), "report-bob.docx", b"data")
+
+    assert search(client, "REPORT") == ["report-final.docx"]
+    assert search(client, "отчёт") == ["Отчёт за май.pdf"]
+    # Несколько слов — все должны встретиться в имени
+    assert search(client, "final rep") == ["report-final.docx"]
+    assert search(client, "за") == ["Отчёт за май.pdf"]
+    assert search(client, 'x"y') == []
+
+
+def test_index_follows_rename_and_delete(client):
+    file_id = upload(client, "draft.txt", b"data")["id"]
+    client.patch(f"/api/v1/files/{file_id}", json={"filename": "summary"})
+    assert search(client, "draft") == []
+    assert search(client, "summ") == ["summary.txt"]
+
+    client.delete(f"/api/v1/files/{file_id}")
+    assert search(client, "summ") == []
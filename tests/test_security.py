@@ -0,0 +1,56 @@
+import threading
+
+from sqlalchemy import event
+
+from nestcloud import db, security
+from nestcloud.models import User
+from tests.conftest import PASSWORD, upload
+
+
+def count_user_queries(fn):
+    """Сколько запросов к таблице user выполнил fn"""
+    statements = []
+
+    def collect(conn, cursor, statement, *args):
+        if 'FROM "user"' in statement or "FROM user" in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", collect)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", collect)
+    return len(statements)
+
+
+def test_user_loader_is_cached_and_invalidated(client, app_context):
+    user_id = User.query.filter_by(login="alice").one().id
+    security.user_cache.clear()
+    assert count_user_queries(lambda: security.load_user(str(user_id))) == 1
+    assert count_user_queries(lambda: security.load_user(str(user_id))) == 0
+
+    # Новый файл меняет счётчики пользователя — снимок в кеше сбрасывается
+    upload(client, "a.txt", b"data")
+    assert security.user_cache.get(user_id) is None
+
+
+def test_password_is_rehashed_when_method_changes(app, make_client, app_context):
+    make_client("alice")
+    app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:2000"
+    response = app.test_client().post(
+        "/login", data={"login": "alice", "password": PASSWORD}
+    )
+    assert response.status_code == 302
+    db.session.expire_all()
+    assert User.query.filter_by(login="alice").one().password.startswith("pbkdf2:sha256:2000$")
+
+
+def test_login_is_refused_when_hash_queue_is_full(app, make_client, monkeypatch):
+    make_client("alice")
+    monkeypatch.setattr(security, "password_slots", threading.BoundedSemaphore(1))
+    security.password_slots.acquire()
+    response = app.test_client().post(
+        "/api/v1/login", json={"login": "alice", "password": PASSWORD}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
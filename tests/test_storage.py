@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from nestcloud import db, storage
+from nestcloud.models import Blob, File
+from tests.conftest import upload
+
+DATA = b"one content, many files" * 100
+
+
+@pytest.fixture(autouse=True)
+def cas_mode(app):
+    app.config["STORAGE_MODE"] = "cas"
+
+
+def purge(app, client, file_id):
+    """Удаляет файл в корзину, навсегда и запускает проход очистки"""
+    assert client.delete(f"/api/v1/files/{file_id}").status_code == 204
+    assert client.delete(f"/api/v1/trash/{file_id}").status_code == 204
+    result = app.test_cli_runner().invoke(args=["purge-trash", "--once", "--rate", "0"])
+    assert result.exit_code == 0, result.output
+
+
+def test_identical_uploads_share_one_blob(app, client, make_client, app_context):
+    first = upload(client, "a.txt", DATA)
+    second = upload(make_client("bob"), "b.txt", DATA)
+
+    blob = db.session.get(Blob, db.session.get(File, first["id"]).blob_hash)
+    assert db.session.get(File, second["id"]).blob_hash == blob.hash
+    assert blob.refcount == 2
+    assert Blob.query.count() == 1
+    assert os.path.getsize(storage.get_blob_path(blob.hash)) == len(DATA)
+
+
+def test_blob_is_removed_with_its_last_reference(app, client, app_context):
+    first = upload(client, "a.txt", DATA)
+    second = upload(client, "b.txt", DATA)
+    blob_hash = db.session.get(File, first["id"]).blob_hash
+    blob_path = storage.get_blob_path(blob_hash)
+
+    purge(app, client, first["id"])
+    db.session.expire_all()
+    assert db.session.get(Blob, blob_hash).refcount == 1
+    assert client.get(f"/download/{second['id']}").data == DATA
+
+    purge(app, client, second["id"])
+    db.session.expire_all()
+    assert db.session.get(Blob, blob_hash) is None
+    assert not os.path.exists(blob_path)
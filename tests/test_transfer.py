@@ -0,0 +1,77 @@
+import pytest
+
+from tests.conftest import upload
+
+DATA = b"0123456789abcdef" * 256  # 4 КиБ, хорошо сжимается
+
+
+@pytest.fixture(params=["", "zstd"], ids=["plain", "zstd"])
+def stored(request, app, client):
+    """Загруженный файл: как есть и сжатый при хранении"""
+    app.config["STORAGE_COMPRESSION"] = request.param
+    file_id = upload(client, "data.txt", DATA)["id"]
+    head = client.get(f"/download/{file_id}")
+    assert head.status_code == 200 and head.data == DATA
+    return f"/download/{file_id}", head
+
+
+def test_single_range(client, stored):
+    url, _ = stored
+    response = client.get(url, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.data == DATA[10:20]
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(DATA)}"
+
+
+def test_multiple_ranges(client, stored):
+    url, _ = stored
+    response = client.get(url, headers={"Range": "bytes=0-3,-4"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert DATA[:4] in response.data and DATA[-4:] in response.data
+
+
+@pytest.mark.parametrize("validator", ["ETag", "Last-Modified"])
+def test_matching_if_range_serves_ranges(client, stored, validator):
+    url, head = stored
+    headers = {"Range": "bytes=0-3,8-11", "If-Range": head.headers[validator]}
+    response = client.get(url, headers=headers)
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+
+    headers["Range"] = "bytes=4-7"
+    response = client.get(url, headers=headers)
+    assert response.status_code == 206
+    assert response.data == DATA[4:8]
+
+
+@pytest.mark.parametrize(
+    "if_range", ['"stale"', 'W/"stale"', "Thu, 01 Jan 2015 00:00:00 GMT"]
+)
+def test_stale_if_range_serves_whole_file(client, stored, if_range):
+    url, _ = stored
+    for byte_range in ("bytes=0-3", "bytes=0-3,8-11"):
+        response = client.get(url, headers={"Range": byte_range, "If-Range": if_range})
+        assert response.status_code == 200
+        assert response.data == DATA
+
+
+def test_too_many_ranges_serve_whole_file(client, stored):
+    url, _ = stored
+    ranges = ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(17))
+    response = client.get(url, headers={"Range": f"bytes={ranges}"})
+    assert response.status_code == 200
+    assert response.data == DATA
+
+
+def test_unsatisfiable_range(client, stored):
+    url, _ = stored
+    response = client.get(url, headers={"Range": f"bytes={len(DATA)}-"})
+    assert response.status_code == 416
+
+
+def test_if_none_match_returns_not_modified(client, stored):
+    url, head = stored
+    response = client.get(url, headers={"If-None-Match": head.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.data == b""
@@ -0,0 +1,48 @@
+from tests.conftest import upload
+
+
+def trash_ids(client):
+    return [f["id"] for f in client.get("/api/v1/trash").get_json()["files"]]
+
+
+def test_purge_once_removes_only_expired_files(app, client):
+    purged = upload(client, "a.txt", b"a")["id"]
+    kept = upload(client, "b.txt", b"b")["id"]
+    client.delete(f"/api/v1/files/{purged}")
+    client.delete(f"/api/v1/files/{kept}")
+    # Удаление из корзины только сдвигает срок хранения на «сейчас»
+    assert client.delete(f"/api/v1/trash/{purged}").status_code == 204
+    assert trash_ids(client) == [kept]
+
+    result = app.test_cli_runner().invoke(args=["purge-trash", "--once", "--rate", "0"])
+    assert result.exit_code == 0, result.output
+    assert result.output == "Окончательно удалено файлов: 1\n"
+    assert trash_ids(client) == [kept]
+    result = app.test_cli_runner().invoke(args=["purge-trash", "--once", "--rate", "0"])
+    assert result.output == "Окончательно удалено файлов: 0\n"
+
+
+def test_restore_returns_file_from_trash(client):
+    file_id = upload(client, "a.txt", b"a")["id"]
+    client.delete(f"/api/v1/files/{file_id}")
+    assert client.get(f"/api/v1/files/{file_id}").status_code == 404
+
+    assert client.post(f"/api/v1/trash/{file_id}/restore").status_code == 200
+    assert trash_ids(client) == []
+    assert client.get(f"/api/v1/files/{file_id}").status_code == 200
+
+
+def home_count(client):
+    page = client.get("/home").get_data(as_text=True)
+    return page.split('Ваши файлы <span class="text-muted">(', 1)[1].split(")", 1)[0]
+
+
+def test_home_count_follows_trash_and_restore(client):
+    ids = [upload(client, f"{name}.txt", b"x")["id"] for name in "abc"]
+    assert home_count(client) == "3"
+
+    client.post("/delete/bulk", data={"file_ids": [f"{ids[0]},{ids[1]}"]})
+    assert home_count(client) == "1"
+
+    client.post(f"/api/v1/trash/{ids[0]}/restore")
+    assert home_count(client) == "2"
@@ -0,0 +1,128 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from nestcloud import db
+from nestcloud.models import File, UploadSession
+from nestcloud.upload_sessions import get_part_path
+
+CHUNK = 1024
+DATA = bytes(range(256)) * 10  # 2560 байт — три чанка, последний короче
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(app):
+    app.config["UPLOAD_CHUNK_SIZE"] = CHUNK
+
+
+def create_session(client, data=DATA, name="big.bin"):
+    response = client.post("/upload/sessions", json={"filename": name, "size": len(data)})
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def put_chunk(client, session, index, data=DATA):
+    return client.put(
+        f"/upload/sessions/{session['id']}/chunks/{index}",
+        data=data[index * CHUNK : (index + 1) * CHUNK],
+    )
+
+
+def test_chunks_in_any_order_assemble_the_file(client):
+    session = create_session(client)
+    assert session["chunk_count"] == 3
+    for index in (2, 0):
+        assert put_chunk(client, session, index).status_code == 200
+
+    status = client.get(f"/upload/sessions/{session['id']}").get_json()
+    assert status["received"] == [0, 2]
+    response = client.post(f"/upload/sessions/{session['id']}/complete")
+    assert response.status_code == 409
+    assert response.get_json()["missing"] == [1]
+
+    assert put_chunk(client, session, 1).status_code == 200
+    response = client.post(f"/upload/sessions/{session['id']}/complete")
+    assert response.status_code == 201
+    assert client.get(f"/download/{response.get_json()['id']}").data == DATA
+
+
+def test_chunk_of_wrong_size_is_rejected(client):
+    session = create_session(client)
+    response = client.put(f"/upload/sessions/{session['id']}/chunks/0", data=b"short")
+    assert response.status_code == 400
+    assert client.put(f"/upload/sessions/{session['id']}/chunks/3", data=b"x").status_code == 400
+
+
+def test_other_user_cannot_touch_session(client, make_client):
+    session = create_session(client)
+    assert put_chunk(make_client("bob"), session, 0).status_code == 403
+
+
+@pytest.mark.parametrize("mode", ["files", "cas"])
+def test_failed_commit_leaves_session_retryable(app, client, monkeypatch, mode):
+    app.config["STORAGE_MODE"] = mode
+    session = create_session(client)
+    for index in range(3):
+        put_chunk(client, session, index)
+
+    commit = db.session.commit
+    calls = []
+
+    def fail_once():
+        if not calls:
+            calls.append(1)
+            raise RuntimeError("БД недоступна")
+        commit()
+
+    monkeypatch.setattr(db.session, "commit", fail_once)
+    response = client.post(f"/upload/sessions/{session['id']}/complete")
+    assert response.status_code == 500
+    monkeypatch.undo()
+
+    with app.app_context():
+        upload = db.session.get(UploadSession, session["id"])
+        assert upload is not None
+        with open(get_part_path(upload), "rb") as part:
+            assert part.read() == DATA
+        assert File.query.count() == 0
+
+    response = client.post(f"/upload/sessions/{session['id']}/complete")
+    assert response.status_code == 201
+    assert client.get(f"/download/{response.get_json()['id']}").data == DATA
+    if mode == "cas":
+        # Содержимое лежит только в хранилище блобов, файл сессии удалён
+        with app.app_context():
+            assert not os.path.exists(get_part_path(upload))
+
+
+def expire(app, session_id):
+    with app.app_context():
+        upload = db.session.get(UploadSession, session_id)
+        upload.created_at = datetime.now() - timedelta(
+            hours=app.config["UPLOAD_SESSION_TTL_HOURS"] + 1
+        )
+        db.session.commit()
+        return get_part_path(upload)
+
+
+def test_expired_session_rejects_chunks(app, client):
+    session = create_session(client)
+    part_path = expire(app, session["id"])
+
+    response = put_chunk(client, session, 0)
+    assert response.status_code == 410
+    assert not os.path.exists(part_path)
+    assert client.get(f"/upload/sessions/{session['id']}").status_code == 404
+
+
+def test_expire_command_removes_sessions_of_all_users(app, client, make_client):
+    expired = [create_session(client), create_session(make_client("bob"))]
+    fresh = create_session(client)
+    part_paths = [expire(app, session["id"]) for session in expired]
+
+    result = app.test_cli_runner().invoke(args=["expire-upload-sessions"])
+    assert "Удалено просроченных сессий: 2" in result.output
+    assert not any(os.path.exists(path) for path in part_paths)
+    with app.app_context():
+        assert [upload.id for upload in UploadSession.query] == [fresh["id"]]
@@ -0,0 +1,59 @@
+import io
+import os
+
+from nestcloud import storage
+from tests.conftest import upload
+
+
+def post_files(client, files):
+    form = {"file": [(io.BytesIO(data), name) for name, data in files]}
+    return client.post("/api/v1/files", data=form, content_type="multipart/form-data")
+
+
+def stored_files(app):
+    """Файлы на диске в папках пользователей (без служебных каталогов)"""
+    found = []
+    for root, dirs, names in os.walk(app.config["UPLOAD_FOLDER"]):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        found += [os.path.join(root, n) for n in names if not n.startswith(".")]
+    return found
+
+
+def test_several_files_in_one_request(app, client):
+    files = [(f"f{i}.txt", f"content {i}".encode()) for i in range(5)]
+    response = post_files(client, files)
+    assert response.status_code == 201
+    results = response.get_json()["results"]
+    assert [r["filename"] for r in results] == [name for name, _ in files]
+    for result, (_, data) in zip(results, files):
+        assert client.get(result["file"]["download_url"]).data == data
+    assert len(stored_files(app)) == 5
+
+
+def test_failed_write_leaves_no_partial_file(app, client, monkeypatch):
+    write_content = storage.write_content
+
+    def fail_on_broken(stream, dest_path, compress=False):
+        if stream.read(6) == b"broken":
+            with open(dest_path, "wb") as dest:
+                dest.write(b"partial")
+            raise OSError("Диск переполнен")
+        stream.seek(0)
+        return write_content(stream, dest_path, compress)
+
+    monkeypatch.setattr(storage, "write_content", fail_on_broken)
+    response = post_files(client, [("good.txt", b"good data"), ("bad.txt", b"broken data")])
+    assert response.status_code == 207
+    good, bad = response.get_json()["results"]
+    assert "error" in bad and good["file"]["filename"] == "good.txt"
+
+    # На диске только успешно записанный файл, недописанного нет
+    [path] = stored_files(app)
+    with open(path, "rb") as source:
+        assert source.read() == b"good data"
+
+
+def test_upload_into_folder(client):
+    folder = client.post("/api/v1/folders", json={"name": "docs"}).get_json()
+    uploaded = upload(client, "a.txt", b"data", folder_id=folder["id"])
+    assert uploaded["folder_id"] == folder["id"]
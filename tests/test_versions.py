@@ -0,0 +1,61 @@
+import os
+
+from sqlalchemy import update
+
+from nestcloud import db
+from nestcloud.models import User
+from tests.conftest import upload, upload_version
+
+
+def used_bytes(client):
+    return client.get("/api/v1/usage").get_json()["used_bytes"]
+
+
+def test_kept_versions_count_toward_quota(app, client):
+    file_id = upload(client, "notes.txt", os.urandom(100))["id"]
+    upload_version(client, file_id, os.urandom(300))
+    assert used_bytes(client) == 400
+
+    versions = client.get(f"/api/v1/files/{file_id}/versions").get_json()
+    assert [version["size"] for version in versions["versions"]] == [100]
+
+
+def test_pruned_versions_release_quota(app, client):
+    app.config["VERSION_KEEP_COUNT"] = 1
+    file_id = upload(client, "notes.txt", os.urandom(100))["id"]
+    upload_version(client, file_id, os.urandom(200))
+    upload_version(client, file_id, os.urandom(300))
+    # Версия из 100 байт вышла за VERSION_KEEP_COUNT и удалена
+    assert used_bytes(client) == 500
+
+
+def test_purge_releases_versions(app, client):
+    file_id = upload(client, "notes.txt", os.urandom(100))["id"]
+    upload_version(client, file_id, os.urandom(200))
+    client.delete(f"/api/v1/files/{file_id}")
+    client.delete(f"/api/v1/trash/{file_id}")
+    app.test_cli_runner().invoke(args=["purge-trash", "--once", "--rate", "0"])
+    assert used_bytes(client) == 0
+
+
+def test_version_over_quota_is_rejected(app, client):
+    app.config["USER_QUOTA_BYTES"] = 1000
+    file_id = upload(client, "notes.txt", os.urandom(300))["id"]
+    # Прежние 300 байт остаются версией, новые 800 в квоту уже не помещаются
+    response = client.post(
+        "/upload/sessions",
+        json={"file_id": file_id, "chunks": [{"hash": "0" * 64, "size": 800}]},
+    )
+    assert response.status_code == 413
+
+
+def test_reconcile_usage_counts_versions(app, client, app_context):
+    file_id = upload(client, "notes.txt", os.urandom(100))["id"]
+    upload_version(client, file_id, os.urandom(200))
+    db.session.execute(update(User).values(used_bytes=200))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["reconcile-usage"])
+    assert result.exit_code == 0, result.output
+    assert "счётчиков пользователей 1" in result.output
+    assert used_bytes(client) == 300
@@ -1,19 +1,24 @@
 from werkzeug.utils import secure_filename
+import logging
 import math
 import os
 from datetime import datetime
 from nestcloud import app
+from nestcloud import storage
+from nestcloud.metrics import PREVIEW_FAILURES, PREVIEWS_GENERATED, timed
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Tuple
-from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
 
 
 def get_human_readable_size(size_bytes: int) -> str:
     """Конвертация байтов в человекочитаемый формат"""
     if size_bytes == 0:
         return "0 B"
-    size_name = ("B", "KB", "MB", "GB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB")
+    i = min(int(math.floor(math.log(size_bytes, 1024))), len(size_name) - 1)
     p = math.pow(1024, i)
     s = round(size_bytes / p, 2)
     return f"{s} {size_name[i]}"
@@ -42,13 +47,16 @@ def generate_image_preview(
     :return: путь к превью или None, если генерация невозможна
     """
 
-    if Image is None or ImageOps is None:
+    # Pillow импортируется при первом превью: запуск рабочих процессов остаётся быстрым
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
         raise RuntimeError(
             "Pillow не установлен. Установите пакет 'Pillow' в виртуальное окружение."
         )
 
     if not os.path.exists(source_path):
-        print(f"Исходный файл не найден: {source_path}")
+        logger.warning("Исходный файл не найден: %s", source_path)
         return None
 
     if output_dir is None:
@@ -56,26 +64,29 @@ def generate_image_preview(
         output_dir = os.path.join(parent_dir, "previews")
 
     os.makedirs(output_dir, exist_ok=True)
-    print(f"Папка для превью: {output_dir}")
 
     base_name = os.path.basename(source_path)
     preview_name = f"preview_{base_name}.jpg"
     preview_path = os.path.join(output_dir, preview_name)
-    print(f"Путь к превью: {preview_path}")
 
     try:
         with Image.open(source_path) as img:
-            print(f"Изображение открыто: {img.size}, формат: {img.format}")
+            logger.debug("Изображение открыто: %s, формат: %s", img.size, img.format)
+            if img.format == "JPEG":
+                # JPEG декодируется сразу в уменьшенном масштабе (1/2…1/8) —
+                # полный кадр большой фотографии в память не разворачивается.
+                # Сторона с запасом, т.к. exif_transpose может повернуть кадр
+                side = max(max_size) * 2
+                img.draft("RGB", (side, side))
             img = ImageOps.exif_transpose(img)
             img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            print(f"Размер после уменьшения: {img.size}")
-            img.convert("RGB").save(preview_path, format="JPEG", quality=quality)
-            print(f"Превью сохранено: {preview_path}")
-    except Exception as e:
-        print(f"Ошибка при обработке изображения: {e}")
-        import traceback
-
-        traceback.print_exc()
+            # Пишем во временный файл: незаконченное превью не попадёт на место готового
+            temp_path = preview_path + ".tmp"
+            img.convert("RGB").save(temp_path, format="JPEG", quality=quality)
+            os.replace(temp_path, preview_path)
+            logger.debug("Превью сохранено: %s", preview_path)
+    except Exception:
+        logger.exception("Ошибка при обработке изображения %s", source_path)
         return None
 
     return preview_path
@@ -131,74 +142,268 @@ def get_file_icon(filename: str) -> str:
     return f"file_icons/{icon_filename}"
 
 
-def save_file(file, user_id: int) -> dict:
-    """Сохраняет файл в папку пользователя и возвращает данные для БД/превью"""
-    print(f"Сохранение файла для пользователя {user_id}")
+# Категории файлов для фильтра списка (по иконкам get_file_icon и изображениям)
+FILE_CATEGORIES = {
+    "image": "Изображения",
+    "document": "Документы",
+    "audio": "Аудио",
+    "video": "Видео",
+    "archive": "Архивы",
+    "other": "Другие",
+}
+
+
+def get_file_category(filename: str) -> str:
+    """Категория файла по расширению: image, document, audio, video, archive, other"""
+    if is_image_file(filename):
+        return "image"
+    return os.path.basename(get_file_icon(filename))[: -len(".png")]
+
+
+# Форматы, которые уже сжаты: при упаковке в ZIP их сжимать бесполезно
+COMPRESSED_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".webp",
+    ".gif",
+    ".docx",
+    ".xlsx",
+    ".pptx",
+}
+
+
+def is_compressed_format(filename: str) -> bool:
+    """Архивы, аудио, видео и сжатые форматы изображений/документов"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in COMPRESSED_EXTENSIONS:
+        return True
+    return get_file_icon(filename) in (
+        "file_icons/archive.png",
+        "file_icons/audio.png",
+        "file_icons/video.png",
+    )
+
+
+def is_compressible_format(filename: str) -> bool:
+    """
+    Можно ли сжимать файл при хранении: изображения (из них строятся превью)
+    и уже сжатые форматы хранятся как есть, остальное проверяется пробой сжатия.
+    """
+    return not is_image_file(filename) and not is_compressed_format(filename)
+
+
+def build_preview(filepath: str, user_folder: str) -> Tuple[Optional[str], str]:
+    """
+    Создаёт превью изображения в папке previews пользователя.
+
+    :return: (путь к превью относительно папки пользователя, статус превью)
+    """
+    shard = storage.get_shard_dir(os.path.basename(filepath))
+    try:
+        with timed("preview"):
+            preview_absolute = generate_image_preview(
+                filepath,
+                output_dir=os.path.join(user_folder, "previews", shard),
+            )
+    except Exception:
+        logger.exception("Не удалось создать превью для %s", filepath)
+        preview_absolute = None
 
-    # 1. Путь к папке пользователя
-    user_folder = os.path.join(app.config["UPLOAD_FOLDER"], f"{user_id}")
-    print(f"Папка пользователя: {user_folder}")
+    if not preview_absolute:
+        PREVIEW_FAILURES.inc()
+        return None, "failed"
 
-    # 2. Проверяем существование папки
+    PREVIEWS_GENERATED.inc()
+    preview_relpath = os.path.relpath(preview_absolute, user_folder).replace(os.sep, "/")
+    return preview_relpath, "ready"
+
+
+def get_user_folder(user_id: int) -> str:
+    """Возвращает путь к папке пользователя, создавая её при необходимости"""
+    user_folder = storage.get_user_root(user_id)
     if not os.path.exists(user_folder):
-        print(f"Папка не существует! Пытаемся создать...")
+        logger.info("Создаётся папка пользователя: %s", user_folder)
         os.makedirs(user_folder, exist_ok=True)
+    return user_folder
 
-    # 3. Генерируем уникальное имя
-    filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4().hex}_{filename}"
-    filepath = os.path.join(user_folder, unique_filename)
-    print(f"Итоговый путь: {filepath}")
 
-    # 4. Сохраняем файл на диск
-    try:
-        file.save(filepath)
-        print(f"Файл сохранён на диск")
-    except Exception as e:
-        print(f"Ошибка сохранения на диск: {str(e)}")
-        raise
+def make_stored_filename(original_filename: str) -> str:
+    """Генерирует уникальное имя файла на диске"""
+    return f"{uuid.uuid4().hex}_{secure_filename(original_filename)}"
+
 
-    # 5. Готовим данные для БД
-    file_size = os.path.getsize(filepath)
+def describe_stored_file(
+    filepath: str, original_filename: str, user_folder: str, content: Optional[dict] = None
+) -> dict:
+    """
+    Собирает данные для БД по уже записанному на диск файлу и определяет превью.
+
+    :param filepath: полный путь к сохранённому файлу
+    :param original_filename: оригинальное имя файла (до secure_filename)
+    :param user_folder: папка пользователя
+    :param content: результат storage.write_content — размер и sample_hash
+                    уже посчитаны при записи (и файл на диске может быть сжат)
+    :return: словарь с данными для модели File
+    """
+    # 1. Готовим данные для БД
+    if content is not None:
+        file_size = content["size_bytes"]
+    else:
+        with timed("getsize"):
+            file_size = os.path.getsize(filepath)
     human_size = get_human_readable_size(file_size)
     upload_time = datetime.now()
 
-    # 6. Генерируем превью для изображений или используем иконку для других файлов
+    # 2. Превью для изображений строит фоновый обработчик (flask preview-worker),
+    # для остальных файлов используется иконка
     preview_relpath = None
-    original_filename = file.filename  # Оригинальное имя до secure_filename
-    print(
-        f"Проверка на изображение: оригинальное имя = {original_filename}, обработанное = {filename}"
-    )
+    preview_status = None
 
     if is_image_file(original_filename):
-        print(f"   → Файл определён как изображение, генерирую превью...")
-        try:
-            preview_absolute = generate_image_preview(
-                filepath,
-                output_dir=os.path.join(user_folder, "previews"),
-            )
-            if preview_absolute:
-                preview_relpath = os.path.relpath(preview_absolute, user_folder)
-                print(f"Превью создано: {preview_relpath}")
-                print(f"Абсолютный путь: {preview_absolute}")
-            else:
-                print(f"generate_image_preview вернул None")
-        except Exception as e:
-            print(f"Не удалось создать превью: {e}")
-            import traceback
-
-            traceback.print_exc()
+        if app.config["PREVIEW_MODE"] == "inline":
+            preview_relpath, preview_status = build_preview(filepath, user_folder)
+        else:
+            preview_status = "pending"
     else:
         # Для не-изображений используем иконку
         preview_relpath = get_file_icon(original_filename)
-        print(f"Файл не является изображением, используется иконка: {preview_relpath}")
 
-    print(f"Размер: {file_size} байт → {human_size}")
+    if content is not None:
+        sample_hash = content["sample_hash"]
+    else:
+        with timed("sample_hash"):
+            sample_hash = storage.sample_hash_file(filepath)
     return {
-        "stored_filename": unique_filename,
+        "stored_filename": os.path.basename(filepath),
         "original_filename": original_filename,
         "human_size": human_size,
+        "size_bytes": file_size,
         "upload_time": upload_time,
         "preview_relpath": preview_relpath,
+        "preview_status": preview_status,
+        "sample_hash": sample_hash,
+        "encoding": content["encoding"] if content is not None else None,
+        "stored_size": content["stored_size"] if content is not None else file_size,
         "absolute_path": filepath,
     }
+
+
+def get_upload_filename(file) -> str:
+    """Имя файла без пути (при загрузке папки браузер передаёт относительный путь)"""
+    return os.path.basename((file.filename or "").replace("\\", "/"))
+
+
+def write_file_to_disk(file, user_id: int) -> dict:
+    """
+    Записывает загруженный файл на диск, не обращаясь к БД —
+    поэтому несколько файлов можно записывать параллельно в разных потоках.
+    Результат передаётся в register_written_file.
+    """
+    original_filename = get_upload_filename(file)
+
+    # 1. Путь к папке пользователя (создаётся при необходимости)
+    user_folder = get_user_folder(user_id)
+
+    # 2. Генерируем уникальное имя (в режиме files — внутри подкаталога по хешу имени)
+    unique_filename = make_stored_filename(original_filename)
+    if not storage.is_cas_enabled():
+        unique_filename = storage.make_file_relpath(unique_filename)
+    written = {
+        "original_filename": original_filename,
+        "stored_filename": unique_filename,
+        "user_folder": user_folder,
+        "blob_hash": None,
+        "content_hash": None,
+        "content": None,
+    }
+
+    # Режим хранилища блобов: хеш считается во время записи во временный файл
+    if storage.is_cas_enabled():
+        temp_path = storage.make_temp_path()
+        try:
+            with timed("file_save"):
+                written["blob_hash"] = storage.copy_and_hash(file.stream, temp_path)
+            written["content_hash"] = written["blob_hash"]
+        except Exception:
+            logger.exception("Ошибка сохранения в хранилище блобов: %s", original_filename)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        written["path"] = temp_path
+        return written
+
+    filepath = storage.resolve_user_path(user_id, unique_filename)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    # 3. Сохраняем файл на диск (сжимаемый — сжатым), попутно считая хеш
+    # содержимого для индекса дубликатов
+    compress = storage.is_compression_enabled() and is_compressible_format(
+        original_filename
+    )
+    try:
+        with timed("file_save"):
+            written["content"] = storage.write_content(file.stream, filepath, compress)
+        written["content_hash"] = written["content"]["content_hash"]
+    except Exception:
+        logger.exception("Ошибка сохранения на диск: %s", filepath)
+        # Недописанный файл ни на что не ссылается — как временный файл блоба выше
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        raise
+    logger.debug("Файл сохранён на диск: %s", filepath)
+    written["path"] = filepath
+    return written
+
+
+def register_written_file(written: dict) -> dict:
+    """
+    Завершает сохранение записанного файла: в режиме cas помещает его
+    в хранилище блобов (дубликаты не хранятся), затем собирает данные для БД.
+    """
+    filepath = written["path"]
+    if written["blob_hash"]:
+        try:
+            filepath = storage.store_blob(filepath, written["blob_hash"])
+        except Exception:
+            if os.path.exists(written["path"]):
+                os.remove(written["path"])
+            raise
+
+    # 4. Размер, время загрузки и превью
+    saved_data = describe_stored_file(
+        filepath, written["original_filename"], written["user_folder"], written["content"]
+    )
+    saved_data["stored_filename"] = written["stored_filename"]
+    saved_data["blob_hash"] = written["blob_hash"]
+    saved_data["content_hash"] = written["content_hash"]
+    return saved_data
+
+
+def save_file(file, user_id: int) -> dict:
+    """Сохраняет файл в папку пользователя и возвращает данные для БД/превью"""
+    return register_written_file(write_file_to_disk(file, user_id))
+
+
+def save_files(files, user_id: int) -> list:
+    """
+    Сохраняет несколько файлов: запись на диск идёт параллельно
+    (UPLOAD_WRITE_WORKERS потоков), регистрация — в текущем потоке,
+    т.к. использует сессию БД.
+
+    :return: список (имя файла, данные для БД или None, ошибка или None)
+    """
+    logger.debug("Сохранение %d файлов для пользователя %s", len(files), user_id)
+    workers = max(1, min(app.config["UPLOAD_WRITE_WORKERS"], len(files)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(write_file_to_disk, file, user_id) for file in files]
+
+    results = []
+    for file, future in zip(files, futures):
+        filename = get_upload_filename(file)
+        try:
+            results.append((filename, register_written_file(future.result()), None))
+        except Exception as e:
+            logger.warning("Не удалось сохранить файл %s: %s", filename, e)
+            results.append((filename, None, str(e)))
+    return results
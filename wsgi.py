@@ -0,0 +1,9 @@
+"""
+Точка входа для WSGI-сервера в рабочем режиме:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from nestcloud import create_app
+
+app = create_app()